@@ -1,47 +1,188 @@
-import json
 import os
+import atexit
+import bisect
+import functools
 import time
 import random
-from pathlib import Path
+import threading
+import copy
+from collections import OrderedDict
+from types import MappingProxyType
+from collections.abc import Iterable
+from typing import NamedTuple
 import logging
 from datetime import datetime, timedelta
-import urllib.parse as urlparse
+from contextlib import contextmanager
+import orjson # Faster JSONB (de)serialization than the stdlib json module
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras # For JSONB support
+import psycopg2.pool
 
 logger = logging.getLogger(__name__)
 
+def _json_dumps(obj) -> str:
+    """Serializes a JSONB parameter with orjson (str, so psycopg2 doesn't send it as bytea)."""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
 # --- Database Setup ---
 DATABASE_URL = os.getenv('DATABASE_URL')
-_db_conn = None # Simple connection caching
+DB_POOL_MIN_CONN = 2
+DB_POOL_MAX_CONN = 25 # Roughly the number of handlers we expect to hit the DB at once
+POOL: psycopg2.pool.ThreadedConnectionPool | None = None
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONN) # One per pool connection; db_conn waits on it
+_schema_initialized = False # Prepared statements need the tables to exist first
+
+# Hot-path statements, prepared once per connection and run via EXECUTE <name>(...)
+# Name: (Parameter Types, Statement)
+_PREPARED_STATEMENTS = {
+    "load_player": (("bigint",), """
+        SELECT display_name, franchise_name, cash, pizza_coins, shops, unlocked_achievements, current_title,
+               active_challenges, challenge_progress, stats, total_income_earned, last_login_time,
+               collection_count, last_sabotage_attempt_time, last_summary_seen_version
+        FROM players WHERE user_id = $1
+    """),
+    "save_player": (("bigint", "text", "text", "numeric", "integer", "jsonb", "text[]", "text",
+                     "jsonb", "jsonb", "jsonb", "numeric", "double precision", "integer",
+                     "double precision", "text"), """
+        INSERT INTO players (
+            user_id, display_name, franchise_name, cash, pizza_coins, shops, unlocked_achievements, current_title,
+            active_challenges, challenge_progress, stats, total_income_earned, last_login_time,
+            collection_count, last_sabotage_attempt_time, last_summary_seen_version
+        )
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, to_timestamp($13), $14, to_timestamp($15), $16)
+        ON CONFLICT (user_id) DO UPDATE SET
+            display_name = EXCLUDED.display_name,
+            franchise_name = EXCLUDED.franchise_name,
+            cash = EXCLUDED.cash,
+            pizza_coins = EXCLUDED.pizza_coins,
+            shops = EXCLUDED.shops,
+            unlocked_achievements = EXCLUDED.unlocked_achievements,
+            current_title = EXCLUDED.current_title,
+            active_challenges = EXCLUDED.active_challenges,
+            challenge_progress = EXCLUDED.challenge_progress,
+            stats = EXCLUDED.stats,
+            total_income_earned = EXCLUDED.total_income_earned,
+            last_login_time = GREATEST(players.last_login_time, EXCLUDED.last_login_time), -- A stale copy never moves activity back
+            collection_count = EXCLUDED.collection_count,
+            last_sabotage_attempt_time = EXCLUDED.last_sabotage_attempt_time,
+            last_summary_seen_version = EXCLUDED.last_summary_seen_version
+    """),
+    "touch_login": (("bigint", "text", "text", "numeric", "integer", "jsonb", "text[]", "text",
+                     "jsonb", "jsonb", "jsonb", "numeric", "double precision", "integer",
+                     "double precision", "text"), """
+        INSERT INTO players (
+            user_id, display_name, franchise_name, cash, pizza_coins, shops, unlocked_achievements, current_title,
+            active_challenges, challenge_progress, stats, total_income_earned, last_login_time,
+            collection_count, last_sabotage_attempt_time, last_summary_seen_version
+        )
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, to_timestamp($13), $14, to_timestamp($15), $16)
+        ON CONFLICT (user_id) DO UPDATE SET
+            last_login_time = EXCLUDED.last_login_time,
+            display_name = COALESCE(EXCLUDED.display_name, players.display_name)
+        RETURNING display_name, franchise_name, cash, pizza_coins, shops, unlocked_achievements, current_title,
+                  active_challenges, challenge_progress, stats, total_income_earned, last_login_time,
+                  collection_count, last_sabotage_attempt_time, last_summary_seen_version,
+                  (xmax = 0) AS inserted
+    """),
+    "record_activity": (("bigint", "double precision"), """
+        UPDATE players SET last_login_time = to_timestamp($2)
+        WHERE user_id = $1 AND last_login_time < to_timestamp($2)
+    """),
+    "update_display_name": (("bigint", "text"), """
+        UPDATE players SET display_name = $2
+        WHERE user_id = $1 AND (display_name IS NULL OR display_name != $2)
+    """),
+    "income_leaderboard": (("integer",), """
+        SELECT user_id, display_name, total_income_earned,
+               RANK() OVER (ORDER BY total_income_earned DESC) AS rank,
+               current_title, shops
+        FROM players
+        ORDER BY total_income_earned DESC
+        LIMIT $1
+    """),
+    "cash_leaderboard": (("integer",), """
+        SELECT user_id, display_name, cash
+        FROM players
+        ORDER BY cash DESC
+        LIMIT $1
+    """),
+    "performance_multipliers": (("text[]",), """
+        SELECT location_name, current_multiplier FROM location_performance WHERE location_name = ANY($1)
+    """),
+}
 
-def get_db_connection():
-    """Establishes or reuses a database connection."""
-    global _db_conn
+def _prepare_statements(conn) -> None:
+    """Prepares the hot-path statements on the given connection (session scoped)."""
+    with conn.cursor() as cur:
+        for name, (arg_types, statement) in _PREPARED_STATEMENTS.items():
+            args_sql = f" ({', '.join(arg_types)})" if arg_types else ""
+            cur.execute(f"PREPARE {name}{args_sql} AS {statement}")
+    conn.commit()
+    conn.statements_prepared = True
+    logger.info(f"Prepared {len(_PREPARED_STATEMENTS)} statements on database connection.")
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """Pool connection that remembers whether the hot-path statements are prepared on it."""
+    statements_prepared = False
+
+def init_db_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Creates the shared connection pool (no-op if it already exists)."""
+    global POOL
+    if POOL is not None:
+        return POOL
     if not DATABASE_URL:
         logger.critical("DATABASE_URL environment variable not set!")
         raise ConnectionError("Database URL not configured.")
-
-    # Check if connection is alive, otherwise reconnect
-    if _db_conn is None or _db_conn.closed != 0:
+    try:
+        logger.info(f"Creating database connection pool ({DB_POOL_MIN_CONN}-{DB_POOL_MAX_CONN} connections)...")
+        POOL = psycopg2.pool.ThreadedConnectionPool(
+            DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, DATABASE_URL,
+            sslmode='require', connection_factory=_PooledConnection
+        )
+        psycopg2.extras.register_default_jsonb(globally=True, loads=orjson.loads) # Parse JSONB columns with orjson
+        logger.info("Database connection pool ready.")
+    except psycopg2.DatabaseError as e:
+        logger.critical(f"Database connection failed: {e}", exc_info=True)
+        raise
+    return POOL
+
+def close_db_pool() -> None:
+    """Closes every pooled connection; called on bot shutdown."""
+    global POOL
+    if POOL is not None:
+        POOL.closeall()
+        POOL = None
+        logger.info("Database connection pool closed.")
+
+@contextmanager
+def db_conn():
+    """Borrows a connection from the pool and always hands it back. Waits for a free connection rather than
+       letting getconn() raise PoolError; never take a second one while holding one (that can deadlock)."""
+    pool = init_db_pool()
+    _pool_slots.acquire()
+    try:
+        conn = pool.getconn()
         try:
-            logger.info("Attempting to connect to the database...")
-            _db_conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-            psycopg2.extras.register_default_jsonb(conn_or_curs=_db_conn, globally=True) # Ensure JSONB is handled correctly
-            logger.info("Database connection successful.")
-        except psycopg2.DatabaseError as e:
-            logger.critical(f"Database connection failed: {e}", exc_info=True)
-            _db_conn = None # Reset on failure
-            raise # Re-raise the exception
-    return _db_conn
+            if _schema_initialized and not conn.statements_prepared:
+                _prepare_statements(conn) # Prepared statements are per connection
+            yield conn
+        finally:
+            # Never return a connection mid-transaction; drop it if it is broken
+            broken = bool(conn.closed)
+            if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            pool.putconn(conn, close=broken)
+    finally:
+        _pool_slots.release()
 
 def initialize_database():
     """Creates the players table if it doesn't exist."""
+    global _schema_initialized
     logger.info("Initializing database schema...")
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Cannot initialize database without a connection.")
-        return
 
     create_players_sql = """
     CREATE TABLE IF NOT EXISTS players (
@@ -75,16 +216,29 @@ def initialize_database():
     CREATE INDEX IF NOT EXISTS idx_players_display_name_lower
     ON players (LOWER(display_name));
     """
-    try:
-        with conn.cursor() as cur:
-            cur.execute(create_players_sql)
-            cur.execute(create_perf_sql)
-            cur.execute(create_name_index_sql) # <<< Add index creation
-        conn.commit()
-        logger.info("Schema checked/created successfully (players, location_performance, indexes).") # Updated log
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Error initializing database tables: {e}", exc_info=True)
-        conn.rollback()
+    # Leaderboard indexes: ORDER BY ... LIMIT walks the index. INCLUDE lets the cash board
+    # (user_id, display_name, cash) be an index-only scan that never reads the JSONB-heavy heap rows;
+    # the income board also returns current_title and shops, so it reads the heap for its LIMIT rows anyway
+    create_leaderboard_indexes_sql = """
+    CREATE INDEX IF NOT EXISTS idx_players_total_income_desc
+    ON players (total_income_earned DESC);
+    CREATE INDEX IF NOT EXISTS idx_players_cash_leaderboard
+    ON players (cash DESC) INCLUDE (user_id, display_name);
+    """
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(create_players_sql)
+                cur.execute(create_perf_sql)
+                cur.execute(create_name_index_sql) # <<< Add index creation
+                cur.execute(create_leaderboard_indexes_sql)
+            conn.commit()
+            logger.info("Schema checked/created successfully (players, location_performance, indexes).") # Updated log
+            _prepare_statements(conn)
+            _schema_initialized = True
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Error initializing database tables: {e}", exc_info=True)
+            conn.rollback()
 
 # --- Game Constants ---
 INITIAL_CASH = 10
@@ -93,6 +247,14 @@ BASE_INCOME_PER_SECOND = 0.1
 BASE_UPGRADE_COST = 75
 UPGRADE_COST_MULTIPLIER = 1.75
 UPGRADE_FAILURE_CHANCE = 0.15 # 15% chance for an upgrade to fail
+MAFIA_DEMAND_RANGE = (0.10, 0.75) # Fraction of the collection the Mafia asks for
+TIP_CHANCE = 0.15 # Chance a normal collection comes with a customer tip
+TIP_COLLECTION_FRACTION_RANGE = (0.05, 0.2) # Tip: this fraction of the collection...
+TIP_FLAT_RANGE = (5, 50) # ...plus a flat amount
+_rng = random.Random() # Module-local generator for the collect path and batch helpers
+PERFORMANCE_FLUCTUATION_RANGE = (0.7, 1.5) # Location performance fluctuates around 1.0
+_POW_TABLE_SIZE = 256 # Levels beyond this fall back to a real pow()
+_POW_TABLE = tuple(UPGRADE_COST_MULTIPLIER ** i for i in range(_POW_TABLE_SIZE))
 BASE_EXPANSION_COST = 1000 # Base cost to expand
 SABOTAGE_BASE_COST = 1000
 SABOTAGE_PCT_COST = 0.05
@@ -134,6 +296,40 @@ EXPANSION_LOCATIONS = {
     "Qo'noS":       ("shops_count", 15, 50.0, 100.0),    # Req: Own 15 Shops - Klingons prefer their pizza with live toppings
 }
 
+# Flat per-location lookups (GDP factor / cost scale), precomputed so hot loops skip the tuple unpacking
+_INCOME_MULT = {INITIAL_SHOP_NAME: 1.0, **{name: data[2] for name, data in EXPANSION_LOCATIONS.items()}}
+_COST_SCALE = {INITIAL_SHOP_NAME: 1.0, **{name: data[3] for name, data in EXPANSION_LOCATIONS.items()}}
+def format_money(value: float) -> str:
+    """Dollar amount with thousands separators and cents, without the '$' sign."""
+    return format(value, ",.2f")
+
+def _format_expansion_requirement(req_data: tuple) -> str:
+    """Formats the '(Req: ...)' hint shown next to an expansion in /status."""
+    req_type, req_value = req_data[0], req_data[1]
+    if req_type == "level":
+        return f"(Req: {INITIAL_SHOP_NAME} Lvl {req_value})"
+    elif req_type == "shop_level":
+        return f"(Req: {req_value} Lvl {req_data[2]})"
+    elif req_type == "total_income":
+        return f"(Req: Total Earned ${format_money(req_value)})"
+    elif req_type == "shops_count":
+        return f"(Req: {req_value} Shops)"
+    elif req_type == "has_shop":
+        return f"(Req: Own {req_value})"
+    return "(Unknown Req)"
+
+# Requirement hints never change, so render them once
+EXPANSION_REQ_STR = {name: _format_expansion_requirement(data) for name, data in EXPANSION_LOCATIONS.items()}
+# Case-insensitive name lookup for user input, e.g. "new york city" -> "New York City"
+EXPANSION_LOOKUP = {name.lower(): name for name in EXPANSION_LOCATIONS}
+# Same for every location a shop can exist in, starting shop included
+SHOP_LOOKUP = {INITIAL_SHOP_NAME.lower(): INITIAL_SHOP_NAME, **EXPANSION_LOOKUP}
+# Final rounded upgrade cost per location, indexed by current_level - 1
+_UPGRADE_COST_TABLE = {
+    name: tuple(round(BASE_UPGRADE_COST * scale * multiplier, 2) for multiplier in _POW_TABLE)
+    for name, scale in _COST_SCALE.items()
+}
+
 # --- Achievement Definitions ---
 # ID: (Name, Description, Check Function Args, Requirement, Reward Type, Reward Value, Title Awarded)
 # Check Function Args: Tuple defining what metric to check (e.g., ('total_income',), ('shops_count',))
@@ -163,7 +359,30 @@ ACHIEVEMENTS = {
     # Add more achievements: rivals defeated (requires rival logic), specific shop levels, etc.
 }
 
+def _group_achievements_by_metric() -> dict[str, list[tuple]]:
+    """Groups ACHIEVEMENTS by the metric they check, e.g. 'shops_count' -> [(id, data), ...]."""
+    grouped = {}
+    for achievement_id, achievement_data in ACHIEVEMENTS.items():
+        metric = achievement_data[2][0]
+        grouped.setdefault(metric, []).append((achievement_id, achievement_data))
+    return grouped
+
+# Lets check_achievements evaluate only the achievements an action could have affected
+_ACH_BY_METRIC = _group_achievements_by_metric()
+# One bit per achievement so "anything left to unlock?" is a single integer test
+_ACH_BIT = {achievement_id: 1 << i for i, achievement_id in enumerate(ACHIEVEMENTS)}
+ALL_ACHIEVEMENTS_MASK = (1 << len(ACHIEVEMENTS)) - 1
+_ACH_METRIC_MASK = {
+    metric: sum(_ACH_BIT[achievement_id] for achievement_id, _ in entries)
+    for metric, entries in _ACH_BY_METRIC.items()
+}
+# Achievement metrics each action can change
+COLLECT_ACHIEVEMENT_METRICS = ('total_income_earned',)
+UPGRADE_ACHIEVEMENT_METRICS = ('shop_level',)
+EXPAND_ACHIEVEMENT_METRICS = ('shops_count', 'has_shop')
+
 # --- Challenge Definitions ---
+CHALLENGE_TIMESCALES = ("daily", "weekly")
 # Type: (Description Template, Metric, Timescale ('daily', 'weekly'), Base Goal, Goal Increase Per Level (approx), Reward Type, Base Reward, Reward Increase Per Level)
 CHALLENGE_TYPES = {
     "earn_cash": ("Earn ${goal:,.2f} {timescale}", "session_income", None, 100, 1.5, 'cash', 50, 1.5),
@@ -174,131 +393,343 @@ CHALLENGE_TYPES = {
 
 # --- Database Player Data Management ---
 
+# Canonical defaults, merged into player dicts in one step (read-only to avoid accidental shared writes)
+_DEFAULT_STATS = MappingProxyType({
+    'session_income': 0, 'session_upgrades': 0,
+    'session_collects': 0, 'session_expansions': 0
+})
+# Scalar top-level defaults only; JSONB containers get fresh objects per player below
+_DEFAULT_PLAYER = MappingProxyType({
+    "display_name": None,
+    "franchise_name": None,
+    "cash": 0.0,
+    "pizza_coins": 0,
+    "current_title": None,
+    "total_income_earned": 0.0,
+    "collection_count": 0,
+    "last_sabotage_attempt_time": 0.0,
+    "last_summary_seen_version": None,
+})
+
+# --- In-Process Player Cache (write-behind) ---
+# load_player_data serves hot players from memory; save_player_data marks them dirty and a
+# debounced timer writes every dirty player back. Saves that only touch bookkeeping fields
+# (_VOLATILE_PLAYER_FIELDS) skip the timer and wait for the periodic flush job in main.py.
+# Code that rewrites player rows with its own SQL must not race the cache: see write_challenge_page,
+# which patches cached players in memory and keeps concurrent loads from caching the rows it rewrites.
+PLAYER_CACHE_MAX_SIZE = 10_000
+PLAYER_CACHE_TTL_SECONDS = 300 # Clean entries older than this are re-read from the DB
+PLAYER_FLUSH_DELAY_SECONDS = 0.5 # Saves within this window coalesce into one write
+PLAYER_PERIODIC_FLUSH_SECONDS = 60 # Upper bound on how long a volatile-only change stays in memory
+LOGIN_TIME_RESOLUTION_SECONDS = 60 # Repeat logins within this window don't re-dirty a cached player
+ACTIVITY_DB_STAMP_SECONDS = 3600 # Uncached players get last_login_time written directly at most this often
+_VOLATILE_PLAYER_FIELDS = frozenset({"challenge_progress", "stats", "last_login_time", "challenge_by_metric", "achievements_mask"})
+
+PLAYER_CACHE: "OrderedDict[int, list]" = OrderedDict() # user_id: [player_data, dirty, cached_at], oldest first
+_activity_db_stamps: "OrderedDict[int, float]" = OrderedDict() # user_id: last direct last_login_time write (record_activity), oldest first
+# Rows write_challenge_page is rewriting in SQL, and a counter bumped after each such write; a load whose
+# DB read may predate the write must not cache what it read (see _cache_loaded_player)
+_rewriting_ids: set[int] = set()
+_rewrite_generation = 0
+_player_cache_lock = threading.Lock()
+# Held by a flush from its snapshot through its commit, so an older snapshot can never land after a newer one
+_flush_lock = threading.Lock()
+_flush_timer: threading.Timer | None = None
+
+def _clone_player(data: dict) -> dict:
+    """Independent copy of player data; an orjson round trip is much cheaper than deepcopy for plain JSON data."""
+    try:
+        return orjson.loads(orjson.dumps(data))
+    except orjson.JSONEncodeError: # Something non-JSON slipped in; keep it intact
+        return copy.deepcopy(data)
+
+def _cache_player(user_id: int, data: dict, dirty: bool) -> None:
+    """Stores a private copy of data; caller must hold _player_cache_lock."""
+    entry = PLAYER_CACHE.get(user_id)
+    # Keep a pending write pending even if a clean copy arrives meanwhile
+    dirty = dirty or bool(entry and entry[1])
+    PLAYER_CACHE[user_id] = [_clone_player(data), dirty, time.monotonic()]
+    PLAYER_CACHE.move_to_end(user_id)
+    # Evict least recently used clean entries, oldest first; dirty ones leave after their flush
+    if len(PLAYER_CACHE) > PLAYER_CACHE_MAX_SIZE:
+        cold_ids = []
+        excess = len(PLAYER_CACHE) - PLAYER_CACHE_MAX_SIZE
+        for uid, (_, is_dirty, _) in PLAYER_CACHE.items():
+            if not is_dirty:
+                cold_ids.append(uid)
+                if len(cold_ids) == excess:
+                    break
+        for cold_id in cold_ids:
+            del PLAYER_CACHE[cold_id]
+
+def _durable_fields_changed(cached: dict, data: dict) -> bool:
+    """True if data differs from the cached copy in anything besides _VOLATILE_PLAYER_FIELDS."""
+    return any(cached.get(key) != value for key, value in data.items() if key not in _VOLATILE_PLAYER_FIELDS)
+
+def _schedule_flush() -> None:
+    """Starts the debounce timer unless one is already pending; caller must hold _player_cache_lock."""
+    global _flush_timer
+    if _flush_timer is None:
+        _flush_timer = threading.Timer(PLAYER_FLUSH_DELAY_SECONDS, flush_player_cache)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def flush_player_cache(user_ids: Iterable[int] | None = None) -> None:
+    """Writes dirty cached players (all, or only user_ids) back to the database."""
+    global _flush_timer
+    with _flush_lock:
+        with _player_cache_lock:
+            if user_ids is None:
+                _flush_timer = None
+                wanted = list(PLAYER_CACHE)
+            else:
+                wanted = [uid for uid in user_ids if uid in PLAYER_CACHE]
+            pending = []
+            for uid in wanted:
+                entry = PLAYER_CACHE[uid]
+                if entry[1]:
+                    entry[1] = False
+                    # Serializing under the lock is the snapshot; no separate copy of the dict is needed
+                    pending.append((uid, _save_player_params(uid, entry[0])))
+
+        if not pending:
+            return
+        if _write_player_params_to_db(pending):
+            logger.debug(f"Flushed {len(pending)} cached players to the database.")
+        else:
+            with _player_cache_lock:
+                for uid, _ in pending:
+                    if uid in PLAYER_CACHE:
+                        PLAYER_CACHE[uid][1] = True
+                _schedule_flush() # Retry on the next tick
+
+# Last chance for held-back writes if the process exits without the bot's shutdown hook running
+atexit.register(flush_player_cache)
+
+def _cache_loaded_player(user_id: int, data: dict, generation: int) -> dict:
+    """Caches data just read from the DB and returns the copy the caller should use. A copy cached by someone
+       else during the read wins, and nothing is cached if a challenge rewrite may have overtaken the read."""
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        if entry and (entry[1] or time.monotonic() - entry[2] < PLAYER_CACHE_TTL_SECONDS):
+            PLAYER_CACHE.move_to_end(user_id)
+            return _clone_player(entry[0])
+        if generation == _rewrite_generation and user_id not in _rewriting_ids:
+            _cache_player(user_id, data, dirty=False)
+    return data
+
 def update_display_name(user_id: int, user: "telegram.User | None") -> None:
     """Updates the player's display name in the database if available."""
     if not user or not user.full_name:
         return # Cannot update without user object or name
 
     logger.debug(f"Checking/Updating display name for user {user_id}")
-    conn = get_db_connection()
-    if not conn: return
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        if entry:
+            entry[0]["display_name"] = user.full_name # Keep a pending flush from writing the old name back
 
-    sql_update = "UPDATE players SET display_name = %s WHERE user_id = %s AND (display_name IS NULL OR display_name != %s);"
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql_update, (user.full_name, user_id, user.full_name))
-            if cur.rowcount > 0:
-                logger.info(f"Updated display name for user {user_id} to '{user.full_name}'")
-        conn.commit()
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Database error updating display name for {user_id}: {e}", exc_info=True)
-        conn.rollback()
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE update_display_name(%s, %s);", (user_id, user.full_name))
+                if cur.rowcount > 0:
+                    logger.info(f"Updated display name for user {user_id} to '{user.full_name}'")
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error updating display name for {user_id}: {e}", exc_info=True)
+            conn.rollback()
 
 def load_player_data(user_id: int) -> dict | None:
-    """Loads player data from the database. Returns default state if not found."""
+    """Loads player data, from the in-process cache when possible. Returns default state if not found."""
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        if entry and (entry[1] or time.monotonic() - entry[2] < PLAYER_CACHE_TTL_SECONDS):
+            PLAYER_CACHE.move_to_end(user_id)
+            return _clone_player(entry[0])
+        generation = _rewrite_generation
+
+    player_data = _load_player_from_db(user_id)
+    if player_data is None:
+        # Fallback strategy: return default state without saving or caching
+        return get_default_player_state(user_id)
+    return _cache_loaded_player(user_id, player_data, generation)
+
+def _load_player_from_db(user_id: int) -> dict | None:
+    """Loads player data from the database, inserting the default state if not found. None on DB error."""
     logger.debug(f"Attempting to load data for user {user_id} from database.")
-    conn = get_db_connection()
-    if not conn: return get_default_player_state(user_id) # Return default if DB fails initially
 
-    sql = """
-    SELECT display_name, franchise_name, cash, pizza_coins, shops, unlocked_achievements, current_title,
-           active_challenges, challenge_progress, stats, total_income_earned, last_login_time,
-           collection_count, last_sabotage_attempt_time, last_summary_seen_version
-    FROM players WHERE user_id = %s;
-    """
     default_state = get_default_player_state(user_id)
 
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (user_id,))
-            result = cur.fetchone()
-
-        if result:
-            logger.debug(f"Found existing player data for {user_id}.")
-            player_data = {
-                "user_id": user_id,
-                "display_name": result[0],
-                "franchise_name": result[1],
-                "cash": float(result[2]),
-                "pizza_coins": result[3],
-                "shops": result[4] if result[4] is not None else {},
-                "unlocked_achievements": result[5] if result[5] is not None else [],
-                "current_title": result[6],
-                "active_challenges": result[7] if result[7] is not None else {'daily': None, 'weekly': None},
-                "challenge_progress": result[8] if result[8] is not None else {'daily': {}, 'weekly': {}},
-                "stats": result[9] if result[9] is not None else {},
-                "total_income_earned": float(result[10]),
-                "last_login_time": result[11].timestamp() if result[11] else time.time(),
-                "collection_count": result[12] or 0,
-                "last_sabotage_attempt_time": result[13].timestamp() if result[13] else 0.0,
-                "last_summary_seen_version": result[14]
-            }
-            player_data.setdefault("active_challenges", {'daily': None, 'weekly': None})
-            player_data.setdefault("challenge_progress", {'daily': {}, 'weekly': {}})
-            player_data.setdefault("stats", {})
-            player_data['stats'].setdefault('session_income', 0)
-            player_data['stats'].setdefault('session_upgrades', 0)
-            player_data['stats'].setdefault('session_collects', 0)
-            player_data['stats'].setdefault('session_expansions', 0)
-            # --- Migration / Defaulting for shop names --- #
-            if player_data["shops"]:
-                for loc, shop_data in player_data["shops"].items():
-                    shop_data.setdefault("custom_name", loc) # Default name to location if missing
-                    # Ensure level and time exist too for consistency
-                    shop_data.setdefault("level", 1)
-                    shop_data.setdefault("last_collected_time", time.time())
-                    shop_data.setdefault("shutdown_until", None) # <<< Add default
-            # --- End Migration --- #
-            return player_data
-        else:
-            logger.info(f"No player data found for {user_id}. Inserting default state.")
-            default_state["collection_count"] = 0 # Ensure default includes it
-            save_player_data(user_id, default_state)
-            return default_state
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE load_player(%s);", (user_id,))
+                result = cur.fetchone()
 
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Database error loading data for {user_id}: {e}", exc_info=True)
-        conn.rollback()
-        # Fallback strategy: return default state without saving
-        return default_state
-    except Exception as e:
-         logger.error(f"Unexpected error loading data for {user_id}: {e}", exc_info=True)
-         return default_state # General fallback
+            if result:
+                logger.debug(f"Found existing player data for {user_id}.")
+                return _player_from_row(user_id, result)
+            else:
+                logger.info(f"No player data found for {user_id}. Inserting default state.")
+                default_state["collection_count"] = 0 # Ensure default includes it
+                # Insert now so the row exists for SQL readers, on this connection rather than a second one
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "EXECUTE save_player(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
+                        _save_player_params(user_id, normalize_player_data(default_state))
+                    )
+                conn.commit()
+                return default_state
 
-def save_player_data(user_id: int, data: dict) -> None:
-    """Saves player data to the database using INSERT ON CONFLICT (upsert)."""
-    logger.debug(f"Attempting to save data for user {user_id} to database.")
-    conn = get_db_connection()
-    if not conn:
-        logger.error(f"Cannot save data for {user_id}, no database connection.")
-        return
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error loading data for {user_id}: {e}", exc_info=True)
+            conn.rollback()
+            return None
+        except Exception as e:
+             logger.error(f"Unexpected error loading data for {user_id}: {e}", exc_info=True)
+             return None
+
+def _ensure_challenge_slots(player_data: dict) -> None:
+    """Gives active_challenges/challenge_progress an entry per timescale, so readers can index them directly
+       (rows written by the batch jobs may only have the timescale that was regenerated)."""
+    for timescale in CHALLENGE_TIMESCALES:
+        player_data["active_challenges"].setdefault(timescale, None)
+        player_data["challenge_progress"].setdefault(timescale, {})
+
+def _player_from_row(user_id: int, row: tuple) -> dict:
+    """Builds the player dict from a row in load_player column order."""
+    player_data = {
+        "user_id": user_id,
+        "display_name": row[0],
+        "franchise_name": row[1],
+        "cash": float(row[2]),
+        "pizza_coins": row[3],
+        "shops": row[4] if row[4] is not None else {},
+        "unlocked_achievements": row[5] if row[5] is not None else [],
+        "current_title": row[6],
+        "active_challenges": row[7] if row[7] is not None else {'daily': None, 'weekly': None},
+        "challenge_progress": row[8] if row[8] is not None else {'daily': {}, 'weekly': {}},
+        "stats": {**_DEFAULT_STATS, **(row[9] or {})},
+        "total_income_earned": float(row[10]),
+        "last_login_time": row[11].timestamp() if row[11] else time.time(),
+        "collection_count": row[12] or 0,
+        "last_sabotage_attempt_time": row[13].timestamp() if row[13] else 0.0,
+        "last_summary_seen_version": row[14]
+    }
+    # --- Migration / Defaulting for shop names --- #
+    if player_data["shops"]:
+        for loc, shop_data in player_data["shops"].items():
+            shop_data.setdefault("custom_name", loc) # Default name to location if missing
+            # Ensure level and time exist too for consistency
+            shop_data.setdefault("level", 1)
+            shop_data.setdefault("last_collected_time", time.time())
+            shop_data.setdefault("shutdown_until", None) # <<< Add default
+    # --- End Migration --- #
+    _ensure_challenge_slots(player_data)
+    player_data["challenge_by_metric"] = index_challenges_by_metric(player_data["active_challenges"])
+    player_data["achievements_mask"] = achievements_mask(player_data["unlocked_achievements"])
+    return player_data
+
+def touch_login(user_id: int, now: float | None = None, display_name: str | None = None) -> tuple[dict, bool]:
+    """Stamps last_login_time (and display_name, if given) and returns (player, is_new),
+       inserting the default state with fresh challenges if missing (one round trip)."""
+    now = time.time() if now is None else now
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        if entry and (entry[1] or time.monotonic() - entry[2] < PLAYER_CACHE_TTL_SECONDS):
+            if now - entry[0].get("last_login_time", 0.0) >= LOGIN_TIME_RESOLUTION_SECONDS:
+                entry[0]["last_login_time"] = now
+                entry[1] = True # Volatile field, goes out with the periodic flush
+            if display_name and entry[0].get("display_name") != display_name:
+                entry[0]["display_name"] = display_name
+                entry[1] = True
+                _schedule_flush() # Durable field: don't leave it for the periodic flush
+            PLAYER_CACHE.move_to_end(user_id)
+            return _clone_player(entry[0]), False
+        generation = _rewrite_generation
+
+    default_state = get_default_player_state(user_id)
+    default_state["last_login_time"] = now
+    default_state["display_name"] = display_name # None keeps the stored name
+    # If this turns out to be an insert, the new player starts with challenges already in the row
+    for timescale in CHALLENGE_TIMESCALES:
+        assign_new_challenge(default_state, timescale)
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "EXECUTE touch_login(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
+                    _save_player_params(user_id, normalize_player_data(default_state))
+                )
+                result = cur.fetchone()
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error touching login for {user_id}: {e}", exc_info=True)
+            conn.rollback()
+            return default_state, False # Same fallback as load_player_data: default state, not cached
+
+    is_new = result[15] # (xmax = 0): the upsert inserted rather than updated
+    if is_new:
+        logger.info(f"Inserted default state for new player {user_id}.")
+    return _cache_loaded_player(user_id, _player_from_row(user_id, result), generation), is_new
+
+def record_activity(user_id: int, now: float | None = None) -> None:
+    """Stamps last_login_time for any interaction, so the challenge jobs' active-player filter sees players
+       who never type /start. Cached players are stamped in memory; others get a direct UPDATE (no insert)."""
+    now = time.time() if now is None else now
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        if entry and (entry[1] or time.monotonic() - entry[2] < PLAYER_CACHE_TTL_SECONDS):
+            if now - entry[0].get("last_login_time", 0.0) >= LOGIN_TIME_RESOLUTION_SECONDS:
+                entry[0]["last_login_time"] = now
+                entry[1] = True # Volatile field, goes out with the periodic flush
+            return
+        if now - _activity_db_stamps.get(user_id, 0.0) < ACTIVITY_DB_STAMP_SECONDS:
+            return
+        _activity_db_stamps[user_id] = now
+        _activity_db_stamps.move_to_end(user_id)
+        # Expired stamps no longer throttle anything; drop them from the old end so the dict stays bounded
+        while now - next(iter(_activity_db_stamps.values())) >= ACTIVITY_DB_STAMP_SECONDS:
+            _activity_db_stamps.popitem(last=False)
+
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE record_activity(%s, %s);", (user_id, now))
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error recording activity for {user_id}: {e}", exc_info=True)
+            conn.rollback()
+            return
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        if entry and entry[0].get("last_login_time", 0.0) < now:
+            entry[0]["last_login_time"] = now # A copy cached meanwhile may predate the UPDATE
 
+def save_player_data(user_id: int, data: dict) -> None:
+    """Saves player data to the cache and schedules a write-behind flush to the database."""
+    data = normalize_player_data(data)
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        urgent = entry is None or _durable_fields_changed(entry[0], data)
+        _cache_player(user_id, data, dirty=True)
+        if urgent:
+            _schedule_flush() # Money/shops/etc. go out within PLAYER_FLUSH_DELAY_SECONDS
+
+def normalize_player_data(data: dict) -> dict:
+    """Returns data with every column the save statement needs filled in."""
     # Ensure necessary top-level keys exist with defaults before saving
-    data.setdefault("cash", 0.0)
-    data.setdefault("pizza_coins", 0)
-    data.setdefault("shops", {})
-    data.setdefault("unlocked_achievements", [])
-    data.setdefault("current_title", None)
-    data.setdefault("active_challenges", {'daily': None, 'weekly': None})
-    data.setdefault("challenge_progress", {'daily': {}, 'weekly': {}})
-    data.setdefault("stats", {})
-    data.setdefault("total_income_earned", 0.0)
+    data = {**_DEFAULT_PLAYER, **data}
     data.setdefault("last_login_time", time.time()) # Use current time if missing
-    data.setdefault("collection_count", 0) # Ensure collection_count key exists
-    data.setdefault("franchise_name", None) # Ensure key exists
-    data.setdefault("last_sabotage_attempt_time", 0.0) # <<< Added default
-    data.setdefault("last_summary_seen_version", None) # <<< Added default
 
     # Ensure default sub-dicts/lists for JSONB compatibility
     data["shops"] = data.get("shops") or {}
     data["unlocked_achievements"] = data.get("unlocked_achievements") or []
     data["active_challenges"] = data.get("active_challenges") or {'daily': None, 'weekly': None}
     data["challenge_progress"] = data.get("challenge_progress") or {'daily': {}, 'weekly': {}}
-    data["stats"] = data.get("stats") or {}
-    data['stats'].setdefault('session_income', 0)
-    data['stats'].setdefault('session_upgrades', 0)
-    data['stats'].setdefault('session_collects', 0)
-    data['stats'].setdefault('session_expansions', 0)
+    data["stats"] = {**_DEFAULT_STATS, **(data.get("stats") or {})}
+    _ensure_challenge_slots(data)
 
     # Ensure shop sub-dictionaries have default names
     if data["shops"]:
@@ -307,89 +738,58 @@ def save_player_data(user_id: int, data: dict) -> None:
             shop_data.setdefault("level", 1)
             shop_data.setdefault("last_collected_time", time.time())
             shop_data.setdefault("shutdown_until", None) # <<< Add default
-
-    sql = """
-    INSERT INTO players (
-        user_id, display_name, franchise_name, cash, pizza_coins, shops, unlocked_achievements, current_title,
-        active_challenges, challenge_progress, stats, total_income_earned, last_login_time,
-        collection_count, last_sabotage_attempt_time, last_summary_seen_version
+    return data
+
+def _save_player_params(user_id: int, data: dict) -> tuple:
+    """Builds the save_player statement parameters from normalized player data."""
+    # Convert complex types to JSON strings for psycopg2 if needed,
+    # though register_default_jsonb should handle dicts/lists directly.
+    return (
+        user_id,
+        data["display_name"],
+        data["franchise_name"],
+        data["cash"],
+        data["pizza_coins"],
+        _json_dumps(data["shops"]),
+        data["unlocked_achievements"], # Keep as list for TEXT[]
+        data["current_title"],
+        _json_dumps(data["active_challenges"]),
+        _json_dumps(data["challenge_progress"]),
+        _json_dumps(data["stats"]),
+        data["total_income_earned"],
+        data["last_login_time"],
+        data["collection_count"],
+        data["last_sabotage_attempt_time"],
+        data["last_summary_seen_version"]
     )
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, to_timestamp(%s), %s, to_timestamp(%s), %s)
-    ON CONFLICT (user_id) DO UPDATE SET
-        display_name = EXCLUDED.display_name,
-        franchise_name = EXCLUDED.franchise_name,
-        cash = EXCLUDED.cash,
-        pizza_coins = EXCLUDED.pizza_coins,
-        shops = EXCLUDED.shops,
-        unlocked_achievements = EXCLUDED.unlocked_achievements,
-        current_title = EXCLUDED.current_title,
-        active_challenges = EXCLUDED.active_challenges,
-        challenge_progress = EXCLUDED.challenge_progress,
-        stats = EXCLUDED.stats,
-        total_income_earned = EXCLUDED.total_income_earned,
-        last_login_time = EXCLUDED.last_login_time,
-        collection_count = EXCLUDED.collection_count,
-        last_sabotage_attempt_time = EXCLUDED.last_sabotage_attempt_time,
-        last_summary_seen_version = EXCLUDED.last_summary_seen_version;
-    """
-    try:
-        # Convert complex types to JSON strings for psycopg2 if needed,
-        # though register_default_jsonb should handle dicts/lists directly.
-        shops_json = json.dumps(data["shops"])
-        achievements_list = data["unlocked_achievements"] # Keep as list for TEXT[]
-        active_challenges_json = json.dumps(data["active_challenges"])
-        challenge_progress_json = json.dumps(data["challenge_progress"])
-        stats_json = json.dumps(data["stats"])
-
-        with conn.cursor() as cur:
-            cur.execute(sql, (
-                user_id,
-                data["display_name"],
-                data["franchise_name"],
-                data["cash"],
-                data["pizza_coins"],
-                shops_json,
-                achievements_list,
-                data["current_title"],
-                active_challenges_json,
-                challenge_progress_json,
-                stats_json,
-                data["total_income_earned"],
-                data["last_login_time"],
-                data["collection_count"],
-                data["last_sabotage_attempt_time"],
-                data["last_summary_seen_version"]
-            ))
-        conn.commit()
-        logger.debug(f"Successfully saved data for user {user_id}.")
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Database error saving data for {user_id}: {e}", exc_info=True)
-        conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error saving data for {user_id}: {e}", exc_info=True)
-        # Attempt rollback just in case
+
+def _write_player_params_to_db(items: list[tuple[int, tuple]]) -> bool:
+    """Runs save_player for each (user_id, params) in one transaction. Returns success."""
+    user_ids = [user_id for user_id, _ in items]
+    logger.debug(f"Attempting to save data for users {user_ids} to database.")
+
+    with db_conn() as conn:
         try:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_batch(
+                    cur,
+                    "EXECUTE save_player(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
+                    [params for _, params in items]
+                )
+            conn.commit()
+            logger.debug(f"Successfully saved data for users {user_ids}.")
+            return True
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error saving data for {user_ids}: {e}", exc_info=True)
             conn.rollback()
-        except psycopg2.InterfaceError: # If connection already closed
-             pass
-
-def get_all_user_ids() -> list[int]:
-    """Fetches all user IDs from the players table."""
-    logger.debug("Fetching all user IDs from database.")
-    conn = get_db_connection()
-    if not conn: return []
-    results = []
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_id FROM players;")
-            results = [row[0] for row in cur.fetchall()]
-        logger.debug(f"Fetched {len(results)} user IDs.")
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Database error fetching all user IDs: {e}", exc_info=True)
-        conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error fetching all user IDs: {e}", exc_info=True)
-    return results
+        except Exception as e:
+            logger.error(f"Unexpected error saving data for {user_ids}: {e}", exc_info=True)
+            # Attempt rollback just in case
+            try:
+                conn.rollback()
+            except psycopg2.InterfaceError: # If connection already closed
+                 pass
+    return False
 
 def get_default_player_state(user_id: int) -> dict:
     """Returns the initial state dictionary for a new player."""
@@ -409,13 +809,12 @@ def get_default_player_state(user_id: int) -> dict:
             }
         },
         "unlocked_achievements": [],
+        "achievements_mask": 0,
         "current_title": None,
         "active_challenges": {'daily': None, 'weekly': None},
+        "challenge_by_metric": {},
         "challenge_progress": {'daily': {}, 'weekly': {}},
-        "stats": {
-            'session_income': 0, 'session_upgrades': 0,
-            'session_collects': 0, 'session_expansions': 0
-        },
+        "stats": dict(_DEFAULT_STATS),
         "total_income_earned": 0.0,
         "last_login_time": time.time(),
         "collection_count": 0,
@@ -424,33 +823,31 @@ def get_default_player_state(user_id: int) -> dict:
     }
 
 # --- Income Calculation (Uses GDP Factor) ---
-def calculate_income_rate(shops: dict) -> float:
-    total_rate = 0.0
-    for name, shop_data in shops.items():
-        level = shop_data.get("level", 1)
-        # Use get_shop_income_rate which now includes GDP factor
-        shop_rate = get_shop_income_rate(name, level)
-        total_rate += shop_rate
-    return total_rate
-
-def get_shop_income_rate(shop_name: str, level: int) -> float:
-    """Calculates the income rate, including base GDP and current performance."""
-    base_gdp_factor = 1.0
-    if shop_name != INITIAL_SHOP_NAME and shop_name in EXPANSION_LOCATIONS:
-        if len(EXPANSION_LOCATIONS[shop_name]) > 2:
-             base_gdp_factor = EXPANSION_LOCATIONS[shop_name][2]
-        else:
-             logger.warning(f"Missing GDP factor for expansion {shop_name}, using 1.0")
+def calculate_income_rate(shops: dict, performance: dict[str, float] | None = None) -> float:
+    """Total income per second across shops. Pass performance to reuse an already fetched multiplier map."""
+    if performance is None:
+        performance = get_performance_multipliers(shops)
+    # Same formula as get_shop_income_rate, with every multiplier from one lookup
+    return BASE_INCOME_PER_SECOND * sum(
+        shop_data.get("level", 1) * _INCOME_MULT.get(name, 1.0) * performance.get(name, 1.0)
+        for name, shop_data in shops.items()
+    )
 
-    current_performance = get_current_performance_multiplier(shop_name)
+def get_shop_income_rate(shop_name: str, level: int, current_performance: float | None = None) -> float:
+    """Calculates the income rate, including base GDP and current performance (fetched if not given)."""
+    base_gdp_factor = _INCOME_MULT.get(shop_name, 1.0)
+    if current_performance is None:
+        current_performance = get_current_performance_multiplier(shop_name)
     # Combine base potential with current market fluctuation
     effective_rate = (BASE_INCOME_PER_SECOND * level * base_gdp_factor) * current_performance
     return effective_rate
 
-def calculate_uncollected_income(player_data: dict) -> float:
+def calculate_uncollected_income(player_data: dict, performance: dict[str, float] | None = None) -> float:
     current_time = time.time()
     total_uncollected = 0.0
     shops = player_data.get("shops", {})
+    if performance is None:
+        performance = get_performance_multipliers(shops)
     for name, shop_data in shops.items():
         level = shop_data.get("level", 1)
         last_collected = shop_data.get("last_collected_time", current_time)
@@ -473,19 +870,19 @@ def calculate_uncollected_income(player_data: dict) -> float:
         active_duration = max(0, effective_end_time - effective_start_time)
 
         if active_duration > 0:
-            shop_rate = get_shop_income_rate(name, level)
+            shop_rate = BASE_INCOME_PER_SECOND * level * _INCOME_MULT.get(name, 1.0) * performance.get(name, 1.0)
             total_uncollected += shop_rate * active_duration
         # else: logger.debug(f"Shop {name} generated 0 income (active_duration: {active_duration})")
 
     return total_uncollected
 
-def collect_income(user_id: int) -> tuple[float, list[str], bool, float | None]:
-    """Collects income, increments count, checks for Mafia.
-       Returns (collected_amount, completed_challenges, is_mafia_event, mafia_demand_or_None)."""
+def collect_income(user_id: int) -> tuple[float, list[str], bool, float | None, list[tuple[str, str, str | None]], float]:
+    """Collects income, increments count, checks for Mafia, tips and achievements.
+       Returns (collected_amount, completed_challenges, is_mafia_event, mafia_demand_or_None, newly_unlocked_achievements, tip_amount)."""
     player_data = load_player_data(user_id)
     if not player_data:
         logger.error(f"Failed to load player data for collect_income, user {user_id}")
-        return 0.0, [], False, None
+        return 0.0, [], False, None, [], 0.0
 
     uncollected = calculate_uncollected_income(player_data)
     completed_challenges = []
@@ -514,11 +911,11 @@ def collect_income(user_id: int) -> tuple[float, list[str], bool, float | None]:
         # --- Check for Mafia Event --- #
         if collection_count > 0 and collection_count % 5 == 0:
             is_mafia_event = True
-            demand_percentage = random.uniform(0.10, 0.75)
+            demand_percentage = _rng.uniform(*MAFIA_DEMAND_RANGE)
             mafia_demand = round(uncollected * demand_percentage, 2)
             logger.info(f"Mafia event triggered for user {user_id}! Demand: ${mafia_demand:.2f} ({demand_percentage*100:.1f}%)")
             # Return amount calculated from OLD time, but timestamps/count are already saved
-            return uncollected, [], is_mafia_event, mafia_demand
+            return uncollected, [], is_mafia_event, mafia_demand, [], 0.0
         else:
             # --- Normal Collection --- #
             # Timestamps and count already saved, now just add cash/stats
@@ -528,65 +925,77 @@ def collect_income(user_id: int) -> tuple[float, list[str], bool, float | None]:
             player_data["stats"]["session_collects"] = player_data["stats"].get("session_collects", 0) + 1
 
             completed_challenges = update_challenge_progress(player_data, ["session_income", "session_collects"])
-            save_player_data(user_id, player_data) # Save cash/stats update
-            return uncollected, completed_challenges, is_mafia_event, mafia_demand
+            newly_unlocked, player_data = check_achievements(player_data, COLLECT_ACHIEVEMENT_METRICS)
+            # Tip goes in with the same save; like before, it isn't counted as earned income
+            tip_amount = 0.0
+            if _rng.random() < TIP_CHANCE:
+                tip_amount = round(_rng.uniform(*(uncollected * f for f in TIP_COLLECTION_FRACTION_RANGE)) + _rng.uniform(*TIP_FLAT_RANGE), 2)
+                player_data["cash"] += tip_amount
+                logger.debug(f"User {user_id} received a tip of ${tip_amount:.2f}")
+            save_player_data(user_id, player_data) # Save cash/stats/achievement update
+            return uncollected, completed_challenges, is_mafia_event, mafia_demand, newly_unlocked, tip_amount
     else:
         # Nothing to collect, still return structure
-        return 0.0, [], False, None
+        return 0.0, [], False, None, [], 0.0
 
 # --- Upgrade & Expansion Logic (Modified for failure chance) ---
 
+# Expansion costs are fixed per location, so compute them once
+_EXPANSION_COST = {name: round(BASE_EXPANSION_COST * _COST_SCALE[name], 2) for name in EXPANSION_LOCATIONS}
+_EXPANSION_COST_TEXT = {name: format_money(cost) for name, cost in _EXPANSION_COST.items()}
+
 def get_expansion_cost(shop_name: str) -> float:
     """Calculates the cost to expand to a new location."""
-    base_cost = BASE_EXPANSION_COST
-    cost_scale = 1.0 # Default if not found (shouldn't happen)
-    if shop_name in EXPANSION_LOCATIONS:
-        # Cost Scale Factor is the 4th element (index 3)
-        if len(EXPANSION_LOCATIONS[shop_name]) > 3:
-             cost_scale = EXPANSION_LOCATIONS[shop_name][3]
-        else:
-             logger.warning(f"Missing cost scale factor for expansion {shop_name} in cost calculation, using 1.0")
-    else:
+    cost = _EXPANSION_COST.get(shop_name)
+    if cost is None:
          logger.warning(f"Shop name {shop_name} not found in EXPANSION_LOCATIONS for cost calculation.")
+         cost = round(BASE_EXPANSION_COST * _COST_SCALE.get(shop_name, 1.0), 2) # Default scale if not found (shouldn't happen)
+    return cost
 
-    return round(base_cost * cost_scale, 2)
+def get_expansion_meta_bulk(locations: Iterable[str]) -> dict[str, tuple[float, float]]:
+    """(cost, current performance multiplier) for each location, with one multiplier lookup for all of them."""
+    locations = tuple(locations)
+    performance = get_performance_multipliers(locations)
+    return {loc: (get_expansion_cost(loc), performance[loc]) for loc in locations}
 
 def get_upgrade_cost(current_level: int, shop_name: str) -> float:
     """Calculates the cost to upgrade to the next level, considering location."""
+    exponent = current_level - 1
+    cost_table = _UPGRADE_COST_TABLE.get(shop_name)
+    if cost_table is not None and 0 <= exponent < _POW_TABLE_SIZE:
+        return cost_table[exponent]
+
+    # Unknown location or out-of-table level: compute it directly
     base_location_cost = BASE_UPGRADE_COST
 
     # Get location cost scale factor (default to 1.0 for Brooklyn/initial)
-    location_cost_scale = 1.0
-    if shop_name != INITIAL_SHOP_NAME and shop_name in EXPANSION_LOCATIONS:
-        # Ensure the tuple has the 4th element (cost scale)
-        if len(EXPANSION_LOCATIONS[shop_name]) > 3:
-             location_cost_scale = EXPANSION_LOCATIONS[shop_name][3]
-        else:
-             logger.warning(f"Missing cost scale factor for expansion {shop_name}, using 1.0")
+    location_cost_scale = _COST_SCALE.get(shop_name, 1.0)
 
     # Apply location scaling and level multiplier
-    level_cost = (base_location_cost * location_cost_scale) * (UPGRADE_COST_MULTIPLIER ** (current_level - 1))
+    level_multiplier = _POW_TABLE[exponent] if 0 <= exponent < _POW_TABLE_SIZE else UPGRADE_COST_MULTIPLIER ** exponent
+    level_cost = (base_location_cost * location_cost_scale) * level_multiplier
     return round(level_cost, 2) # Round to 2 decimal places
 
-def upgrade_shop(user_id: int, shop_name: str) -> tuple[bool, str, list[str]]:
+def upgrade_shop(user_id: int, shop_name: str) -> tuple[bool, dict, list[str], list[tuple[str, str, str | None]]]:
     """Attempts to upgrade a shop with a chance of failure.
-       Returns (success, message_or_data, completed_challenge_messages)."""
+       Returns (success, outcome, completed_challenge_messages, newly_unlocked_achievements), where outcome holds
+       "new_level" on success, "cost_lost" when the attempt failed after paying, or "error" if it couldn't be tried."""
     player_data = load_player_data(user_id)
     if not player_data:
-        return False, "Failed to load player data.", []
+        return False, {"error": "Failed to load player data."}, [], []
 
     shops = player_data.get("shops", {})
     completed_challenges = []
 
     if shop_name not in shops:
-        return False, f"You don't own a shop in {shop_name}!", []
+        return False, {"error": f"You don't own a shop in {shop_name}!"}, [], []
 
     current_level = shops[shop_name].get("level", 1)
     cost = get_upgrade_cost(current_level, shop_name)
     cash = player_data.get("cash", 0)
 
     if cash < cost:
-        return False, f"Not enough cash! Need ${cost:,.2f} to upgrade {shop_name} to level {current_level + 1}. You have ${cash:,.2f}.", []
+        return False, {"error": f"Not enough cash! Need ${cost:,.2f} to upgrade {shop_name} to level {current_level + 1}. You have ${cash:,.2f}."}, [], []
 
     # --- Upgrade Attempt: Deduct cost first --- #
     player_data["cash"] = cash - cost
@@ -598,7 +1007,7 @@ def upgrade_shop(user_id: int, shop_name: str) -> tuple[bool, str, list[str]]:
         # Save the data with deducted cash, but no level increase or stats update
         save_player_data(user_id, player_data)
         # Return False and the cost (so main.py can mention it in the failure message)
-        return False, f"Oh no! The upgrade failed! You lost ${cost:,.2f} in the attempt!", [] # Specific message format
+        return False, {"cost_lost": cost}, [], []
     else:
         # --- Success --- #
         logger.info(f"Upgrade SUCCEEDED for user {user_id} on {shop_name} Lvl {current_level}.")
@@ -609,17 +1018,29 @@ def upgrade_shop(user_id: int, shop_name: str) -> tuple[bool, str, list[str]]:
 
         # Check challenges after successful upgrade
         completed_challenges = update_challenge_progress(player_data, ["session_upgrades"])
+        newly_unlocked, player_data = check_achievements(player_data, UPGRADE_ACHIEVEMENT_METRICS)
 
         save_player_data(user_id, player_data)
 
-        # Return True and the new level as a string
-        return True, str(new_level), completed_challenges
+        return True, {"new_level": new_level}, completed_challenges, newly_unlocked
+
+# Sorted total_income requirements: eligibility only changes when total income crosses one of them
+_INCOME_THRESHOLDS = tuple(sorted({req_data[1] for req_data in EXPANSION_LOCATIONS.values() if req_data[0] == "total_income"}))
+
+def get_available_expansions(player_data: dict) -> tuple[str, ...]:
+    """Locations the player meets the requirements for and doesn't own yet.
+       Memoized on the owned shop levels and which income thresholds have been reached."""
+    shop_levels = frozenset((name, data.get("level", 1)) for name, data in player_data.get("shops", {}).items())
+    income_bracket = bisect.bisect_right(_INCOME_THRESHOLDS, player_data.get("total_income_earned", 0))
+    return _available_expansions(shop_levels, income_bracket)
 
-def get_available_expansions(player_data: dict) -> list[str]:
+@functools.lru_cache(maxsize=4096)
+def _available_expansions(shop_levels: frozenset, income_bracket: int) -> tuple[str, ...]:
     available = []
-    owned_shops = player_data.get("shops", {})
-    initial_shop_level = owned_shops.get(INITIAL_SHOP_NAME, {}).get("level", 1)
-    total_income = player_data.get("total_income_earned", 0)
+    owned_shops = dict(shop_levels) # location -> level
+    initial_shop_level = owned_shops.get(INITIAL_SHOP_NAME, 1)
+    # Any income in the bracket compares the same against every threshold
+    total_income = _INCOME_THRESHOLDS[income_bracket - 1] if income_bracket else float("-inf")
 
     for name, req_data in EXPANSION_LOCATIONS.items():
         if name in owned_shops:
@@ -638,7 +1059,7 @@ def get_available_expansions(player_data: dict) -> list[str]:
         elif req_type == "shop_level": # New: Requirement on a specific OTHER shop's level
             required_shop_name = req_value # In this case, req_value is the shop name
             required_level = req_data[2]   # The actual level needed is now 3rd element
-            current_shop_level = owned_shops.get(required_shop_name, {}).get("level", 0)
+            current_shop_level = owned_shops.get(required_shop_name, 0)
             if current_shop_level >= required_level:
                 met_requirement = True
         elif req_type == "total_income":
@@ -654,21 +1075,22 @@ def get_available_expansions(player_data: dict) -> list[str]:
 
         if met_requirement:
             available.append(name)
-    return available
+    return tuple(available)
 
-def expand_shop(user_id: int, expansion_name: str) -> tuple[bool, str, list[str]]:
-    """Attempts to establish a new shop, checking and deducting cost."""
+def expand_shop(user_id: int, expansion_name: str) -> tuple[bool, str, list[str], list[tuple[str, str, str | None]]]:
+    """Attempts to establish a new shop, checking and deducting cost.
+       Returns (success, message, completed_challenge_messages, newly_unlocked_achievements)."""
     player_data = load_player_data(user_id)
-    if not player_data: return False, "Failed to load player data.", []
+    if not player_data: return False, "Failed to load player data.", [], []
 
     available_expansions = get_available_expansions(player_data)
     completed_challenges = []
 
     if expansion_name not in EXPANSION_LOCATIONS:
-         return False, f"{expansion_name} is not a valid expansion location.", []
+         return False, f"{expansion_name} is not a valid expansion location.", [], []
 
     if expansion_name in player_data["shops"]:
-        return False, f"You already have a shop in {expansion_name}!", []
+        return False, f"You already have a shop in {expansion_name}!", [], []
 
     if expansion_name not in available_expansions:
         req_data = EXPANSION_LOCATIONS[expansion_name]
@@ -683,14 +1105,14 @@ def expand_shop(user_id: int, expansion_name: str) -> tuple[bool, str, list[str]
         elif req_type == "shops_count": req_msg = f"Requires {req_value} total shops (you have {len(player_data.get('shops', {}))})."
         elif req_type == "has_shop": req_msg = f"Requires owning a shop in {req_value}."
 
-        return False, f"Can't expand to {expansion_name} yet. {req_msg}", []
+        return False, f"Can't expand to {expansion_name} yet. {req_msg}", [], []
 
     # --- Expansion Cost Check --- #
     expansion_cost = get_expansion_cost(expansion_name)
     current_cash = player_data.get("cash", 0)
 
     if current_cash < expansion_cost:
-        return False, f"Not enough cash to expand to {expansion_name}! Need ${expansion_cost:,.2f}, you have ${current_cash:,.2f}.", []
+        return False, f"Not enough cash to expand to {expansion_name}! Need ${expansion_cost:,.2f}, you have ${current_cash:,.2f}.", [], []
     # --- End Cost Check --- #
 
     # Deduct cost, add shop, update stats
@@ -705,11 +1127,12 @@ def expand_shop(user_id: int, expansion_name: str) -> tuple[bool, str, list[str]
     player_data["stats"]["session_expansions"] = player_data["stats"].get("session_expansions", 0) + 1
 
     completed_challenges = update_challenge_progress(player_data, ["session_expansions"])
+    newly_unlocked, player_data = check_achievements(player_data, EXPAND_ACHIEVEMENT_METRICS)
     save_player_data(user_id, player_data)
 
     # Return success message (main.py handles cheeky message)
     msg = f"Expansion to {expansion_name} successful! Cost: ${expansion_cost:,.2f}"
-    return True, msg, completed_challenges
+    return True, msg, completed_challenges, newly_unlocked
 
 # --- Achievement Logic ---
 
@@ -732,93 +1155,270 @@ def get_achievement_value(player_data: dict, metric_args: tuple) -> float | int:
     else:
         return 0
 
-def check_achievements(user_id: int) -> list[tuple[str, str, str | None]]:
-    """Checks for unlocked achievements and returns (name, description, title) for newly unlocked ones."""
-    player_data = load_player_data(user_id)
+def achievements_mask(unlocked_achievements: Iterable[str]) -> int:
+    """Bitmask of the unlocked achievement ids (unknown ids are ignored)."""
+    mask = 0
+    for achievement_id in unlocked_achievements:
+        mask |= _ACH_BIT.get(achievement_id, 0)
+    return mask
+
+def check_achievements(player_data: dict, triggered_metrics: Iterable[str] | None = None) -> tuple[list[tuple[str, str, str | None]], dict]:
+    """Checks the in-memory player_data for unlocked achievements. Does not save; the caller persists.
+       Only achievements tracking one of triggered_metrics are evaluated (all of them if None).
+       Returns ((name, description, title) for newly unlocked ones, possibly-updated player_data)."""
     unlocked_achievements = player_data.get("unlocked_achievements", [])
+    mask = player_data.get("achievements_mask")
+    if mask is None:
+        mask = achievements_mask(unlocked_achievements)
+    metrics = _ACH_BY_METRIC.keys() if triggered_metrics is None else triggered_metrics
+    candidates = ALL_ACHIEVEMENTS_MASK if triggered_metrics is None else sum(_ACH_METRIC_MASK.get(m, 0) for m in set(metrics))
+    if not candidates & ~mask:
+        player_data["achievements_mask"] = mask
+        return [], player_data # Everything these metrics could unlock is already unlocked
+
+    user_id = player_data.get("user_id")
     newly_unlocked = []
     highest_new_title = None
-
-    for achievement_id, (name, desc, metric_args, req, _, _, title) in ACHIEVEMENTS.items():
-        if achievement_id not in unlocked_achievements:
-            current_value = get_achievement_value(player_data, metric_args)
-            if current_value >= req:
-                logger.info(f"User {user_id} unlocked achievement: {achievement_id} ({name})")
-                unlocked_achievements.append(achievement_id)
-                newly_unlocked.append((name, desc, title))
-                if title:
-                    # Simple logic: last unlocked title is equipped? Or choose based on rank?
-                    highest_new_title = title # For now, just take the latest one
-
+    for metric in metrics:
+        for achievement_id, (name, desc, metric_args, req, _, _, title) in _ACH_BY_METRIC.get(metric, ()):
+            if not mask & _ACH_BIT[achievement_id]:
+                current_value = get_achievement_value(player_data, metric_args)
+                if current_value >= req:
+                    logger.info(f"User {user_id} unlocked achievement: {achievement_id} ({name})")
+                    unlocked_achievements.append(achievement_id)
+                    mask |= _ACH_BIT[achievement_id]
+                    newly_unlocked.append((name, desc, title))
+                    if title:
+                        # Simple logic: last unlocked title is equipped? Or choose based on rank?
+                        highest_new_title = title # For now, just take the latest one
+
+    player_data["achievements_mask"] = mask
     if newly_unlocked:
         player_data["unlocked_achievements"] = unlocked_achievements
         if highest_new_title:
              player_data["current_title"] = highest_new_title
              logger.info(f"User {user_id} equipped title: {highest_new_title}")
-        save_player_data(user_id, player_data)
 
-    return newly_unlocked
+    return newly_unlocked, player_data
 
 # --- Challenge Logic ---
 
-def generate_new_challenges(user_id: int, timescale: str):
-    """Generates new daily or weekly challenges for the player."""
+ACTIVE_PLAYER_WINDOW_DAYS = 14 # Scheduled challenge jobs skip players who haven't used the bot for this long (last_login_time)
+
+_CHALLENGE_TYPE_IDS = tuple(CHALLENGE_TYPES)
+
+def _build_challenge(player_level: int, timescale: str) -> dict:
+    """Picks a random challenge type and scales its goal/reward to player_level."""
+    # Choose a random challenge type
+    challenge_type_id = random.choice(_CHALLENGE_TYPE_IDS)
+    desc_template, metric, _, base_goal, goal_mult, reward_type, base_reward, reward_mult = CHALLENGE_TYPES[challenge_type_id]
+
+    # Scale goal and reward based on player level (simple example)
+    goal = int(base_goal * (goal_mult ** player_level))
+    reward_value = int(base_reward * (reward_mult ** player_level))
+
+    # Prevent excessively easy goals
+    if "cash" in metric and goal < 100: goal = 100
+    if "upgrade" in metric and goal < 1: goal = 1
+    if "collect" in metric and goal < 2: goal = 2
+
+    now = time.time()
+    return {
+        "id": f"{timescale}_{challenge_type_id}_{int(now)}", # Unique ID
+        "type": challenge_type_id,
+        "description": desc_template.format(goal=goal, timescale=timescale),
+        "metric": metric,
+        "goal": goal,
+        "reward_type": reward_type,
+        "reward_value": reward_value,
+        "start_time": now,
+        "timescale": timescale
+    }
+
+def assign_new_challenge(player_data: dict, timescale: str) -> dict:
+    """Puts a new timescale challenge on player_data in memory, resetting its progress and the tracked stats.
+       Returns the challenge; nothing is saved."""
+    player_level = len(player_data.get("unlocked_achievements", [])) # Use achievement count as proxy for level
+    challenge_data = _build_challenge(player_level, timescale)
+    player_data["active_challenges"][timescale] = challenge_data
+    player_data["challenge_by_metric"] = index_challenges_by_metric(player_data["active_challenges"])
+    player_data["challenge_progress"][timescale] = {} # Reset progress for this timescale
+    player_data["stats"] = {k: 0 for k in player_data["stats"]} # Reset tracked stats
+    return challenge_data
+
+def generate_new_challenges(user_id: int, timescale: str, player_data: dict | None = None, save: bool = True) -> dict | None:
+    """Generates new daily or weekly challenges for the player.
+       Works on player_data when given (loading it otherwise) and returns the updated data, or None on failure.
+       With save=False the caller is responsible for saving it."""
     logger.info(f"Attempting to generate {timescale} challenge for user {user_id}.")
     try:
-        player_data = load_player_data(user_id)
-        player_level = len(player_data.get("unlocked_achievements", [])) # Use achievement count as proxy for level
-        logger.debug(f"Player {user_id} level (based on achievements): {player_level}")
-
-        # Choose a random challenge type
-        challenge_type_id = random.choice(list(CHALLENGE_TYPES.keys()))
-        logger.debug(f"Selected challenge type for {user_id} ({timescale}): {challenge_type_id}")
-        desc_template, metric, _, base_goal, goal_mult, reward_type, base_reward, reward_mult = CHALLENGE_TYPES[challenge_type_id]
-
-        # Scale goal and reward based on player level (simple example)
-        goal = int(base_goal * (goal_mult ** player_level))
-        reward_value = int(base_reward * (reward_mult ** player_level))
-        logger.debug(f"Calculated goal: {goal}, reward: {reward_value} for {user_id} ({timescale})")
-
-        # Prevent excessively easy goals
-        if "cash" in metric and goal < 100: goal = 100
-        if "upgrade" in metric and goal < 1: goal = 1
-        if "collect" in metric and goal < 2: goal = 2
-
-        description = desc_template.format(goal=goal, timescale=timescale)
-        logger.debug(f"Formatted description: {description}")
-
-        challenge_data = {
-            "id": f"{timescale}_{challenge_type_id}_{int(time.time())}", # Unique ID
-            "type": challenge_type_id,
-            "description": description,
-            "metric": metric,
-            "goal": goal,
-            "reward_type": reward_type,
-            "reward_value": reward_value,
-            "start_time": time.time(),
-            "timescale": timescale
-        }
-
-        player_data["active_challenges"][timescale] = challenge_data
-        player_data["challenge_progress"][timescale] = {} # Reset progress for this timescale
-        player_data["stats"] = {k: 0 for k in player_data["stats"]} # Reset tracked stats
-        logger.debug(f"Updated player_data challenge/stats for {user_id} ({timescale})")
+        if player_data is None:
+            player_data = load_player_data(user_id)
+        challenge_data = assign_new_challenge(player_data, timescale)
+        description, metric, goal = challenge_data["description"], challenge_data["metric"], challenge_data["goal"]
+        reward_type, reward_value = challenge_data["reward_type"], challenge_data["reward_value"]
 
         logger.info(f"Generated new {timescale} challenge for user {user_id}: {description} (Goal: {goal} {metric}, Reward: {reward_value} {reward_type})")
-        save_player_data(user_id, player_data)
-        logger.info(f"Successfully saved player data after {timescale} challenge generation for {user_id}.")
+        if save:
+            save_player_data(user_id, player_data)
+            logger.info(f"Successfully saved player data after {timescale} challenge generation for {user_id}.")
+        return player_data
     except Exception as e:
         logger.error(f"ERROR during generate_new_challenges for user {user_id}, timescale {timescale}: {e}", exc_info=True)
-        # Re-raise or handle appropriately? For now, just log.
+        return None
+
+# Writes one generated challenge per row of (user_id, timescale, challenge, reset_stats)
+_CHALLENGE_BATCH_UPDATE_SQL = """
+    UPDATE players AS p SET
+        active_challenges = jsonb_set(COALESCE(p.active_challenges, '{}'::jsonb), ARRAY[v.ts], v.ch),
+        challenge_progress = jsonb_set(COALESCE(p.challenge_progress, '{}'::jsonb), ARRAY[v.ts], '{}'::jsonb),
+        stats = v.st
+    FROM (VALUES %s) AS v(id, ts, ch, st)
+    WHERE p.user_id = v.id
+"""
+
+def _write_generated_challenges(cur, selected: list[tuple], timescale: str) -> dict[int, tuple[dict, dict]]:
+    """Builds a challenge for each (user_id, player_level, stats) row and writes them in one statement.
+       Returns {user_id: (challenge, reset_stats)} as written."""
+    # Batch job writes don't wait for the WAL flush: a DB crash can only drop the last few pages, leaving
+    # those players on their previous challenge until the next run. SET LOCAL ends with the transaction.
+    cur.execute("SET LOCAL synchronous_commit TO OFF;")
+    written = {}
+    for user_id, player_level, stats in selected:
+        written[user_id] = (_build_challenge(player_level, timescale), dict.fromkeys({**_DEFAULT_STATS, **(stats or {})}, 0))
+    psycopg2.extras.execute_values(
+        cur, _CHALLENGE_BATCH_UPDATE_SQL,
+        [(user_id, timescale, _json_dumps(challenge), _json_dumps(reset_stats)) for user_id, (challenge, reset_stats) in written.items()],
+        template="(%s::bigint, %s::text, %s::jsonb, %s::jsonb)",
+        page_size=1000
+    )
+    return written
 
-def update_challenge_progress(player_data: dict, updated_metrics: list[str]) -> list[str]:
+def get_user_id_bounds() -> tuple[int, int] | None:
+    """Smallest and largest user_id (two index probes), or None if there are no players."""
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT min(user_id), max(user_id) FROM players;")
+                low, high = cur.fetchone()
+            return None if low is None else (low, high)
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error fetching user id bounds: {e}", exc_info=True)
+            conn.rollback()
+            raise
+
+def select_challenge_page(after_user_id: int, limit: int, up_to_user_id: int | None = None,
+                          active_since: datetime | None = None) -> list[tuple[int, int, dict | None]]:
+    """The next limit players after after_user_id (primary key order, optionally stopping at up_to_user_id
+       inclusive and skipping players whose last activity is before active_since) as
+       (user_id, player_level, stats) rows for write_challenge_page. Raises on DB errors so the caller stops paging."""
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT user_id, COALESCE(cardinality(unlocked_achievements), 0), stats FROM players
+                       WHERE user_id > %s AND (%s::bigint IS NULL OR user_id <= %s::bigint)
+                         AND (%s::timestamptz IS NULL OR last_login_time >= %s::timestamptz)
+                       ORDER BY user_id LIMIT %s;""",
+                    (after_user_id, up_to_user_id, up_to_user_id, active_since, active_since, limit)
+                )
+                return cur.fetchall()
+        except psycopg2.DatabaseError as e:
+            logger.error(f"DB error selecting challenge page after user {after_user_id}: {e}", exc_info=True)
+            conn.rollback()
+            raise
+
+def _apply_generated_challenge(player_data: dict, timescale: str, challenge: dict, reset_stats: dict) -> None:
+    """Mirrors one _CHALLENGE_BATCH_UPDATE_SQL row onto a cached player dict."""
+    player_data["active_challenges"][timescale] = challenge
+    player_data["challenge_by_metric"] = index_challenges_by_metric(player_data["active_challenges"])
+    player_data["challenge_progress"][timescale] = {}
+    player_data["stats"] = dict.fromkeys({**reset_stats, **player_data.get("stats", {})}, 0)
+
+@contextmanager
+def _rewriting(user_ids: list[int]):
+    """Marks rows as being rewritten with out-of-band SQL for the duration of the block. Loads that overlap it
+       don't cache what they read (_cache_loaded_player). The caller drops stale clean cache entries first."""
+    global _rewrite_generation
+    with _player_cache_lock:
+        _rewriting_ids.update(user_ids)
+    try:
+        yield
+    finally:
+        with _player_cache_lock:
+            _rewriting_ids.difference_update(user_ids)
+            _rewrite_generation += 1
+
+def write_challenge_page(selected: list[tuple[int, int, dict | None]], timescale: str) -> int:
+    """Gives every selected player a new timescale challenge. The caller must hold their player locks, so no
+       handler has a copy out to save over the result.
+       Cached players are changed in memory and reach the DB with the next flush; the rest are rewritten in one
+       UPDATE under _rewriting. Returns the number of players updated. Raises on DB errors."""
+    uncached = []
+    with _player_cache_lock:
+        for row in selected:
+            entry = PLAYER_CACHE.get(row[0])
+            if entry and (entry[1] or time.monotonic() - entry[2] < PLAYER_CACHE_TTL_SECONDS):
+                assign_new_challenge(entry[0], timescale)
+                entry[1] = True
+            else:
+                PLAYER_CACHE.pop(row[0], None) # Stale and clean: nothing pending, the next load re-reads the row
+                uncached.append(row)
+        if len(uncached) < len(selected):
+            _schedule_flush()
+    if not uncached:
+        return len(selected)
+
+    with _rewriting([row[0] for row in uncached]), db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                written = _write_generated_challenges(cur, uncached, timescale)
+            conn.commit()
+        except psycopg2.DatabaseError as e:
+            logger.error(f"DB error writing {timescale} challenges for {len(uncached)} players: {e}", exc_info=True)
+            conn.rollback()
+            raise
+        with _player_cache_lock:
+            # Only a save can have cached these rows meanwhile (loads skip them); its copy predates the UPDATE
+            for user_id, (challenge, reset_stats) in written.items():
+                entry = PLAYER_CACHE.get(user_id)
+                if entry:
+                    _apply_generated_challenge(entry[0], timescale, challenge, reset_stats)
+                    entry[1] = True
+                    _schedule_flush()
+    return len(selected)
+
+def index_challenges_by_metric(active_challenges: dict) -> dict[str, list[str]]:
+    """Builds the metric -> [timescale, ...] index kept in player_data["challenge_by_metric"].
+       Derived from active_challenges (not stored in the DB); rebuild whenever a challenge is replaced."""
+    index = {}
+    for timescale, challenge in active_challenges.items():
+        if challenge:
+            index.setdefault(challenge["metric"], []).append(timescale)
+    return index
+
+def update_challenge_progress(player_data: dict, updated_metrics: Iterable[str]) -> list[str]:
     """Updates progress for active challenges based on player stats and returns messages for completed challenges."""
+    active_challenges = player_data.get("active_challenges")
+    if not active_challenges or not any(active_challenges.values()):
+        return [] # No challenge generated yet
+    challenge_by_metric = player_data.get("challenge_by_metric")
+    if challenge_by_metric is None: # Dict didn't come from load_player_data
+        challenge_by_metric = player_data["challenge_by_metric"] = index_challenges_by_metric(active_challenges)
+    # A set, so a metric listed twice can't visit (and reward) the same challenge twice
+    metrics = updated_metrics if isinstance(updated_metrics, (set, frozenset)) else set(updated_metrics)
+    matched_timescales = [timescale for metric in metrics for timescale in challenge_by_metric.get(metric, ())]
+    if not matched_timescales:
+        return [] # No active challenge tracks these metrics
+
     completed_messages = []
     user_id = player_data["user_id"]
     stats = player_data.get("stats", {})
+    cash_delta, coin_delta, progress_updates = 0, 0, {}
 
-    for timescale, challenge in player_data["active_challenges"].items():
-        if challenge and challenge["metric"] in updated_metrics:
+    for timescale in matched_timescales:
+        challenge = active_challenges.get(timescale)
+        if challenge:
             metric = challenge["metric"]
             current_progress = stats.get(metric, 0)
             goal = challenge["goal"]
@@ -840,20 +1440,45 @@ def update_challenge_progress(player_data: dict, updated_metrics: list[str]) ->
 
                 # Grant reward
                 if reward_type == 'cash':
-                    player_data["cash"] = player_data.get("cash", 0) + reward_value
+                    cash_delta += reward_value
                 elif reward_type == 'pizza_coins':
-                    player_data["pizza_coins"] = player_data.get("pizza_coins", 0) + reward_value
+                    coin_delta += reward_value
 
                 completed_messages.append(msg)
                 # Mark as completed for this period
-                player_data["challenge_progress"].setdefault(timescale, {})[challenge_id] = True
+                progress_updates.setdefault(timescale, {})[challenge_id] = True
                 # We don't remove the active challenge here, just mark progress complete.
                 # It will be replaced by generate_new_challenges on schedule.
 
+    if completed_messages:
+        _merge_challenge_rewards(player_data, cash_delta, coin_delta, progress_updates)
     # No need to save here, the calling function (collect, upgrade) will save.
     return completed_messages
 
+def _merge_challenge_rewards(player_data: dict, cash_delta: float, coin_delta: int, progress_updates: dict) -> None:
+    """Applies challenge reward deltas and completion flags to an in-memory player dict."""
+    player_data["cash"] = player_data.get("cash", 0) + cash_delta
+    player_data["pizza_coins"] = player_data.get("pizza_coins", 0) + coin_delta
+    progress = player_data.setdefault("challenge_progress", {})
+    for timescale, completed in progress_updates.items():
+        progress.setdefault(timescale, {}).update(completed)
+
 # --- Status Formatting (with sorting) ---
+# Fixed layout of /status; the variable-length sections are pre-joined into the *_block slots
+STATUS_TEMPLATE = (
+    "{header}\n"
+    "<b>Cash:</b> ${cash:,.2f}\n"
+    "<b>Pizza Coins:</b> {pizza_coins:,} 🍕\n"
+    "<b>Total Income Earned:</b> ${total_income_earned:,.2f}\n"
+    "<b>Achievements Unlocked:</b> {achievements_unlocked}\n"
+    "<b>Shops:</b>\n"
+    "{shops_block}\n"
+    "<b>Current Income Rate:</b> ${income_rate:.2f}/sec\n"
+    "<b>Uncollected Income:</b> ${uncollected_income:.2f}\n"
+    "<b>Available Expansions:</b>\n"
+    "{expansions_block}"
+)
+
 def format_status(player_data: dict, sort_by: str = 'name') -> str:
     """Formats the player's status, allowing sorting of the shop list."""
     user_id = player_data.get("user_id", "Unknown")
@@ -869,25 +1494,17 @@ def format_status(player_data: dict, sort_by: str = 'name') -> str:
     if title:
         header += f"\n<i>Title: &lt;{title}&gt;</i>"
 
-    status_lines = [
-        header,
-        f"<b>Cash:</b> ${cash:,.2f}",
-        f"<b>Pizza Coins:</b> {pizza_coins:,} 🍕",
-        f"<b>Total Income Earned:</b> ${total_income_earned:,.2f}",
-        f"<b>Achievements Unlocked:</b> {achievements_unlocked}",
-        "<b>Shops:</b>"
-    ]
+    # One query for every location's performance; owned shops are a subset
+    performance = get_performance_multipliers(EXPANSION_LOCATIONS)
 
-    if not shops:
-        status_lines.append("  None yet! Use /start")
-    else:
+    if shops:
         # --- Sorting Logic --- #
         shop_list_to_sort = []
         for name, data in shops.items():
             level = data.get("level", 1)
             custom_name = data.get("custom_name", name)
             upgrade_cost = get_upgrade_cost(level, name)
-            current_perf = get_current_performance_multiplier(name)
+            current_perf = performance.get(name, 1.0)
             shop_list_to_sort.append({
                 'location': name,
                 'level': level,
@@ -918,6 +1535,7 @@ def format_status(player_data: dict, sort_by: str = 'name') -> str:
         # --- End Sorting Logic --- #
 
         # Iterate through sorted list
+        shop_lines = []
         for shop_info in sorted_shops:
             name = shop_info['location']
             shop_data_dict = shops.get(name, {}) # Get the full data dict
@@ -935,85 +1553,107 @@ def format_status(player_data: dict, sort_by: str = 'name') -> str:
                  time_left = timedelta(seconds=int(shutdown_until - time.time()))
                  shutdown_str = f" 🚫(Closed: {str(time_left).split('.')[0]})"
 
-            status_lines.append(f"  - {perf_emoji} <b>{display_shop_name}:</b> Level {level}{shutdown_str}")
+            shop_lines.append(f"  - {perf_emoji} <b>{display_shop_name}:</b> Level {level}{shutdown_str}")
+        shops_block = "\n".join(shop_lines)
+    else:
+        shops_block = "  None yet! Use /start"
+
+    return STATUS_TEMPLATE.format_map({
+        "header": header,
+        "cash": cash,
+        "pizza_coins": pizza_coins,
+        "total_income_earned": total_income_earned,
+        "achievements_unlocked": achievements_unlocked,
+        "shops_block": shops_block,
+        "income_rate": calculate_income_rate(shops, performance),
+        "uncollected_income": calculate_uncollected_income(player_data, performance),
+        "expansions_block": _expansions_block(shops, get_available_expansions(player_data), performance),
+    })
+
+def _expansions_block(owned_shops: dict, eligible_expansions: Iterable[str], performance: dict[str, float]) -> str:
+    """Renders the /status expansion list. It only depends on which locations are owned/eligible
+       and the multipliers, so rendered blocks are reused until performance changes."""
+    eligible_expansions = frozenset(eligible_expansions)
+    key = (frozenset(owned_shops), eligible_expansions, tuple(performance.items()))
+    block = _EXPANSIONS_BLOCK_CACHE.get(key)
+    if block is not None:
+        return block
 
-    income_rate = calculate_income_rate(shops)
-    status_lines.append(f"<b>Current Income Rate:</b> ${income_rate:.2f}/sec")
-    uncollected_income = calculate_uncollected_income(player_data)
-    status_lines.append(f"<b>Uncollected Income:</b> ${uncollected_income:.2f}")
-    
-    # Get the list of expansions the player is actually eligible for
-    eligible_expansions = get_available_expansions(player_data)
-    
-    status_lines.append("<b>Available Expansions:</b>")
-    
     # Show all possible expansions, not just eligible ones
-    owned_shops = player_data.get("shops", {})
     exp_list_formatted = []
     
-    for loc, req_data in EXPANSION_LOCATIONS.items():
+    for loc in EXPANSION_LOCATIONS:
         # Skip locations player already owns
         if loc in owned_shops:
             continue
             
-        # Get requirement details
-        req_type = req_data[0]
-        req_value = req_data[1]
-        gdp_factor = req_data[2]
-        cost_scale = req_data[3]
-        expansion_cost = get_expansion_cost(loc)
-        current_perf = get_current_performance_multiplier(loc)
+        current_perf = performance.get(loc, 1.0)
         
         # Format performance indicator
         perf_emoji = "📈" if current_perf > 1.1 else "📉" if current_perf < 0.9 else "🤷‍♂️"
-        
-        # Format requirement string
-        if req_type == "level": 
-            req_str = f"(Req: {INITIAL_SHOP_NAME} Lvl {req_value})"
-        elif req_type == "shop_level": 
-            req_str = f"(Req: {req_value} Lvl {req_data[2]})"
-        elif req_type == "total_income": 
-            req_str = f"(Req: Total Earned ${req_value:,.2f})"
-        elif req_type == "shops_count": 
-            req_str = f"(Req: {req_value} Shops)"
-        elif req_type == "has_shop": 
-            req_str = f"(Req: Own {req_value})"
-        else: 
-            req_str = "(Unknown Req)"
+        req_str = EXPANSION_REQ_STR[loc]
         
         # Add eligible indicator
         eligible_emoji = "✅ " if loc in eligible_expansions else "🔒 "
         
-        exp_list_formatted.append(f"  - {eligible_emoji}{loc} {perf_emoji}x{current_perf:.1f} - Cost: ${expansion_cost:,.2f} {req_str}")
+        exp_list_formatted.append(f"  - {eligible_emoji}{loc} {perf_emoji}x{current_perf:.1f} - Cost: ${_EXPANSION_COST_TEXT[loc]} {req_str}")
     
     if exp_list_formatted:
-        status_lines.extend(sorted(exp_list_formatted)) # Sort expansions alphabetically
+        expansions_block = "\n".join(sorted(exp_list_formatted)) # Sort expansions alphabetically
     else:
-        status_lines.append("  No more expansions available. You've conquered the pizza universe!")
-    
-    return "\n".join(status_lines)
+        expansions_block = "  No more expansions available. You've conquered the pizza universe!"
+
+    if len(_EXPANSIONS_BLOCK_CACHE) >= _EXPANSIONS_BLOCK_CACHE_MAX:
+        _EXPANSIONS_BLOCK_CACHE.clear()
+    _EXPANSIONS_BLOCK_CACHE[key] = expansions_block
+    return expansions_block
 
 # --- Payment Logic (Pack Definitions) ---
+class CoinPack(NamedTuple):
+    name: str
+    desc: str
+    price_cents: int
+    coin_amount: int
+
 PIZZA_COIN_PACKS = {
-    "pack_small": ("Small Coin Pack", "A small boost for your empire!", 99, 100),
-    "pack_medium": ("Medium Coin Pack", "A helpful amount of coins.", 499, 550),
-    "pack_large": ("Large Coin Pack", "Rule the pizza world!", 999, 1200),
+    "pack_small": CoinPack("Small Coin Pack", "A small boost for your empire!", 99, 100),
+    "pack_medium": CoinPack("Medium Coin Pack", "A helpful amount of coins.", 499, 550),
+    "pack_large": CoinPack("Large Coin Pack", "Rule the pizza world!", 999, 1200),
 }
+# (pack_id, price_cents): pack - one lookup validates both the pack and the amount at checkout
+PACKS_BY_ID_AMOUNT = {(pack_id, pack.price_cents): pack for pack_id, pack in PIZZA_COIN_PACKS.items()}
 
-def get_pizza_coin_pack(pack_id: str) -> tuple | None:
+def get_pizza_coin_pack(pack_id: str) -> CoinPack | None:
     return PIZZA_COIN_PACKS.get(pack_id)
 
 def credit_pizza_coins(user_id: int, amount: int):
+    """Adds purchased coins with one UPDATE, so the purchase is durable on its own, and mirrors it into a cached copy.
+       The caller must hold the player's lock, so no handler saves a copy without them."""
     if amount <= 0:
         logger.warning(f"Attempted to credit non-positive coin amount ({amount}) for user {user_id}")
         return
-    try:
-        player_data = load_player_data(user_id)
-        player_data["pizza_coins"] = player_data.get("pizza_coins", 0) + amount
-        save_player_data(user_id, player_data)
-        logger.info(f"Successfully credited {amount} Pizza Coins to user {user_id}. New balance: {player_data['pizza_coins']}")
-    except Exception as e:
-        logger.error(f"Failed to credit {amount} Pizza Coins to user {user_id}: {e}", exc_info=True)
+    # No flush may be in flight between the UPDATE and the mirror, or its older snapshot could undo the credit
+    with _flush_lock, _rewriting([user_id]), db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE players SET pizza_coins = pizza_coins + %s WHERE user_id = %s RETURNING pizza_coins;", (amount, user_id))
+                result = cur.fetchone()
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to credit {amount} Pizza Coins to user {user_id}: {e}", exc_info=True)
+            conn.rollback()
+            return
+        if not result:
+            logger.error(f"Failed to credit {amount} Pizza Coins to user {user_id}: no player row.")
+            return
+        with _player_cache_lock:
+            entry = PLAYER_CACHE.get(user_id)
+            if entry and entry[1]:
+                # Pending changes win on the next flush, so they must carry the coins too
+                entry[0]["pizza_coins"] = entry[0].get("pizza_coins", 0) + amount
+            elif entry:
+                entry[0]["pizza_coins"] = result[0] # Clean copy matches the row
+    logger.info(f"Successfully credited {amount} Pizza Coins to user {user_id}. New balance: {result[0]}")
 
 # --- DEPRECATED placeholders ---
 def use_pizza_coins_for_speedup(user_id: int, feature: str):
@@ -1024,116 +1664,125 @@ def use_pizza_coins_for_speedup(user_id: int, feature: str):
     else:
         return "You don't have any Pizza Coins! Purchases are coming soon."
 
-def get_leaderboard_data(limit: int = 10) -> list[tuple[int, str | None, float]]:
-    """Fetches top players based on total_income_earned."""
+def get_leaderboard_data(limit: int = 10) -> list[tuple[int, str | None, float, int, str | None, dict]]:
+    """Fetches top players based on total_income_earned, with everything the leaderboard renders.
+       Returns (user_id, display_name, total_income_earned, rank, current_title, shops) rows."""
     logger.debug(f"Fetching leaderboard data (top {limit})")
-    conn = get_db_connection()
-    if not conn: return []
 
-    sql = """
-    SELECT user_id, display_name, total_income_earned
-    FROM players
-    ORDER BY total_income_earned DESC
-    LIMIT %s;
-    """
     results = []
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (limit,))
-            fetched_results = cur.fetchall()
-            # Convert numeric total_income_earned back to float
-            results = [(row[0], row[1], float(row[2])) for row in fetched_results]
-        logger.debug(f"Fetched {len(results)} rows for leaderboard.")
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Database error fetching leaderboard: {e}", exc_info=True)
-        conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error fetching leaderboard: {e}", exc_info=True)
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE income_leaderboard(%s);", (limit,))
+                fetched_results = cur.fetchall()
+                # Convert numeric total_income_earned back to float
+                results = [(row[0], row[1], float(row[2]), row[3], row[4], row[5] or {}) for row in fetched_results]
+            logger.debug(f"Fetched {len(results)} rows for leaderboard.")
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error fetching leaderboard: {e}", exc_info=True)
+            conn.rollback()
+        except Exception as e:
+            logger.error(f"Unexpected error fetching leaderboard: {e}", exc_info=True)
 
-    return results
+        return results
 
 def get_cash_leaderboard_data(limit: int = 10) -> list[tuple[int, str | None, float]]:
     """Fetches top players based on current cash on hand."""
     logger.debug(f"Fetching cash leaderboard data (top {limit})")
-    conn = get_db_connection()
-    if not conn: return []
 
-    # Order by cash DESC
-    sql = """
-    SELECT user_id, display_name, cash
-    FROM players
-    ORDER BY cash DESC
-    LIMIT %s;
-    """
     results = []
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (limit,))
-            fetched_results = cur.fetchall()
-            # Convert numeric cash back to float
-            results = [(row[0], row[1], float(row[2])) for row in fetched_results]
-        logger.debug(f"Fetched {len(results)} rows for cash leaderboard.")
-    except psycopg2.DatabaseError as e:
-        logger.error(f"Database error fetching cash leaderboard: {e}", exc_info=True)
-        conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error fetching cash leaderboard: {e}", exc_info=True)
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE cash_leaderboard(%s);", (limit,)) # Ordered by cash DESC
+                fetched_results = cur.fetchall()
+                # Convert numeric cash back to float
+                results = [(row[0], row[1], float(row[2])) for row in fetched_results]
+            logger.debug(f"Fetched {len(results)} rows for cash leaderboard.")
+        except psycopg2.DatabaseError as e:
+            logger.error(f"Database error fetching cash leaderboard: {e}", exc_info=True)
+            conn.rollback()
+        except Exception as e:
+            logger.error(f"Unexpected error fetching cash leaderboard: {e}", exc_info=True)
 
-    return results
+        return results
 
 # --- Helper to get display name by ID ---
 def find_display_name_by_id(user_id: int) -> str | None:
      """Fetches just the display name for a given user ID."""
-     conn = get_db_connection()
-     if not conn: return None
      sql = "SELECT display_name FROM players WHERE user_id = %s;"
      name = None
-     try:
-         with conn.cursor() as cur:
-             cur.execute(sql, (user_id,))
-             result = cur.fetchone()
-             if result:
-                 name = result[0]
-     except Exception as e:
-          logger.error(f"Error fetching display name for {user_id}: {e}")
-          # conn.rollback() # Read-only query, rollback might not be needed
-     return name
+     with db_conn() as conn:
+         try:
+             with conn.cursor() as cur:
+                 cur.execute(sql, (user_id,))
+                 result = cur.fetchone()
+                 if result:
+                     name = result[0]
+         except Exception as e:
+              logger.error(f"Error fetching display name for {user_id}: {e}")
+              # conn.rollback() # Read-only query, rollback might not be needed
+         return name
+
+# --- Batch Random Helpers ---
+def uniform_batch(low: float, high: float, n: int) -> list[float]:
+    """Returns n uniform draws in [low, high) using one bound generator method."""
+    draw = _rng.random
+    span = high - low
+    return [low + span * draw() for _ in range(n)]
 
 # --- New Location Performance Functions ---
 def get_current_performance_multiplier(location_name: str) -> float:
     """Gets the current performance multiplier for a location from the DB."""
-    if location_name == INITIAL_SHOP_NAME: # Base location always has 1.0x performance
-        return 1.0
-
-    conn = get_db_connection()
-    if not conn: return 1.0 # Default to 1.0 if DB error
+    return get_performance_multipliers((location_name,))[location_name]
+
+# Multipliers only change in update_location_performance(), so keep the last read in process
+_performance_snapshot: dict[str, float] | None = None
+# (owned locations, eligible locations, multipliers) -> rendered /status expansions block
+_EXPANSIONS_BLOCK_CACHE: dict[tuple[frozenset, frozenset, tuple], str] = {}
+_EXPANSIONS_BLOCK_CACHE_MAX = 1024
+
+def get_performance_multipliers(location_names: Iterable[str]) -> dict[str, float]:
+    """Gets current performance multipliers for several locations (1.0 when unknown), reading every
+       location in one query the first time and serving later calls from the in-process snapshot."""
+    snapshot = _performance_snapshot
+    if snapshot is not None:
+        return {name: snapshot.get(name, 1.0) for name in location_names}
+
+    # Base location always has 1.0x performance
+    multipliers = {name: 1.0 for name in location_names}
+    lookup = list(EXPANSION_LOCATIONS)
+
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXECUTE performance_multipliers(%s);", (lookup,))
+                found = {name: float(value) for name, value in cur.fetchall()}
+            multipliers.update((name, found[name]) for name in multipliers if name in found)
+            missing = [name for name in lookup if name not in found]
+            if missing:
+                # If location not in table yet, keep 1.0 and log warning
+                logger.warning(f"No performance data found for {', '.join(missing)}, returning 1.0.")
+            _set_performance_snapshot(found)
+        except psycopg2.DatabaseError as e:
+            logger.error(f"DB error fetching performance multipliers for {lookup}: {e}", exc_info=True)
+            conn.rollback()
+        except Exception as e:
+            logger.error(f"Unexpected error fetching performance multipliers for {lookup}: {e}", exc_info=True)
 
-    sql = "SELECT current_multiplier FROM location_performance WHERE location_name = %s;"
-    multiplier = 1.0
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (location_name,))
-            result = cur.fetchone()
-            if result:
-                multiplier = float(result[0])
-            else:
-                 # If location not in table yet, return 1.0 and log warning
-                 logger.warning(f"No performance data found for {location_name}, returning 1.0.")
-    except psycopg2.DatabaseError as e:
-        logger.error(f"DB error fetching performance multiplier for {location_name}: {e}", exc_info=True)
-        conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error fetching performance multiplier for {location_name}: {e}", exc_info=True)
+        # Clamp multiplier just in case? Optional.
+        # multiplier = max(0.5, min(2.0, multiplier))
+        return multipliers
 
-    # Clamp multiplier just in case? Optional.
-    # multiplier = max(0.5, min(2.0, multiplier))
-    return multiplier
+def _set_performance_snapshot(snapshot: dict[str, float] | None) -> None:
+    """Replaces the cached multipliers (None forces a re-read) and drops status blocks rendered from the old ones."""
+    global _performance_snapshot
+    _performance_snapshot = snapshot
+    _EXPANSIONS_BLOCK_CACHE.clear()
 
 def update_location_performance():
     """Calculates and saves new random multipliers for all locations."""
     logger.info("Updating location performance multipliers...")
-    conn = get_db_connection()
-    if not conn: return
 
     sql = """
     INSERT INTO location_performance (location_name, current_multiplier, last_updated)
@@ -1143,23 +1792,25 @@ def update_location_performance():
         last_updated = EXCLUDED.last_updated;
     """
     updates = []
-    for name, data in EXPANSION_LOCATIONS.items():
-        # Fluctuate around 1.0, range e.g. 0.7 to 1.5
-        fluctuation = random.uniform(0.7, 1.5)
+    # Fluctuate around 1.0, one batch draw for every location
+    fluctuations = uniform_batch(*PERFORMANCE_FLUCTUATION_RANGE, len(EXPANSION_LOCATIONS))
+    for name, fluctuation in zip(EXPANSION_LOCATIONS, fluctuations):
         new_multiplier = round(fluctuation, 2)
         updates.append((name, new_multiplier))
         logger.debug(f"New performance for {name}: {new_multiplier:.2f}")
 
-    try:
-        with conn.cursor() as cur:
-            psycopg2.extras.execute_batch(cur, sql, updates)
-        conn.commit()
-        logger.info(f"Successfully updated performance multipliers for {len(updates)} locations.")
-    except psycopg2.DatabaseError as e:
-        logger.error(f"DB error updating location performance: {e}", exc_info=True)
-        conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error updating location performance: {e}", exc_info=True)
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_batch(cur, sql, updates)
+            conn.commit()
+            _set_performance_snapshot(dict(updates))
+            logger.info(f"Successfully updated performance multipliers for {len(updates)} locations.")
+        except psycopg2.DatabaseError as e:
+            logger.error(f"DB error updating location performance: {e}", exc_info=True)
+            conn.rollback()
+        except Exception as e:
+            logger.error(f"Unexpected error updating location performance: {e}", exc_info=True)
 
 # --- New Sabotage Helper Functions ---
 def get_top_earning_shop(shops: dict) -> str | None:
@@ -1173,9 +1824,7 @@ def get_top_earning_shop(shops: dict) -> str | None:
     for name, data in shops.items():
         level = data.get("level", 1)
         # Calculate potential rate (ignoring current performance/shutdown for targeting)
-        gdp_factor = 1.0
-        if name != INITIAL_SHOP_NAME and name in EXPANSION_LOCATIONS:
-            if len(EXPANSION_LOCATIONS[name]) > 2: gdp_factor = EXPANSION_LOCATIONS[name][2]
+        gdp_factor = _INCOME_MULT.get(name, 1.0)
         potential_rate = (BASE_INCOME_PER_SECOND * level * gdp_factor)
 
         if potential_rate > max_rate:
@@ -1189,7 +1838,7 @@ def get_top_earning_shop(shops: dict) -> str | None:
     return top_shop
 
 def apply_shop_shutdown(target_user_id: int, shop_location: str, duration_seconds: int):
-    """Applies a shutdown timer to a specific shop for a target user."""
+    """Applies a shutdown timer to a specific shop for a target user. Caller must hold the target's player lock."""
     logger.info(f"Applying shutdown to {shop_location} for user {target_user_id} for {duration_seconds}s")
     player_data = load_player_data(target_user_id)
     if not player_data or shop_location not in player_data.get("shops", {}):
@@ -1206,29 +1855,43 @@ def apply_shop_shutdown(target_user_id: int, shop_location: str, duration_second
 def find_user_by_display_name(display_name: str) -> list[int]:
     """Finds user IDs by display name (case-insensitive)."""
     logger.debug(f"Searching for user ID by display name: {display_name}")
-    conn = get_db_connection()
-    if not conn: return []
 
     # Use LOWER() for case-insensitive comparison
     sql = "SELECT user_id FROM players WHERE LOWER(display_name) = LOWER(%s);"
     user_ids = []
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (display_name,))
-            results = cur.fetchall()
-            user_ids = [row[0] for row in results]
-        logger.debug(f"Found {len(user_ids)} match(es) for display name '{display_name}'.")
-    except psycopg2.DatabaseError as e:
-        logger.error(f"DB error finding user by display name '{display_name}': {e}", exc_info=True)
-        conn.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error finding user by display name '{display_name}': {e}", exc_info=True)
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, (display_name,))
+                results = cur.fetchall()
+                user_ids = [row[0] for row in results]
+            logger.debug(f"Found {len(user_ids)} match(es) for display name '{display_name}'.")
+        except psycopg2.DatabaseError as e:
+            logger.error(f"DB error finding user by display name '{display_name}': {e}", exc_info=True)
+            conn.rollback()
+        except Exception as e:
+            logger.error(f"Unexpected error finding user by display name '{display_name}': {e}", exc_info=True)
 
-    return user_ids
+        return user_ids
 
 def get_shop_custom_name(user_id: int, location_name: str) -> str | None:
     """Fetches the custom name of a specific shop for a user."""
-    player_data = load_player_data(user_id)
-    if not player_data:
-        return location_name # Fallback if data load fails
-    return player_data.get("shops", {}).get(location_name, {}).get("custom_name", location_name)
+    with _player_cache_lock:
+        entry = PLAYER_CACHE.get(user_id)
+        if entry:
+            return entry[0].get("shops", {}).get(location_name, {}).get("custom_name", location_name)
+
+    # Not cached: project just this one JSONB field instead of loading (and parsing) the whole player
+    sql = "SELECT shops #>> ARRAY[%s, 'custom_name'] FROM players WHERE user_id = %s;"
+    custom_name = None
+    with db_conn() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, (location_name, user_id))
+                result = cur.fetchone()
+                if result:
+                    custom_name = result[0]
+        except psycopg2.DatabaseError as e:
+            logger.error(f"DB error fetching custom name of {location_name} for {user_id}: {e}", exc_info=True)
+            conn.rollback()
+    return custom_name or location_name # Fallback to the location name
@@ -1,32 +1,39 @@
 import logging
+import logging.handlers
+import queue
 import os
-import glob # For finding player data files
 import random # For tips!
 import time # <<< Added missing import
 import re # For sanitization
 import html # For escaping
 import asyncio # For delays between messages
-from datetime import time as dt_time, timedelta, datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import weakref
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import timedelta, datetime, timezone
 
 # Telegram Core Types
-from telegram import Update, LabeledPrice, ShippingOption, Invoice, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
-# Telegram Constants & Filters
-from telegram.constants import ChatAction # Maybe useful later?
+from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, MessageEntity
+from telegram.error import RetryAfter, TimedOut
 # Telegram Extensions
 from telegram.ext import (
+    AIORateLimiter,
     Application,
-    CommandHandler,
+    BaseHandler,
     ContextTypes,
     MessageHandler,
     filters,
     PreCheckoutQueryHandler,
-    ShippingQueryHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
 
 # Scheduling
+from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 # Import game logic functions
 import game # Corrected import
@@ -46,10 +53,16 @@ CHANGE_LOG_ENTRIES = [
 # Use a date format like YYYYMMDD or a simple version number
 CURRENT_SUMMARY_VERSION = "20240406.1"
 
-# Enable logging (ensure logger is configured as before)
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Enable logging: handlers only enqueue records; a background thread formats and writes them,
+# so log I/O never stalls the event loop
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler, respect_handler_level=True)
+# INFO by default; set LOG_LEVEL=WARNING in production to skip per-command request logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, handlers=[logging.handlers.QueueHandler(_log_queue)])
+log_listener.start()
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("apscheduler").setLevel(logging.WARNING) # Keep scheduler logs quieter
 logger = logging.getLogger(__name__)
@@ -57,6 +70,29 @@ logger = logging.getLogger(__name__)
 # --- Bot Tokens & Config ---
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN")
+# Public hostname Telegram pushes updates to; leave unset to fall back to long polling (local dev)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Bot API HTTP client: the default 8 connections run out when jobs fan messages out to many players
+TELEGRAM_CONNECTION_POOL_SIZE = 256
+TELEGRAM_POOL_TIMEOUT_SECONDS = 20
+TELEGRAM_CONNECT_TIMEOUT_SECONDS = 10
+TELEGRAM_READ_TIMEOUT_SECONDS = 15
+TELEGRAM_HTTP_VERSION = "2" # Concurrent sends multiplex over a few connections instead of opening one each
+# Updates handled at once; per-player locks (player_lock) keep one user's updates from racing each other
+CONCURRENT_UPDATES = 64
+# Every Bot API call goes through AIORateLimiter (Telegram's ~30 msg/s bot-wide and 20 msg/min per group limits);
+# calls answered with 429 RetryAfter are retried after the requested wait, up to this many times
+TELEGRAM_MAX_RETRIES = 3
+# Notification sends: attempts per message, and the first backoff after a timeout (doubles each retry)
+NOTIFICATION_SEND_ATTEMPTS = 3
+NOTIFICATION_RETRY_BACKOFF_SECONDS = 1.0
+# Chance of the pineapple easter egg on a normal collection
+PINEAPPLE_CHANCE = 0.05
+_rng = random.Random() # Module-local generator for the collect path
+# Worker threads for asyncio.to_thread (blocking game/DB calls); by default one per pooled DB connection,
+# so handlers rarely queue in game.db_conn behind the flush timer and job threads that share the pool
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", str(game.DB_POOL_MAX_CONN)))
 
 if not BOT_TOKEN:
     logger.critical("TELEGRAM_BOT_TOKEN environment variable not set! Exiting.")
@@ -65,9 +101,27 @@ if not BOT_TOKEN:
 if not PAYMENT_PROVIDER_TOKEN:
     logger.warning("PAYMENT_PROVIDER_TOKEN environment variable not set! Payments will fail.")
 
+# Coin packs never change at runtime, so build the invoice pieces once; only the payload's user id varies
+INVOICE_CURRENCY = "USD"
+# pack_id -> (pack name, payload prefix, send_invoice keyword arguments)
+_INVOICE_TEMPLATES = {
+    pack_id: (name, f"BUY_{pack_id.upper()}_", {
+        "title": f"{name} ({coin_amount} Coins)",
+        "description": description,
+        "currency": INVOICE_CURRENCY,
+        "provider_token": PAYMENT_PROVIDER_TOKEN,
+        "prices": (LabeledPrice(label=name, amount=price_cents),),
+    })
+    for pack_id, (name, description, price_cents, coin_amount) in game.PIZZA_COIN_PACKS.items()
+}
+# Invoice payload "BUY_<PACK_ID>_<user_id>"; pack ids contain underscores, so the user id is whatever follows the last one
+_PAYLOAD_RE = re.compile(r"^BUY_([A-Z0-9_]+)_(\d+)$")
+_HTML_TAG_RE = re.compile(r"<[^<]+?>") # Tags stripped from user-chosen names
+
 # Initialize Database Schema & Seed Performance Data
 try:
     logger.info("Initializing database...")
+    game.init_db_pool()
     game.initialize_database()
     logger.info("Seeding/Updating location performance data...")
     game.update_location_performance() # Ensure this runs on startup
@@ -80,35 +134,102 @@ except Exception as e:
     exit()
 
 # Global Scheduler instance
-scheduler = AsyncIOScheduler(timezone="UTC") # Use UTC for consistency
+# Seconds a job may start late (busy loop, restart) before APScheduler drops that run
+SCHEDULER_MISFIRE_GRACE_SECONDS = 300
+scheduler = AsyncIOScheduler(
+    timezone="UTC", # Use UTC for consistency
+    executors={"default": AsyncIOExecutor()}, # Jobs are coroutines; their blocking DB work already runs on the default thread pool
+    job_defaults={"max_instances": 1, "coalesce": True, "misfire_grace_time": SCHEDULER_MISFIRE_GRACE_SECONDS},
+)
+# Players per transaction in the challenge jobs; keeps row locks and flushes short while the job runs
+CHALLENGE_JOB_BATCH_SIZE = 1000
+# The user id range is split into this many slices, paged by at most CHALLENGE_JOB_CONCURRENCY workers at once
+CHALLENGE_JOB_SLICES = 16
+CHALLENGE_JOB_CONCURRENCY = 4
+
+# One lock per player so overlapping updates from the same user can't interleave a load/modify/save.
+# Holders and waiters keep a lock alive; once nobody references it the entry disappears
+_player_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
 
 # --- Helper Functions ---
-async def check_and_notify_achievements(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    """Checks for new achievements and sends notifications."""
+def player_lock(user_id: int) -> asyncio.Lock:
+    """Returns the lock guarding read-modify-write of this player's data."""
+    lock = _player_locks.get(user_id)
+    if lock is None:
+        lock = _player_locks[user_id] = asyncio.Lock()
+    return lock
+
+@asynccontextmanager
+async def player_session(user_id: int):
+    """Holds the player's lock, loads their data once and saves it once when the block exits normally."""
+    async with player_lock(user_id):
+        player_data = await asyncio.to_thread(game.load_player_data, user_id)
+        yield player_data
+        await asyncio.to_thread(game.save_player_data, user_id, player_data)
+
+async def safe_send(bot, chat_id: int, **kwargs):
+    """send_message for notifications, retried on timeouts (exponential backoff) and on any 429 the rate
+       limiter gave up on (after Telegram's retry_after). The last attempt's error propagates to the caller."""
+    delay = NOTIFICATION_RETRY_BACKOFF_SECONDS
+    for _ in range(NOTIFICATION_SEND_ATTEMPTS - 1):
+        try:
+            return await bot.send_message(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Rate limited sending to {chat_id}, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except TimedOut:
+            logger.warning(f"Timed out sending to {chat_id}, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay *= 2
+    return await bot.send_message(chat_id=chat_id, **kwargs)
+
+async def check_and_notify_achievements(user_id: int, context: ContextTypes.DEFAULT_TYPE, triggered_metrics: tuple[str, ...] | None = None, player_data: dict | None = None):
+    """Checks for new achievements (optionally only those tracking triggered_metrics), saves and notifies.
+       Pass player_data when the caller already holds a current copy to skip the reload."""
+    if player_data is not None and player_data.get("achievements_mask") == game.ALL_ACHIEVEMENTS_MASK:
+        return # Nothing left to unlock
     try:
-        newly_unlocked = game.check_achievements(user_id)
-        for name, desc, title in newly_unlocked:
-            title_msg = f" You've earned the title: <{title}>!" if title else ""
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"🏆 Achievement Unlocked! 🏆\n<b>{name}</b>: {desc}{title_msg}\n<i>Share your success!</i>",
-                parse_mode="HTML"
-            )
+        async with player_lock(user_id):
+            if player_data is None:
+                player_data = await asyncio.to_thread(game.load_player_data, user_id)
+            newly_unlocked, player_data = game.check_achievements(player_data, triggered_metrics)
+            if newly_unlocked:
+                await asyncio.to_thread(game.save_player_data, user_id, player_data)
+    except Exception as e:
+        logger.error(f"Error checking achievements for {user_id}: {e}", exc_info=True)
+        return
+    await notify_achievements(user_id, newly_unlocked, context)
+
+async def notify_achievements(user_id: int, newly_unlocked: list[tuple[str, str, str | None]], context: ContextTypes.DEFAULT_TYPE):
+    """Sends every achievement already unlocked by a game action as one message."""
+    if not newly_unlocked:
+        return
+    notices = []
+    for name, desc, title in newly_unlocked:
+        title_msg = f" You've earned the title: &lt;{html.escape(title)}&gt;!" if title else ""
+        notices.append(f"🏆 Achievement Unlocked! 🏆\n<b>{name}</b>: {desc}{title_msg}")
+    try:
+        await safe_send(
+            context.bot, user_id,
+            text="\n\n".join(notices) + "\n<i>Share your success!</i>",
+            parse_mode="HTML"
+        )
     except Exception as e:
-        logger.error(f"Error checking/notifying achievements for {user_id}: {e}", exc_info=True)
+        logger.error(f"Error notifying achievements for {user_id}: {e}", exc_info=True)
 
 async def send_challenge_notifications(user_id: int, messages: list[str], context: ContextTypes.DEFAULT_TYPE):
-    """Sends messages about completed challenges."""
+    """Sends all completed-challenge messages as one message."""
     if not messages:
         return
     try:
-        for msg in messages:
-            await context.bot.send_message(chat_id=user_id, text=msg)
+        await safe_send(context.bot, user_id, text="\n\n".join(messages))
     except Exception as e:
         logger.error(f"Error sending challenge notification to {user_id}: {e}", exc_info=True)
 
 # --- Helper Function to send summary (Modified) ---
-async def send_change_summary(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+async def send_change_summary(user_id: int, context: ContextTypes.DEFAULT_TYPE, player_data: dict | None = None):
+    """Sends the change log and records the version as seen. When player_data is given the
+       version is only set on it and the caller saves it; otherwise the player is loaded and saved."""
     logger.info(f"Sending change summary version {CURRENT_SUMMARY_VERSION} to user {user_id}")
     try:
         if not CHANGE_LOG_ENTRIES:
@@ -125,23 +246,67 @@ async def send_change_summary(user_id: int, context: ContextTypes.DEFAULT_TYPE):
             f"<i>Keep building that empire!</i>"
         )
 
-        await context.bot.send_message(chat_id=user_id, text=full_message, parse_mode="HTML")
+        await safe_send(context.bot, user_id, text=full_message, parse_mode="HTML")
 
         # Update player's seen version in DB
-        player_data = game.load_player_data(user_id)
-        if player_data:
+        if player_data is not None:
+            player_data["last_summary_seen_version"] = CURRENT_SUMMARY_VERSION
+            return
+        async with player_session(user_id) as player_data:
             player_data["last_summary_seen_version"] = CURRENT_SUMMARY_VERSION
-            game.save_player_data(user_id, player_data)
-        else:
-             logger.warning(f"Could not load player data for {user_id} after sending summary to update seen version.")
     except Exception as e:
         logger.error(f"Error sending change summary to {user_id}: {e}", exc_info=True)
 
+async def record_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs after every update's handler (group 1) so any command or button keeps the player in the
+       challenge jobs' active window, not only /start."""
+    user = update.effective_user
+    if user:
+        await asyncio.to_thread(game.record_activity, user.id)
+
 # --- Utility function to update name ---
 async def update_player_display_name(user_id: int, user: "telegram.User | None"):
     """Helper to call the game logic update function."""
     if user:
-        game.update_display_name(user_id, user)
+        await asyncio.to_thread(game.update_display_name, user_id, user)
+
+# Main action keyboard under every status message; it never changes, so build it once
+STATUS_MAIN_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("💰 Collect Income", callback_data="main_collect"),
+        InlineKeyboardButton("⬆️ Upgrade Shop", callback_data="main_upgrade"),
+    ],
+    [
+        InlineKeyboardButton("🗺️ Expand Empire", callback_data="main_expand"),
+        InlineKeyboardButton("🎯 View Challenges", callback_data="main_challenges"),
+    ],
+    [
+        InlineKeyboardButton("🏆 Leaderboard", callback_data="main_leaderboard"),
+        InlineKeyboardButton("🔪 Sabotage Rival", callback_data="main_sabotage"),
+    ],
+    [
+        InlineKeyboardButton("🍕 Buy Coins", callback_data="main_buycoins"),
+        InlineKeyboardButton("❓ Help Guide", callback_data="main_help"),
+    ]
+])
+
+@functools.lru_cache(maxsize=256)
+def expansion_markup(options: tuple[tuple[str, tuple[float, float]], ...]) -> InlineKeyboardMarkup:
+    """Two-per-row expansion buttons from (location, (cost, performance)) pairs. Markups are immutable,
+       so identical menus (same locations, same day's multipliers) share one object."""
+    keyboard = []
+    row = []
+    for i, (loc, (cost, current_perf)) in enumerate(options):
+        perf_emoji = "📈" if current_perf > 1.1 else "📉" if current_perf < 0.9 else "🤷‍♂️"
+        # Show performance and cost on button
+        button_text = f"{loc} {perf_emoji}x{current_perf:.1f} (${cost:,.0f})"
+        row.append(InlineKeyboardButton(button_text, callback_data=f"expand_{loc}"))
+        if (i + 1) % 2 == 0:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard)
 
 # --- NEW Helper to show upgrade options ---
 async def _show_upgrade_options(update_or_query: Update | CallbackQuery, context: ContextTypes.DEFAULT_TYPE):
@@ -164,7 +329,7 @@ async def _show_upgrade_options(update_or_query: Update | CallbackQuery, context
         return
 
     logger.debug(f"Showing upgrade options for user {user.id}")
-    player_data = game.load_player_data(user.id)
+    player_data = await asyncio.to_thread(game.load_player_data, user.id)
     shops = player_data.get("shops", {})
 
     if not shops:
@@ -175,11 +340,13 @@ async def _show_upgrade_options(update_or_query: Update | CallbackQuery, context
     current_cash = player_data.get("cash", 0)
 
     keyboard = []
-    shop_list = sorted(shops.items(), key=lambda item: game.get_upgrade_cost(item[1].get('level', 1), item[0])) # Sort by current upgrade cost asc
+    # (cost, location, shop_data, level), sorted by current upgrade cost asc; each cost is looked up once
+    shop_list = sorted(
+        (game.get_upgrade_cost(shop_data.get("level", 1), location), location, shop_data, shop_data.get("level", 1))
+        for location, shop_data in shops.items()
+    )
 
-    for location, shop_data in shop_list:
-        level = shop_data.get("level", 1)
-        cost = game.get_upgrade_cost(level, location)
+    for cost, location, shop_data, level in shop_list:
         custom_name = shop_data.get("custom_name", location)
         display_name = f"{custom_name} ({location})" if custom_name != location else location
         # Button shows Shop Name (Lvl X) - Cost $Y
@@ -211,44 +378,35 @@ async def _show_upgrade_options(update_or_query: Update | CallbackQuery, context
 
 
 # --- NEW Helper to process upgrade attempt ---
+# Outcome message templates: only the one picked gets formatted
+_UPGRADE_SUCCESS_MESSAGES = (
+    "🍾 Hot dang! Your {shop} spot just hit Level {level}. Lines around the block incoming!",
+    "🤌 Mama mia! {shop} is now Level {level}! More dough, less problems!",
+    "🎉 Level {level} for {shop}! You're cookin' with gas now!",
+)
+_UPGRADE_FAILURE_MESSAGES = (
+    "💥 KABOOM! Contractors messed up! Upgrade failed, ${cost} went up in smoke!",
+    "😱 Mamma Mia! Sinkhole swallowed the crew! Upgrade failed, dough gone (${cost})!",
+    "📉 Bad investment! {shop} upgrade flopped. Lost ${cost}!",
+    "🔥 Grease fire! Upgrade went belly-up. Kiss ${cost} goodbye!",
+)
+
 async def _process_upgrade(context: ContextTypes.DEFAULT_TYPE, user_id: int, shop_location: str, query: CallbackQuery | None = None):
     """Handles the core logic of attempting an upgrade."""
     logger.info(f"Processing upgrade attempt for user {user_id}, shop '{shop_location}'")
     try:
-        # Need attacker data for display name fallback on failure message
-        attacker_data = game.load_player_data(user_id)
-        shops = attacker_data.get("shops", {})
-        if shop_location not in shops:
-             # This check might be redundant if called from button, but good safety
-             raise ValueError(f"Shop {shop_location} not found for user {user_id}")
-
-        current_level = shops[shop_location].get("level", 1)
-        success, result_data, completed_challenges = game.upgrade_shop(user_id, shop_location)
+        # upgrade_shop checks ownership and cash itself
+        async with player_lock(user_id):
+            success, outcome, completed_challenges, newly_unlocked = await asyncio.to_thread(game.upgrade_shop, user_id, shop_location)
 
         outcome_message = ""
         if success:
-            new_level = result_data
-            fun_messages = [
-                f"🍾 Hot dang! Your {shop_location} spot just hit Level {new_level}. Lines around the block incoming!",
-                f"🤌 Mama mia! {shop_location} is now Level {new_level}! More dough, less problems!",
-                f"🎉 Level {new_level} for {shop_location}! You're cookin' with gas now!"
-            ]
-            outcome_message = random.choice(fun_messages)
+            outcome_message = random.choice(_UPGRADE_SUCCESS_MESSAGES).format(shop=shop_location, level=outcome["new_level"])
         else:
-            failure_message = result_data
-            if "Not enough cash" in failure_message:
-                 outcome_message = failure_message
+            if "error" in outcome:
+                 outcome_message = outcome["error"]
             else:
-                 cost_lost_str = "the cost"
-                 try: cost_lost_str = failure_message.split("lost ")[-1].split(" in")[0]
-                 except IndexError: logger.warning(f"Could not parse cost from failure message: {failure_message}")
-                 failure_messages = [
-                      f"💥 KABOOM! Contractors messed up! Upgrade failed, {cost_lost_str} went up in smoke!",
-                      f"😱 Mamma Mia! Sinkhole swallowed the crew! Upgrade failed, dough gone ({cost_lost_str})!",
-                      f"📉 Bad investment! {shop_location} upgrade flopped. Lost {cost_lost_str}!",
-                      f"🔥 Grease fire! Upgrade went belly-up. Kiss {cost_lost_str} goodbye!"
-                 ]
-                 outcome_message = random.choice(failure_messages)
+                 outcome_message = random.choice(_UPGRADE_FAILURE_MESSAGES).format(shop=shop_location, cost=game.format_money(outcome["cost_lost"]))
 
         # Send result: Edit message if from callback, else send new
         if query:
@@ -259,7 +417,7 @@ async def _process_upgrade(context: ContextTypes.DEFAULT_TYPE, user_id: int, sho
         # Post-action checks
         if success:
             await send_challenge_notifications(user_id, completed_challenges, context)
-            await check_and_notify_achievements(user_id, context)
+            await notify_achievements(user_id, newly_unlocked, context)
 
     except Exception as e:
         logger.error(f"Error during _process_upgrade for {user_id}, shop {shop_location}: {e}", exc_info=True)
@@ -271,192 +429,206 @@ async def _process_upgrade(context: ContextTypes.DEFAULT_TYPE, user_id: int, sho
              await context.bot.send_message(chat_id=user_id, text=error_msg)
 
 # --- Scheduled Job Functions (Restore Definitions) ---
-async def generate_daily_challenges_job(context: ContextTypes.DEFAULT_TYPE):
-    """Scheduled job to generate daily challenges for all players in DB."""
-    logger.info("Running daily challenge generation job...")
+async def _generate_challenges_for_range(timescale: str, after_user_id: int, up_to_user_id: int,
+                                         active_since: datetime, semaphore: asyncio.Semaphore) -> int:
+    """Pages one user id slice CHALLENGE_JOB_BATCH_SIZE rows at a time, each page in its own transaction.
+       A page's players are locked (in user id order) while it is written, so no handler saves over it."""
+    generated_count = 0
+    async with semaphore:
+        while True:
+            selected = await asyncio.to_thread(
+                game.select_challenge_page, after_user_id, CHALLENGE_JOB_BATCH_SIZE, up_to_user_id, active_since
+            )
+            if not selected:
+                return generated_count
+            async with AsyncExitStack() as locks:
+                for row in selected:
+                    await locks.enter_async_context(player_lock(row[0]))
+                generated_count += await asyncio.to_thread(game.write_challenge_page, selected, timescale)
+            after_user_id = selected[-1][0]
+
+async def generate_challenges_in_batches(timescale: str) -> tuple[int, list[BaseException]]:
+    """Generates challenges for every recently active player off the event loop, paging CHALLENGE_JOB_SLICES
+       id ranges concurrently (bounded by CHALLENGE_JOB_CONCURRENCY).
+       Returns (players_updated, errors from the slices that failed)."""
+    bounds = await asyncio.to_thread(game.get_user_id_bounds)
+    if bounds is None:
+        return 0, []
+    # Cached logins may not have reached the DB yet; write them out so the activity filter sees them
+    await asyncio.to_thread(game.flush_player_cache)
+    active_since = datetime.now(timezone.utc) - timedelta(days=game.ACTIVE_PLAYER_WINDOW_DAYS)
+    low, high = bounds
+    step = max(1, (high - low + CHALLENGE_JOB_SLICES) // CHALLENGE_JOB_SLICES)
+    semaphore = asyncio.Semaphore(CHALLENGE_JOB_CONCURRENCY)
+    # Slices are (after, up_to]: the first starts just below the smallest id, the last ends at the largest
+    edges = list(range(low - 1, high, step)) + [high]
+    results = await asyncio.gather(
+        *(_generate_challenges_for_range(timescale, after, up_to, active_since, semaphore) for after, up_to in zip(edges, edges[1:])),
+        return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    return sum(result for result in results if not isinstance(result, BaseException)), errors
+
+async def _run_challenge_job(timescale: str) -> None:
+    """Shared body of the daily/weekly jobs: one paged bulk run, then a single summary of what failed."""
+    logger.info(f"Running {timescale} challenge generation job...")
     try:
-        user_ids = game.get_all_user_ids()
-        if not user_ids:
-            logger.info("No players found in database for daily challenge generation.")
-            return
-        generated_count = 0
-        for user_id in user_ids:
-            try:
-                game.generate_new_challenges(user_id, 'daily')
-                generated_count += 1
-            except Exception as e:
-                logger.error(f"Error generating daily challenge for user {user_id}: {e}", exc_info=True)
-        logger.info(f"Daily challenge generation complete. Processed for {generated_count}/{len(user_ids)} users.")
+        generated_count, errors = await generate_challenges_in_batches(timescale)
     except Exception as e:
-        logger.error(f"Failed to fetch user IDs for daily challenge job: {e}", exc_info=True)
+        logger.error(f"Failed during {timescale} challenge job: {e}", exc_info=True)
+        return
+    for error in errors:
+        logger.error(f"A {timescale} challenge slice failed: {error}", exc_info=error)
+    if errors:
+        logger.warning(f"{timescale.capitalize()} challenge generation finished with {len(errors)} failed slice(s); {generated_count} users updated.")
+    elif not generated_count:
+        logger.info(f"No recently active players for {timescale} challenge generation.")
+    else:
+        logger.info(f"{timescale.capitalize()} challenge generation complete. Processed for {generated_count} users.")
+
+async def generate_daily_challenges_job(context: ContextTypes.DEFAULT_TYPE):
+    """Scheduled job to generate daily challenges for recently active players in DB."""
+    await _run_challenge_job('daily')
 
 async def generate_weekly_challenges_job(context: ContextTypes.DEFAULT_TYPE):
-    """Scheduled job to generate weekly challenges for all players in DB."""
-    logger.info("Running weekly challenge generation job...")
-    try:
-        user_ids = game.get_all_user_ids()
-        if not user_ids:
-            logger.info("No players found in database for weekly challenge generation.")
-            return
-        generated_count = 0
-        for user_id in user_ids:
-            try:
-                game.generate_new_challenges(user_id, 'weekly')
-                generated_count += 1
-            except Exception as e:
-                logger.error(f"Error generating weekly challenge for user {user_id}: {e}", exc_info=True)
-        logger.info(f"Weekly challenge generation complete. Processed for {generated_count}/{len(user_ids)} users.")
-    except Exception as e:
-        logger.error(f"Failed to fetch user IDs for weekly challenge job: {e}", exc_info=True)
+    """Scheduled job to generate weekly challenges for recently active players in DB."""
+    await _run_challenge_job('weekly')
 
 async def update_location_performance_job(context: ContextTypes.DEFAULT_TYPE):
     """Scheduled job to update location performance multipliers."""
     logger.info("Running location performance update job...")
     try:
-        game.update_location_performance()
+        await asyncio.to_thread(game.update_location_performance)
     except Exception as e:
         logger.error(f"Error in update_location_performance_job: {e}", exc_info=True)
 
+async def flush_player_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    """Scheduled job writing back cached players whose only changes were stats/progress/login time."""
+    try:
+        await asyncio.to_thread(game.flush_player_cache)
+    except Exception as e:
+        logger.error(f"Error in flush_player_cache_job: {e}", exc_info=True)
+
 # --- Sabotage Processing Helper (Restore Definition) --- #
-async def _process_sabotage(context: ContextTypes.DEFAULT_TYPE, attacker_user_id: int, target_user_id: int, shop_location: str):
-    """Handles the core logic: check target, roll chance, apply outcome, handle cost/cooldown."""
-    attacker_data = game.load_player_data(attacker_user_id)
+async def _process_sabotage(attacker_user_id: int, target_user_id: int, shop_location: str, attacker_data: dict | None = None) -> tuple[dict | None, list[str], str | None]:
+    """Handles the core logic: check target, roll chance, apply outcome, handle cost/cooldown.
+       Changes are made to attacker_data (loaded if not passed) and returned for the caller's single save.
+       The caller must hold both players' locks, so nothing is sent from here: returns (attacker_data or None,
+       messages for the attacker, alert for the target or None) for the caller to send once the locks are released."""
+    if attacker_data is None:
+        attacker_data = await asyncio.to_thread(game.load_player_data, attacker_user_id)
     if not attacker_data:
-        await context.bot.send_message(chat_id=attacker_user_id, text="Couldn't load your data to process sabotage outcome.")
-        return None # Indicate failure to save
+        return None, ["Couldn't load your data to process sabotage outcome."], None # Indicate failure to save
 
     attacker_cash = attacker_data.get("cash", 0)
     sabotage_cost = round(game.SABOTAGE_BASE_COST + (attacker_cash * game.SABOTAGE_PCT_COST), 2)
 
-    target_data = game.load_player_data(target_user_id)
+    target_data = await asyncio.to_thread(game.load_player_data, target_user_id)
     target_shop_display_name = shop_location
     if target_data and shop_location in target_data.get("shops", {}):
         target_shop_display_name = target_data["shops"][shop_location].get("custom_name", shop_location)
 
+    attacker_name = attacker_data.get("display_name", f"Player {attacker_user_id}")
+    attacker_franchise = attacker_data.get("franchise_name", "")
+    franchise_text = f" ({attacker_franchise})" if attacker_franchise else ""
+
     attempt_time = time.time()
     if random.random() < game.SABOTAGE_SUCCESS_CHANCE:
         # SUCCESS
         logger.info(f"Sabotage SUCCESS by {attacker_user_id} against {target_user_id}'s {shop_location}")
-        shutdown_applied = game.apply_shop_shutdown(target_user_id, shop_location, game.SABOTAGE_DURATION_SECONDS)
-        if shutdown_applied:
-            await context.bot.send_message(chat_id=attacker_user_id, text=f"🐀 Success! Your agent planted the rat. {target_shop_display_name} shut down! No cost to you.")
-            try:
-                attacker_name = attacker_data.get("display_name", f"Player {attacker_user_id}")
-                attacker_franchise = attacker_data.get("franchise_name", "")
-                franchise_text = f" ({attacker_franchise})" if attacker_franchise else ""
-                
-                await context.bot.send_message(
-                    chat_id=target_user_id, 
-                    text=f"🚨 SABOTAGE ALERT! 🚨\n\nYour rival {attacker_name}{franchise_text} sent a health inspector who found a 'rat' at your {target_shop_display_name} shop! Shut down for 1 hour!"
-                )
-            except Exception as notify_err: logger.error(f"Failed to notify target {target_user_id} of successful sabotage: {notify_err}")
-        else:
-            await context.bot.send_message(chat_id=attacker_user_id, text=f"Agent found the shop ({target_shop_display_name}), but couldn't apply shutdown... Weird.")
+        shutdown_applied = await asyncio.to_thread(game.apply_shop_shutdown, target_user_id, shop_location, game.SABOTAGE_DURATION_SECONDS)
         attacker_data["last_sabotage_attempt_time"] = attempt_time
-    else:
-        # FAILURE
-        logger.warning(f"Sabotage FAILED by {attacker_user_id} against {target_user_id}")
-        if attacker_cash < sabotage_cost:
-             await context.bot.send_message(chat_id=attacker_user_id, text=f"Your agent failed, and you didn't even have the ${sabotage_cost:,.2f} to cover the bribe! Nothing happens.")
-             attacker_data["last_sabotage_attempt_time"] = attempt_time
-             return attacker_data # Return modified data to save cooldown
-
-        attacker_data["cash"] = attacker_cash - sabotage_cost
-        logger.info(f"Deducting sabotage cost ${sabotage_cost:,.2f} from attacker {attacker_user_id} due to failure.")
-        failure_base_message = f"Your crooked business attempt was found out! You had to pay a bribe of ${sabotage_cost:,.2f} to the press to keep it quiet."
-
-        if random.random() < game.SABOTAGE_BACKFIRE_CHANCE:
-            # BACKFIRE!
-            logger.warning(f"Sabotage BACKFIRED on attacker {attacker_user_id}!")
-            attacker_shops = attacker_data.get("shops", {})
-            shop_to_shutdown = game.get_top_earning_shop(attacker_shops)
-            if shop_to_shutdown:
-                game.apply_shop_shutdown(attacker_user_id, shop_to_shutdown, game.SABOTAGE_DURATION_SECONDS)
-                attacker_shop_display = attacker_data["shops"].get(shop_to_shutdown, {}).get("custom_name", shop_to_shutdown)
-                backfire_message = f"\n💥 To make matters worse, your agent ratted you out! Your own {attacker_shop_display} got shut down for an hour!"
-                logger.info(f"Sending sabotage backfire msg to {attacker_user_id}")
-                await context.bot.send_message(chat_id=attacker_user_id, text=failure_base_message + backfire_message)
-            else:
-                 no_shop_backfire_msg = failure_base_message + "\n💥 Your agent also ratted you out, but luckily you have no shops for them to shut down!"
-                 logger.info(f"Sending sabotage backfire (no shop) msg to {attacker_user_id}")
-                 await context.bot.send_message(chat_id=attacker_user_id, text=no_shop_backfire_msg)
-        else:
-            # Normal Failure
-            logger.info(f"Sending sabotage normal failure msg to {attacker_user_id}")
-            await context.bot.send_message(chat_id=attacker_user_id, text=failure_base_message)
-            try: # Notify Target of FAILED attempt
-                 attacker_name = attacker_data.get("display_name", f"Player {attacker_user_id}")
-                 attacker_franchise = attacker_data.get("franchise_name", "")
-                 franchise_text = f" ({attacker_franchise})" if attacker_franchise else ""
-                 
-                 await context.bot.send_message(
-                     chat_id=target_user_id, 
-                     text=f"⚠️ SABOTAGE ATTEMPT FOILED! ⚠️\n\n{attacker_name}{franchise_text} tried to send a health inspector to your {target_shop_display_name} shop, but your security caught them! No damage done."
-                 )
-            except Exception as notify_err: logger.error(f"Failed to notify target {target_user_id} of failed sabotage: {notify_err}")
-        attacker_data["last_sabotage_attempt_time"] = attempt_time
-
-    return attacker_data
+        if shutdown_applied:
+            return (
+                attacker_data,
+                [f"🐀 Success! Your agent planted the rat. {target_shop_display_name} shut down! No cost to you."],
+                f"🚨 SABOTAGE ALERT! 🚨\n\nYour rival {attacker_name}{franchise_text} sent a health inspector who found a 'rat' at your {target_shop_display_name} shop! Shut down for 1 hour!"
+            )
+        return attacker_data, [f"Agent found the shop ({target_shop_display_name}), but couldn't apply shutdown... Weird."], None
+
+    # FAILURE
+    logger.warning(f"Sabotage FAILED by {attacker_user_id} against {target_user_id}")
+    attacker_data["last_sabotage_attempt_time"] = attempt_time
+    if attacker_cash < sabotage_cost:
+         # Return modified data to save cooldown
+         return attacker_data, [f"Your agent failed, and you didn't even have the ${sabotage_cost:,.2f} to cover the bribe! Nothing happens."], None
+
+    attacker_data["cash"] = attacker_cash - sabotage_cost
+    logger.info(f"Deducting sabotage cost ${sabotage_cost:,.2f} from attacker {attacker_user_id} due to failure.")
+    failure_base_message = f"Your crooked business attempt was found out! You had to pay a bribe of ${sabotage_cost:,.2f} to the press to keep it quiet."
+
+    if random.random() < game.SABOTAGE_BACKFIRE_CHANCE:
+        # BACKFIRE!
+        logger.warning(f"Sabotage BACKFIRED on attacker {attacker_user_id}!")
+        attacker_shops = attacker_data.get("shops", {})
+        shop_to_shutdown = game.get_top_earning_shop(attacker_shops)
+        if shop_to_shutdown:
+            # Set on attacker_data directly: it is saved by the caller and would overwrite a separate save
+            attacker_shops[shop_to_shutdown]["shutdown_until"] = time.time() + game.SABOTAGE_DURATION_SECONDS
+            attacker_shop_display = attacker_data["shops"].get(shop_to_shutdown, {}).get("custom_name", shop_to_shutdown)
+            backfire_message = f"\n💥 To make matters worse, your agent ratted you out! Your own {attacker_shop_display} got shut down for an hour!"
+            return attacker_data, [failure_base_message + backfire_message], None
+        return attacker_data, [failure_base_message + "\n💥 Your agent also ratted you out, but luckily you have no shops for them to shut down!"], None
+
+    # Normal Failure: the target hears about the foiled attempt
+    return (
+        attacker_data,
+        [failure_base_message],
+        f"⚠️ SABOTAGE ATTEMPT FOILED! ⚠️\n\n{attacker_name}{franchise_text} tried to send a health inspector to your {target_shop_display_name} shop, but your security caught them! No damage done."
+    )
 
 # --- Command Handlers ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    logger.info("Entered start_command")
     if not user:
         logger.warning("start_command called without user info")
         return
 
-    await update_player_display_name(user.id, user) # Update name first
-    logger.info(f"User {user.id} ({user.username}) triggered /start.")
-
     try:
-        logger.info(f"Loading player data for {user.id}...")
-        player_data = game.load_player_data(user.id)
-        if not player_data: # Handle potential load failure
-             logger.error(f"Failed to load or initialize player data for {user.id} in start_command.")
-             await update.message.reply_text("Sorry, couldn't retrieve your game data. Please try again.")
-             return
-
-        logger.info(f"Player data loaded for {user.id}.")
-
-        # --- Check if summary needs to be shown --- #
-        last_seen_version = player_data.get("last_summary_seen_version")
-        if last_seen_version != CURRENT_SUMMARY_VERSION:
-            await send_change_summary(user.id, context)
-            # Update the local dict too, though save happens in send_change_summary
-            player_data["last_summary_seen_version"] = CURRENT_SUMMARY_VERSION
-        # --- End Summary Check --- #
-
-        # --- Check if player seems new based on default data --- #
-        # (e.g., exactly initial cash AND only the starting shop at level 1)
-        is_likely_new = (
-            player_data.get('total_income_earned', 0) < 0.01 and
-            len(player_data.get('shops', {})) == 1 and
-            game.INITIAL_SHOP_NAME in player_data.get('shops', {}) and
-            player_data['shops'][game.INITIAL_SHOP_NAME].get('level') == 1
-        )
+        # One load (the login upsert) and at most one save for everything /start changes
+        async with player_lock(user.id):
+            # Creates the row, stamps login time and refreshes the display name in one go
+            player_data, is_new_player = await asyncio.to_thread(game.touch_login, user.id, None, user.full_name or None)
+            if not player_data: # Handle potential load failure
+                 logger.error(f"Failed to load or initialize player data for {user.id} in start_command.")
+                 await update.message.reply_text("Sorry, couldn't retrieve your game data. Please try again.")
+                 return
 
-        if is_likely_new:
-             logger.info(f"Likely new player {user.id}, generating initial challenges.")
-             # Ensure stats are reset correctly for new players before generating
-             player_data['stats'] = {k: 0 for k in player_data.get('stats', {})} # Reset just in case
-             game.save_player_data(user.id, player_data) # Save reset stats before generating
-             # Generate challenges (will load/save again inside)
-             game.generate_new_challenges(user.id, 'daily')
-             game.generate_new_challenges(user.id, 'weekly')
-             # Reload data to get generated challenges for the status message
-             player_data = game.load_player_data(user.id)
-             if not player_data: # Handle potential load failure after generation
-                  logger.error(f"Failed to reload player data for {user.id} after challenge generation.")
-                  await update.message.reply_text("Sorry, couldn't retrieve updated game data. Please try /status.")
-                  return
+            logger.debug("start: user=%s new=%s", user.id, is_new_player)
+            needs_save = False
+
+            # --- Check if summary needs to be shown --- #
+            if player_data.get("last_summary_seen_version") != CURRENT_SUMMARY_VERSION:
+                await send_change_summary(user.id, context, player_data) # Sets the seen version on player_data
+                needs_save = True
+            # --- End Summary Check --- #
+
+            # --- Check if player is new, or seems new based on default data --- #
+            # (row created by another command first: no income AND only the starting shop at level 1)
+            is_likely_new = is_new_player or (
+                player_data.get('total_income_earned', 0) < 0.01 and
+                len(player_data.get('shops', {})) == 1 and
+                game.INITIAL_SHOP_NAME in player_data.get('shops', {}) and
+                player_data['shops'][game.INITIAL_SHOP_NAME].get('level') == 1
+            )
 
-        # --- Update login time and save --- #
-        player_data["last_login_time"] = game.time.time()
-        logger.info(f"Saving updated player data for {user.id}...")
-        game.save_player_data(user.id, player_data) # Save login time etc.
-        logger.info(f"Player data saved for {user.id}.")
+            # A brand-new row was inserted with its challenges; only rows made by other commands need them here
+            if is_likely_new and not is_new_player:
+                 logger.info("Likely new player %s, generating initial challenges.", user.id)
+                 # Generation also zeroes the tracked stats
+                 for timescale in game.CHALLENGE_TIMESCALES:
+                     player_data = await asyncio.to_thread(game.generate_new_challenges, user.id, timescale, player_data, False)
+                     if not player_data:
+                         break
+                 if not player_data: # Handle generation failure
+                      logger.error(f"Failed to generate initial challenges for {user.id}.")
+                      await update.message.reply_text("Sorry, couldn't retrieve updated game data. Please try /status.")
+                      return
+                 needs_save = True
+
+            if needs_save:
+                await asyncio.to_thread(game.save_player_data, user.id, player_data)
 
         # --- Send Welcome & Initial Status --- #
         reply_message = (
@@ -467,13 +639,10 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             f"- Dominate from Brooklyn to the whole freakin' planet by hittin' big pizza milestones.\n\n"
             f"Now, get cookin', capisce? Check your /status!"
         )
-        logger.info(f"Attempting to send welcome message to {user.id}...")
         await update.message.reply_html(reply_message)
-        logger.info(f"Welcome message sent successfully to {user.id}.")
 
         # --- Show Status & Prompt for Name --- #
-        logger.info(f"Sending initial status to player {user.id}")
-        status_message = game.format_status(player_data)
+        status_message = await asyncio.to_thread(game.format_status, player_data)
         await update.message.reply_html(status_message) # Show initial status
 
         # Prompt for name if not set
@@ -484,12 +653,17 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             )
         # --- End Prompt --- #
 
-        await check_and_notify_achievements(user.id, context)
+        await check_and_notify_achievements(user.id, context, player_data=player_data)
+        logger.info("User %s (%s) completed /start.", user.id, user.username)
 
     except Exception as e:
         logger.error(f"ERROR in start_command for user {user.id}: {e}", exc_info=True)
         await update.message.reply_text("Ay, somethin' went wrong gettin' ya started. Try /start again maybe?")
 
+# /status s:<key> (or sort:<key>) shop ordering
+_SORT_PREFIXES = ('s:', 'sort:')
+_VALID_SORT = frozenset({'name', 'level', 'cost', 'upgrade_cost'})
+
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user:
@@ -497,51 +671,29 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Wrap main logic in try-except
     try:
         await update_player_display_name(user.id, user)
-        logger.info(f"User {user.id} requested status.")
+        logger.info("User %s requested status.", user.id)
 
         # --- Parse Sort Argument --- #
         sort_key = 'name' # Default sort
         if context.args:
             arg_lower = context.args[0].lower()
-            if arg_lower.startswith('s:') or arg_lower.startswith('sort:'):
-                potential_key = arg_lower.split(':', 1)[1]
-                if potential_key in ['name', 'level', 'cost', 'upgrade_cost']:
+            if arg_lower.startswith(_SORT_PREFIXES):
+                potential_key = arg_lower.partition(':')[2]
+                if potential_key in _VALID_SORT:
                     sort_key = potential_key
-                    logger.info(f"User {user.id} requested status sorted by: {sort_key}")
+                    logger.info("User %s requested status sorted by: %s", user.id, sort_key)
                 else:
                      await update.message.reply_text(f"Unknown sort key '{potential_key}'. Use 'name', 'level', or 'cost'.")
                      sort_key = 'name' # Default back
         # --- End Sort Argument --- #
 
-        player_data = game.load_player_data(user.id)
+        player_data = await asyncio.to_thread(game.load_player_data, user.id)
         if not player_data:
              await update.message.reply_text("Couldn't load your data, boss. Try /start?")
              return
-        status_message = game.format_status(player_data, sort_by=sort_key)
-
-        # --- Create CORRECT Action Buttons --- #
-        keyboard = [
-            [
-                InlineKeyboardButton("💰 Collect Income", callback_data="main_collect"),
-                InlineKeyboardButton("⬆️ Upgrade Shop", callback_data="main_upgrade"),
-            ],
-            [
-                InlineKeyboardButton("🗺️ Expand Empire", callback_data="main_expand"),
-                InlineKeyboardButton("🎯 View Challenges", callback_data="main_challenges"),
-            ],
-            [
-                InlineKeyboardButton("🏆 Leaderboard", callback_data="main_leaderboard"),
-                InlineKeyboardButton("🔪 Sabotage Rival", callback_data="main_sabotage"), # <<< Added Sabotage
-            ],
-            [
-                InlineKeyboardButton("🍕 Buy Coins", callback_data="main_buycoins"),
-                InlineKeyboardButton("❓ Help Guide", callback_data="main_help"),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        # --- End Action Buttons --- #
+        status_message = await asyncio.to_thread(game.format_status, player_data, sort_by=sort_key)
 
-        await update.message.reply_html(status_message, reply_markup=reply_markup)
+        await update.message.reply_html(status_message, reply_markup=STATUS_MAIN_MARKUP)
 
     except Exception as e:
         logger.error(f"ERROR in status_command for user {user.id}: {e}", exc_info=True)
@@ -552,11 +704,12 @@ async def collect_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not user:
         return
     await update_player_display_name(user.id, user)
-    logger.info(f"User {user.id} requested collection.")
+    logger.info("User %s requested collection.", user.id)
 
     try:
-        # collect_income now returns: (collected_amount, completed_challenges, is_mafia_event, mafia_demand)
-        collected_amount, completed_challenges, is_mafia_event, mafia_demand = game.collect_income(user.id)
+        # collect_income returns: (collected_amount, completed_challenges, is_mafia_event, mafia_demand, newly_unlocked, tip_amount)
+        async with player_lock(user.id):
+            collected_amount, completed_challenges, is_mafia_event, mafia_demand, newly_unlocked, tip_amount = await asyncio.to_thread(game.collect_income, user.id)
 
         if is_mafia_event:
             # --- MAFIA EVENT --- # 
@@ -568,7 +721,7 @@ async def collect_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             # Store necessary info for the callback handler
             context.user_data['mafia_collect_amount'] = collected_amount
             context.user_data['mafia_demand'] = mafia_demand
-            logger.info(f"Storing user_data for Mafia event: collect={collected_amount}, demand={mafia_demand}")
+            logger.debug("Storing user_data for Mafia event: collect=%s, demand=%s", collected_amount, mafia_demand)
 
             keyboard = [
                 [
@@ -587,26 +740,20 @@ async def collect_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         elif collected_amount > 0.01:
             # --- NORMAL COLLECTION (with tip/pineapple) --- #
             tip_message, pineapple_message = "", ""
-            if random.random() < 0.15: # Tip chance
-                player_data_tip = game.load_player_data(user.id)
-                tip_amount = round(random.uniform(collected_amount * 0.05, collected_amount * 0.2) + random.uniform(5, 50), 2)
-                player_data_tip["cash"] = player_data_tip.get("cash", 0) + tip_amount
-                game.save_player_data(user.id, player_data_tip)
+            if tip_amount: # Already added to cash by collect_income
                 tip_message = f"\n🍕 Woah, some wiseguy just tipped you an extra ${tip_amount:.2f} for the 'best slice in town.' You're killin' it!"
-                logger.info(f"User {user.id} received a tip of ${tip_amount:.2f}")
 
             # Pineapple Easter Egg
-            pineapple_chance = 0.05
-            if random.random() < pineapple_chance:
+            if _rng.random() < PINEAPPLE_CHANCE:
                 pineapple_message = "\n🍍 Psst... Remember, putting pineapple on your pizza may get you sent to the gulag."
-                logger.info(f"User {user.id} triggered the pineapple easter egg.")
+                logger.debug("User %s triggered the pineapple easter egg.", user.id)
 
             # Send confirmation with comma formatting
             await update.message.reply_html(f"🤑 Pizza payday, baby! You just grabbed ${collected_amount:,.2f} fresh outta the oven!{tip_message}{pineapple_message}")
 
             # Notifications AFTER confirmation
             await send_challenge_notifications(user.id, completed_challenges, context)
-            await check_and_notify_achievements(user.id, context)
+            await notify_achievements(user.id, newly_unlocked, context)
         else:
             await update.message.reply_html("Nothin' to collect, boss. Ovens are cold!")
 
@@ -629,13 +776,12 @@ async def upgrade_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         # Args provided - attempt direct upgrade
         shop_name_arg = " ".join(context.args).strip()
-        player_data = game.load_player_data(user.id)
-        shops = player_data.get("shops", {})
-        target_shop_name = None
-        for name in shops.keys():
-            if name.lower() == shop_name_arg.lower():
-                target_shop_name = name
-                break
+        # Reject names that aren't a location at all before loading anything
+        target_shop_name = game.SHOP_LOOKUP.get(shop_name_arg.lower())
+        if target_shop_name:
+            player_data = await asyncio.to_thread(game.load_player_data, user.id)
+            if target_shop_name not in player_data.get("shops", {}):
+                target_shop_name = None
         if not target_shop_name:
             await update.message.reply_text(f"Whaddya talkin' about? You don't own '{shop_name_arg}'. Check /status or use /upgrade first.")
             return
@@ -652,21 +798,17 @@ async def expand_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # If arguments provided, handle direct expansion attempt (existing logic)
     if context.args:
         expansion_name_arg = " ".join(context.args).strip()
-        target_expansion_name = None
-        for name in game.EXPANSION_LOCATIONS.keys():
-            if name.lower() == expansion_name_arg.lower():
-                target_expansion_name = name
-                break
+        target_expansion_name = game.EXPANSION_LOOKUP.get(expansion_name_arg.lower())
         if not target_expansion_name:
             await update.message.reply_text(f"'{expansion_name_arg}'? Never heard of it. Check available spots via /expand (no args) or /status.")
             return
-        logger.info(f"User {user.id} attempting direct expand to '{target_expansion_name}'.")
+        logger.info("User %s attempting direct expand to '%s'.", user.id, target_expansion_name)
         await _process_expansion(update, context, user.id, target_expansion_name)
         return
 
     # --- No arguments: Show available expansions with buttons & costs/perf --- #
-    logger.info(f"User {user.id} requested expansion list.")
-    player_data = game.load_player_data(user.id)
+    logger.info("User %s requested expansion list.", user.id)
+    player_data = await asyncio.to_thread(game.load_player_data, user.id)
     if not player_data:
         await update.message.reply_text("Could not load your data.")
         return
@@ -677,42 +819,29 @@ async def expand_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("No new turf available right now, boss. Keep growin' the current spots!")
         return
 
-    keyboard = []
-    row = []
-    for i, loc in enumerate(available):
-        cost = game.get_expansion_cost(loc)
-        current_perf = game.get_current_performance_multiplier(loc)
-        perf_emoji = "📈" if current_perf > 1.1 else "📉" if current_perf < 0.9 else "🤷‍♂️"
-        # Show performance and cost on button
-        button_text = f"{loc} {perf_emoji}x{current_perf:.1f} (${cost:,.0f})"
-        row.append(InlineKeyboardButton(button_text, callback_data=f"expand_{loc}"))
-        if (i + 1) % 2 == 0:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    expansion_meta = await asyncio.to_thread(game.get_expansion_meta_bulk, available)
+    reply_markup = expansion_markup(tuple(expansion_meta.items()))
     await update.message.reply_text("Ready to expand the empire? Choose your next conquest (Perf/Cost shown):", reply_markup=reply_markup)
 
 # --- Helper for processing expansion --- #
-async def _process_expansion(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, target_expansion_name: str):
+_EXPAND_SUCCESS_MESSAGES = (
+    "🗽 Fuggedaboutit! Your pizza empire just hit {location}!",
+    "🗺️ You've outgrown the neighborhood? Time to take this pizza circus to {location}!",
+    "🍕 Plantin' the flag in {location}! More ovens, more money!",
+)
+
+async def _process_expansion(update: Update | CallbackQuery, context: ContextTypes.DEFAULT_TYPE, user_id: int, target_expansion_name: str):
     """Internal function to handle the actual expansion logic and feedback."""
     logger.info(f"Entered _process_expansion for user {user_id}, target {target_expansion_name}") # Added log
+    # Correctly check if the update object itself is the CallbackQuery
+    is_callback = isinstance(update, CallbackQuery)
+    logger.debug(f"_process_expansion: is_callback = {is_callback}") # Added log
     try:
-        success, message, completed_challenges = game.expand_shop(user_id, target_expansion_name)
-        # Correctly check if the update object itself is the CallbackQuery
-        from telegram import CallbackQuery # Local import for type check
-        is_callback = isinstance(update, CallbackQuery)
-        logger.debug(f"_process_expansion: is_callback = {is_callback}") # Added log
+        async with player_lock(user_id):
+            success, message, completed_challenges, newly_unlocked = await asyncio.to_thread(game.expand_shop, user_id, target_expansion_name)
 
         if success:
-            fun_messages = [
-                 f"🗽 Fuggedaboutit! Your pizza empire just hit {target_expansion_name}!",
-                 f"🗺️ You've outgrown the neighborhood? Time to take this pizza circus to {target_expansion_name}!",
-                 f"🍕 Plantin' the flag in {target_expansion_name}! More ovens, more money!"
-            ]
-            response_message = random.choice(fun_messages)
+            response_message = random.choice(_EXPAND_SUCCESS_MESSAGES).format(location=target_expansion_name)
             if is_callback:
                  logger.debug("Attempting to edit message for callback (success).")
                  await update.edit_message_text(text=response_message, parse_mode="HTML") # Use update directly
@@ -721,7 +850,7 @@ async def _process_expansion(update: Update, context: ContextTypes.DEFAULT_TYPE,
                  await context.bot.send_message(chat_id=user_id, text=response_message, parse_mode="HTML")
 
             await send_challenge_notifications(user_id, completed_challenges, context)
-            await check_and_notify_achievements(user_id, context)
+            await notify_achievements(user_id, newly_unlocked, context)
         else:
             # Send the error message from game.expand_shop
             if is_callback:
@@ -734,10 +863,6 @@ async def _process_expansion(update: Update, context: ContextTypes.DEFAULT_TYPE,
     except Exception as e:
         logger.error(f"Error during _process_expansion for {user_id}, location {target_expansion_name}: {e}", exc_info=True)
         error_message = "Whoa there! Somethin' went sideways tryin' to expand."
-        # Correctly check if the original trigger was a callback
-        from telegram import CallbackQuery # Local import for type check
-        is_callback = isinstance(update, CallbackQuery)
-        logger.debug(f"_process_expansion exception: is_callback = {is_callback}")
         if is_callback:
              # Use update.message.chat_id for sending fallback if edit fails
              chat_id_to_reply = update.message.chat_id if update.message else user_id
@@ -776,7 +901,7 @@ async def expansion_choice_callback(update: Update, context: ContextTypes.DEFAUL
              logger.error(f"Failed to edit message on invalid callback data: {edit_err}")
         return
 
-    logger.info(f"User {user.id} chose to expand to {target_location} via button.")
+    logger.info("User %s chose to expand to %s via button.", user.id, target_location)
     # Pass the query object to the helper
     await _process_expansion(query, context, user.id, target_location)
     # --- Show Status Again AFTER processing --- #
@@ -784,58 +909,67 @@ async def expansion_choice_callback(update: Update, context: ContextTypes.DEFAUL
     await asyncio.sleep(1.5)  # Add delay to let player read the message
     await _send_status_update(query.message.chat_id, user.id, context)
 
+_CHALLENGES_HEADER = "<b>--- Your Active Challenges ---</b>"
+_CHALLENGE_TEMPLATE = "\n<b>{ts_cap} Challenge:</b>\n  - {desc}{status}\n    Reward: {reward_value:,} {reward_type}"
+_CHALLENGE_MISSING_TEMPLATE = "\n<b>{ts_cap} Challenge:</b>\n  Error generating challenge. Check logs or try again later."
+
+def format_challenges(player_data: dict) -> str:
+    """Renders the daily and weekly challenge sections shown by /challenges and the menu button."""
+    # Loaded/saved player data always has stats and a slot per timescale (game.normalize_player_data)
+    stats = player_data["stats"]
+    active_challenges = player_data["active_challenges"]
+    challenge_progress = player_data["challenge_progress"]
+    sections = [_CHALLENGES_HEADER]
+    for timescale in game.CHALLENGE_TIMESCALES:
+        challenge = active_challenges[timescale]
+        if not challenge:
+            # This case should ideally not happen now, but keep as fallback
+            sections.append(_CHALLENGE_MISSING_TEMPLATE.format_map({"ts_cap": timescale.capitalize()}))
+            continue
+        goal = challenge["goal"]
+        if challenge_progress[timescale].get(challenge["id"], False):
+            status = " ✅ Completed!"
+        elif isinstance(goal, (int, float)):
+            status = f" ({stats.get(challenge['metric'], 0):,.0f} / {goal:,.0f})"
+        else:
+            status = ""
+        sections.append(_CHALLENGE_TEMPLATE.format_map({
+            "ts_cap": timescale.capitalize(),
+            "desc": challenge["description"],
+            "status": status,
+            "reward_value": challenge["reward_value"],
+            "reward_type": challenge["reward_type"].upper(),
+        }))
+    return "\n".join(sections)
+
+async def ensure_challenges(user_id: int) -> dict | None:
+    """Loads the player once under their lock, generates any missing daily/weekly challenge on that same
+       copy and saves once. Returns the up-to-date player data (None if generation failed)."""
+    async with player_lock(user_id):
+        player_data = await asyncio.to_thread(game.load_player_data, user_id)
+        missing = [ts for ts in game.CHALLENGE_TIMESCALES if player_data["active_challenges"][ts] is None]
+        if not missing:
+            return player_data
+        for timescale in missing:
+            logger.info(f"{timescale.capitalize()} challenge missing for {user_id}, generating on demand.")
+            player_data = await asyncio.to_thread(game.generate_new_challenges, user_id, timescale, player_data, False)
+            if player_data is None:
+                return None
+        await asyncio.to_thread(game.save_player_data, user_id, player_data)
+    return player_data
+
 async def challenges_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user:
         return
     await update_player_display_name(user.id, user) # <-- Update name on challenges
-    logger.info(f"User {user.id} requested challenges.")
-    player_data = game.load_player_data(user.id)
-    needs_save = False # Flag to check if we modified data
-
-    # --- Generate challenges on demand if missing --- #
-    if player_data.get("active_challenges", {}).get("daily") is None:
-        logger.info(f"Daily challenge missing for {user.id}, generating on demand.")
-        game.generate_new_challenges(user.id, 'daily')
-        needs_save = True # generate_new_challenges saves, but we need to reload
-
-    if player_data.get("active_challenges", {}).get("weekly") is None:
-        logger.info(f"Weekly challenge missing for {user.id}, generating on demand.")
-        game.generate_new_challenges(user.id, 'weekly')
-        needs_save = True
-
-    # Reload data if we generated any challenges
-    if needs_save:
-        logger.info(f"Reloading player data for {user.id} after on-demand generation.")
-        player_data = game.load_player_data(user.id)
-    # --- End generation on demand --- #
-
-    stats = player_data.get("stats", {})
-    active_challenges = player_data.get("active_challenges", {})
-    challenge_progress = player_data.get("challenge_progress", {})
-
-    lines = ["<b>--- Your Active Challenges ---</b>"]
-
-    for timescale in ["daily", "weekly"]:
-        challenge = active_challenges.get(timescale)
-        lines.append(f"\n<b>{timescale.capitalize()} Challenge:</b>")
-        if challenge:
-            challenge_id = challenge["id"]
-            metric = challenge["metric"]
-            goal = challenge["goal"]
-            current_prog = stats.get(metric, 0)
-            is_complete = challenge_progress.get(timescale, {}).get(challenge_id, False)
-
-            progress_str = f" ({current_prog:,.0f} / {goal:,.0f})" if isinstance(goal, (int, float)) else ""
-            status_str = " ✅ Completed!" if is_complete else progress_str
-
-            lines.append(f"  - {challenge['description']}{status_str}")
-            lines.append(f"    Reward: {challenge['reward_value']:,} {challenge['reward_type'].upper()}")
-        else:
-            # This case should ideally not happen now, but keep as fallback
-            lines.append("  Error generating challenge. Check logs or try again later.")
+    logger.info("User %s requested challenges.", user.id)
+    player_data = await ensure_challenges(user.id)
+    if not player_data:
+        await update.message.reply_text("Could not load challenge data.")
+        return
 
-    await update.message.reply_html("\n".join(lines))
+    await update.message.reply_html(format_challenges(player_data))
     
     # Show status after viewing challenges
     chat_id = update.effective_chat.id if update.effective_chat else user.id
@@ -843,54 +977,85 @@ async def challenges_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await _send_status_update(chat_id, user.id, context)
 
 # --- Consolidated Leaderboard Command --- #
+# Rankings move slowly, so leaderboard rows are shared by every request for this many seconds
+LEADERBOARD_CACHE_TTL_SECONDS = 45
+_leaderboard_cache: dict[tuple[str, int], tuple[float, list]] = {}
+_leaderboard_locks: dict[tuple[str, int], asyncio.Lock] = {} # One per (kind, limit); a miss only holds up its own board
+
+def _fresh_leaderboard(key: tuple[str, int]) -> list | None:
+    """Cached rows for key if still within the TTL, else None."""
+    cached = _leaderboard_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < LEADERBOARD_CACHE_TTL_SECONDS:
+        return cached[1]
+    return None
+
+async def _cached_leaderboard(kind: str, fetcher, limit: int) -> list:
+    """Returns fetcher(limit=limit) rows, refetched at most once per TTL; concurrent misses for the same board
+       wait for one query. Empty results (also what the fetchers return on DB errors) aren't cached."""
+    key = (kind, limit)
+    rows = _fresh_leaderboard(key)
+    if rows is not None:
+        return rows
+    async with _leaderboard_locks.setdefault(key, asyncio.Lock()):
+        rows = _fresh_leaderboard(key) # Another request may have refetched while we waited
+        if rows is not None:
+            return rows
+        rows = await asyncio.to_thread(fetcher, limit=limit)
+        if rows:
+            _leaderboard_cache[key] = (time.monotonic(), rows)
+        return rows
+
+def _render_leaderboard(top_income_players: list, performance: dict[str, float]) -> str:
+    """HTML for /leaderboard: the total-income top 10 and the same players ranked by current income rate."""
+    income_rate_data = [(player_id, display_name, game.calculate_income_rate(shops, performance))
+                        for player_id, display_name, _, _, _, shops in top_income_players]
+    income_rate_data.sort(key=lambda x: x[2], reverse=True)
+
+    lines = ["<b>🏆 Global Pizza Empire Leaderboard 🏆</b>\n(Based on Total Income Earned)\n"]
+    if not top_income_players:
+        lines.append("<i>No income earned yet!</i>")
+    else:
+        for player_id, display_name, total_income, rank, _, _ in top_income_players:
+            name = display_name or f"Player {player_id}"
+            if len(name) > 25: name = name[:22] + "..."
+            lines.append(f"{rank}. {name} - ${game.format_money(total_income)}")
+
+    lines.append("\n<b>💰 Income Rate Leaderboard 💰</b>\n($/sec)\n")
+    if not income_rate_data:
+        lines.append("<i>No income rates calculated!</i>")
+    else:
+        for rank, (player_id, display_name, rate) in enumerate(income_rate_data, start=1):
+            name = display_name or f"Player {player_id}"
+            if len(name) > 25: name = name[:22] + "..."
+            lines.append(f"{rank}. {name} - ${rate:.2f}/sec")
+    return "\n".join(lines)
+
+# (rows, html) of the last render; reused for as long as _cached_leaderboard keeps handing out the same rows
+_leaderboard_render: tuple[list, str] | None = None
+
+async def _leaderboard_html() -> str:
+    """The rendered leaderboard, re-rendered only when the cached rows are refreshed."""
+    global _leaderboard_render
+    top_income_players = await _cached_leaderboard("income", game.get_leaderboard_data, 10)
+    rendered = _leaderboard_render
+    if rendered is not None and rendered[0] is top_income_players:
+        return rendered[1]
+    performance = await asyncio.to_thread(game.get_performance_multipliers, game.EXPANSION_LOCATIONS)
+    html_text = _render_leaderboard(top_income_players, performance)
+    if top_income_players:
+        _leaderboard_render = (top_income_players, html_text)
+    return html_text
+
 async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Displays both global leaderboards (Total Income & Current Cash)."""
     user = update.effective_user
     if not user:
         return
-    logger.info(f"User {user.id} requested combined leaderboard.")
+    logger.info("User %s requested combined leaderboard.", user.id)
     await update_player_display_name(user.id, user)
 
     try:
-        # --- Fetch Data --- #
-        top_income_players = game.get_leaderboard_data(limit=10)
-        
-        # --- Calculate income rates for all players --- #
-        income_rate_data = []
-        for player_id, display_name, _ in top_income_players:
-            player_data = game.load_player_data(player_id)
-            if player_data:
-                shops = player_data.get("shops", {})
-                income_rate = game.calculate_income_rate(shops)
-                income_rate_data.append((player_id, display_name, income_rate))
-        
-        # Sort by income rate
-        income_rate_data.sort(key=lambda x: x[2], reverse=True)
-        income_rate_data = income_rate_data[:10]  # Limit to top 10
-
-        # --- Format Income Leaderboard --- #
-        lines = ["<b>🏆 Global Pizza Empire Leaderboard 🏆</b>\n(Based on Total Income Earned)\n"]
-        if not top_income_players:
-            lines.append("<i>No income earned yet!</i>")
-        else:
-            for i, (player_id, display_name, total_income) in enumerate(top_income_players):
-                rank = i + 1
-                name = display_name or f"Player {player_id}"
-                if len(name) > 25: name = name[:22] + "..."
-                lines.append(f"{rank}. {name} - ${total_income:,.2f}")
-
-        # --- Format Income Rate Leaderboard --- #
-        lines.append("\n<b>💰 Income Rate Leaderboard 💰</b>\n($/sec)\n")
-        if not income_rate_data:
-            lines.append("<i>No income rates calculated!</i>")
-        else:
-            for i, (player_id, display_name, rate) in enumerate(income_rate_data):
-                rank = i + 1
-                name = display_name or f"Player {player_id}"
-                if len(name) > 25: name = name[:22] + "..."
-                lines.append(f"{rank}. {name} - ${rate:.2f}/sec")
-
-        await update.message.reply_html("\n".join(lines))
+        await update.message.reply_html(await _leaderboard_html())
         
         # Show status after viewing leaderboard
         chat_id = update.effective_chat.id if update.effective_chat else user.id
@@ -941,6 +1106,22 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await _send_status_update(chat_id, user.id, context)
 
 # --- Payment Handlers ---
+async def send_coin_invoices(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> list[str]:
+    """Sends every coin pack's invoice at once instead of one round trip after another.
+       Returns the names of the packs whose invoice failed."""
+    results = await asyncio.gather(
+        *(context.bot.send_invoice(chat_id=user_id, payload=f"{payload_prefix}{user_id}", **invoice)
+          for name, payload_prefix, invoice in _INVOICE_TEMPLATES.values()),
+        return_exceptions=True
+    )
+    failed = []
+    for (pack_id, (name, *_)), result in zip(_INVOICE_TEMPLATES.items(), results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send invoice for {pack_id} to {user_id}: {result}", exc_info=result)
+            failed.append(name)
+    logger.info(f"Sent {len(results) - len(failed)} coin pack invoices to {user_id}")
+    return failed
+
 async def buy_coins_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user # Get user object
     if not user:
@@ -952,37 +1133,26 @@ async def buy_coins_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "My owner still hasn't signed up for a Stripe account. If you send him funds, he will send you a bajillion pizza coins."
         )
         return
-    for pack_id, (name, description, price_cents, coin_amount) in game.PIZZA_COIN_PACKS.items():
-        title = f"{name} ({coin_amount} Coins)"
-        payload = f"BUY_{pack_id.upper()}_{user.id}"
-        currency = "USD"
-        prices = [LabeledPrice(label=name, amount=price_cents)]
-        logger.info(f"Sending invoice for {pack_id} to chat {user.id}")
-        try:
-            await context.bot.send_invoice(
-                chat_id=user.id, title=title, description=description, payload=payload,
-                provider_token=PAYMENT_PROVIDER_TOKEN, currency=currency, prices=prices,
-            )
-        except Exception as e:
-            logger.error(f"Failed to send invoice for {pack_id} to {user.id}: {e}", exc_info=True)
-            await update.message.reply_text(f"Sorry, couldn't start the purchase for {name}. Please try again.")
+    for name in await send_coin_invoices(context, user.id):
+        await update.message.reply_text(f"Sorry, couldn't start the purchase for {name}. Please try again.")
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.pre_checkout_query
-    payload_parts = query.invoice_payload.split('_')
-    if len(payload_parts) != 3 or payload_parts[0] != 'BUY':
+    payload_match = _PAYLOAD_RE.match(query.invoice_payload)
+    if not payload_match:
         logger.warning(f"Invalid payload received in precheckout: {query.invoice_payload}")
         await query.answer(ok=False, error_message="Something went wrong with your order details.")
         return
-    pack_id = payload_parts[1].lower()
-    user_id_from_payload = int(payload_parts[2])
+    pack_id, user_id_str = payload_match.group(1, 2)
+    pack_id = pack_id.lower()
+    user_id_from_payload = int(user_id_str)
     if query.from_user.id != user_id_from_payload:
          logger.warning(f"User ID mismatch in precheckout! Query from {query.from_user.id}, payload for {user_id_from_payload}")
          await query.answer(ok=False, error_message="User mismatch, cannot proceed.")
          return
-    pack_details = game.get_pizza_coin_pack(pack_id)
-    if not pack_details or query.total_amount != pack_details[2]:
-        logger.warning(f"Pack details mismatch or amount changed for {pack_id}. Query: {query.total_amount}, Expected: {pack_details[2] if pack_details else 'N/A'}")
+    pack = game.PACKS_BY_ID_AMOUNT.get((pack_id, query.total_amount))
+    if not pack:
+        logger.warning(f"Pack details mismatch or amount changed for {pack_id}. Query: {query.total_amount}")
         await query.answer(ok=False, error_message="Sorry, the price or item details have changed. Please try initiating the purchase again.")
     else:
         logger.info(f"PreCheckout OK for user {query.from_user.id}, pack {pack_id}")
@@ -1001,16 +1171,15 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     logger.info(
         f"Successful payment received! User: {user_id}, Amount: {amount_paid} {currency}, Payload: {payload}"
     )
-    payload_parts = payload.split('_')
-    pack_id = None
-    if len(payload_parts) == 3 and payload_parts[0] == 'BUY':
-        pack_id = payload_parts[1].lower()
+    payload_match = _PAYLOAD_RE.match(payload)
+    pack_id = payload_match.group(1).lower() if payload_match else None
     if pack_id:
         pack_details = game.get_pizza_coin_pack(pack_id)
         if pack_details:
-            _, _, _, coin_amount = pack_details
+            coin_amount = pack_details.coin_amount
             logger.info(f"Crediting {coin_amount} coins for pack {pack_id} to user {user_id}")
-            game.credit_pizza_coins(user_id, coin_amount)
+            async with player_lock(user_id): # A handler's in-flight copy would otherwise save over the coins
+                await asyncio.to_thread(game.credit_pizza_coins, user_id, coin_amount)
             await update.message.reply_text(
                 f"Thank you for your purchase! {coin_amount} Pizza Coins 🍕 have been added to your account."
             )
@@ -1028,7 +1197,7 @@ async def boost_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user = update.effective_user
     if not user:
         return
-    message = game.use_pizza_coins_for_speedup(user.id, "instant_collect")
+    message = await asyncio.to_thread(game.use_pizza_coins_for_speedup, user.id, "instant_collect")
     await update.message.reply_text(message)
 
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1084,30 +1253,27 @@ async def mafia_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
     # --- Update Player Data --- #
     try:
-        player_data = game.load_player_data(user.id)
-        if not player_data:
-             raise ValueError("Failed to load player data after Mafia interaction.")
+        async with player_session(user.id) as player_data:
 
-        if cash_to_add > 0:
-            player_data["cash"] = player_data.get("cash", 0) + cash_to_add
-            player_data["total_income_earned"] = player_data.get("total_income_earned", 0) + cash_to_add
-            # Only track income stat if they actually received cash
-            if "session_income" in challenge_metrics_to_update:
-                 player_data["stats"]["session_income"] = player_data["stats"].get("session_income", 0) + cash_to_add
+            if cash_to_add > 0:
+                player_data["cash"] = player_data.get("cash", 0) + cash_to_add
+                player_data["total_income_earned"] = player_data.get("total_income_earned", 0) + cash_to_add
+                # Only track income stat if they actually received cash
+                if "session_income" in challenge_metrics_to_update:
+                     player_data["stats"]["session_income"] = player_data["stats"].get("session_income", 0) + cash_to_add
 
-        # Always track collection attempt stat
-        player_data["stats"]["session_collects"] = player_data["stats"].get("session_collects", 0) + 1
+            # Always track collection attempt stat
+            player_data["stats"]["session_collects"] = player_data["stats"].get("session_collects", 0) + 1
 
-        # Check challenges based on what actually happened
-        completed_challenges = game.update_challenge_progress(player_data, challenge_metrics_to_update)
-
-        game.save_player_data(user.id, player_data)
+            # Check challenges based on what actually happened
+            completed_challenges = game.update_challenge_progress(player_data, challenge_metrics_to_update)
+            # Check achievements on the same dict so one save covers everything
+            newly_unlocked, player_data = game.check_achievements(player_data, game.COLLECT_ACHIEVEMENT_METRICS)
 
         # --- Notify User --- #
         await query.edit_message_text(text=outcome_message) # Update the original message
         await send_challenge_notifications(user.id, completed_challenges, context)
-        # Check achievements based on final state
-        await check_and_notify_achievements(user.id, context)
+        await notify_achievements(user.id, newly_unlocked, context)
         # --- Show Status Again --- #
         logger.debug("Mafia event resolved, showing status again.")
         await asyncio.sleep(1.5)  # Add delay to let player read the message
@@ -1145,22 +1311,17 @@ async def setname_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Basic sanitization: Remove potential HTML tags just in case
     # A more robust solution might involve allowing specific safe tags or using a library
-    sanitized_name = re.sub('<[^<]+?>', '', new_name) # Strip HTML tags
+    sanitized_name = new_name if '<' not in new_name else _HTML_TAG_RE.sub('', new_name) # Strip HTML tags; most names have none
     if not sanitized_name:
          await update.message.reply_text("C'mon, give it a real name!")
          return
 
     logger.info(f"User {user.id} attempting to set franchise name to: {sanitized_name}")
     try:
-        player_data = game.load_player_data(user.id)
-        if not player_data:
-             await update.message.reply_text("Could not load your data to set the name.")
-             return
-
-        player_data["franchise_name"] = sanitized_name
-        game.save_player_data(user.id, player_data)
-        # Use html.escape for displaying user-provided name safely in HTML context
-        await update.message.reply_html(f"Alright, your pizza empire shall henceforth be known as: <b>{html.escape(sanitized_name)}</b>! Good luck!")
+        async with player_session(user.id) as player_data:
+            player_data["franchise_name"] = sanitized_name
+        # Escape the user-provided name for the HTML reply
+        await update.message.reply_html(f"Alright, your pizza empire shall henceforth be known as: <b>{html.escape(sanitized_name, quote=False)}</b>! Good luck!")
 
     except Exception as e:
         logger.error(f"Error setting franchise name for {user.id}: {e}", exc_info=True)
@@ -1192,7 +1353,7 @@ async def renameshop_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # Basic sanitization
-    sanitized_new_name = re.sub('<[^<]+?>', '', new_custom_name)
+    sanitized_new_name = new_custom_name if '<' not in new_custom_name else _HTML_TAG_RE.sub('', new_custom_name)
     if not sanitized_new_name:
          await update.message.reply_text("C'mon, give it a real name (no funny HTML stuff)!")
          return
@@ -1200,29 +1361,26 @@ async def renameshop_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info(f"User {user.id} attempting to rename shop at '{location_arg}' to: {sanitized_new_name}")
 
     try:
-        player_data = game.load_player_data(user.id)
-        if not player_data:
-             await update.message.reply_text("Could not load your data to rename the shop.")
-             return
+        async with player_lock(user.id):
+            player_data = await asyncio.to_thread(game.load_player_data, user.id)
+            if not player_data:
+                 await update.message.reply_text("Could not load your data to rename the shop.")
+                 return
 
-        shops = player_data.get("shops", {})
-        target_location_key = None
-        # Find the location key case-insensitively
-        for loc_key in shops.keys():
-            if loc_key.lower() == location_arg.lower():
-                target_location_key = loc_key
-                break
+            shops = player_data.get("shops", {})
+            # Find the location key case-insensitively
+            target_location_key = game.SHOP_LOOKUP.get(location_arg.lower())
 
-        if not target_location_key:
-            await update.message.reply_text(f"You don't own a shop at '{location_arg}'. Check /status.")
-            return
+            if target_location_key not in shops:
+                await update.message.reply_text(f"You don't own a shop at '{location_arg}'. Check /status.")
+                return
 
-        # Update the custom name
-        shops[target_location_key]["custom_name"] = sanitized_new_name
-        player_data["shops"] = shops # Ensure the shops dict is updated in player_data
-        game.save_player_data(user.id, player_data)
+            # Update the custom name
+            shops[target_location_key]["custom_name"] = sanitized_new_name
+            player_data["shops"] = shops # Ensure the shops dict is updated in player_data
+            await asyncio.to_thread(game.save_player_data, user.id, player_data)
 
-        await update.message.reply_html(f"Alright, your shop at {target_location_key} is now proudly called: <b>{html.escape(sanitized_new_name)}</b>!")
+        await update.message.reply_html(f"Alright, your shop at {target_location_key} is now proudly called: <b>{html.escape(sanitized_new_name, quote=False)}</b>!")
 
     except Exception as e:
         logger.error(f"Error renaming shop for {user.id}: {e}", exc_info=True)
@@ -1236,6 +1394,13 @@ SABOTAGE_BACKFIRE_CHANCE = 0.25 # Chance of backfire *if* the initial attempt fa
 SABOTAGE_DURATION_SECONDS = 3600
 SABOTAGE_COOLDOWN_SECONDS = 900
 
+def _check_sabotage_cooldown(attacker_data: dict, now: float) -> str | None:
+    """Remaining sabotage cooldown as H:MM:SS, or None when the attacker may try again."""
+    time_since_last = now - attacker_data.get("last_sabotage_attempt_time", 0.0)
+    if time_since_last >= game.SABOTAGE_COOLDOWN_SECONDS:
+        return None
+    return str(timedelta(seconds=int(game.SABOTAGE_COOLDOWN_SECONDS - time_since_last)))
+
 async def sabotage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Starts the sabotage process by showing potential targets and explaining risks."""
     user = update.effective_user
@@ -1243,21 +1408,18 @@ async def sabotage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text("Need user info to start sabotage.")
         return
     await update_player_display_name(user.id, user)
-    logger.info(f"User {user.id} initiated sabotage command.")
+    logger.info("User %s initiated sabotage command.", user.id)
 
     attacker_user_id = user.id
-    attacker_data = game.load_player_data(attacker_user_id)
+    attacker_data = await asyncio.to_thread(game.load_player_data, attacker_user_id)
     if not attacker_data:
         await update.message.reply_text("Couldn't load your data.")
         return
 
     # --- Check Cooldown First --- #
-    now = time.time()
-    last_attempt_time = attacker_data.get("last_sabotage_attempt_time", 0.0)
-    time_since_last = now - last_attempt_time
-    if time_since_last < SABOTAGE_COOLDOWN_SECONDS:
-         remaining_cooldown = timedelta(seconds=int(SABOTAGE_COOLDOWN_SECONDS - time_since_last))
-         await update.message.reply_text(f"Your agents need to lay low! Sabotage available again in {str(remaining_cooldown).split('.')[0]}.")
+    remaining_cooldown = _check_sabotage_cooldown(attacker_data, time.time())
+    if remaining_cooldown:
+         await update.message.reply_text(f"Your agents need to lay low! Sabotage available again in {remaining_cooldown}.")
          return
     # --- End Cooldown Check --- #
 
@@ -1268,16 +1430,17 @@ async def sabotage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     # Show Target List
     try:
         # Get potential targets based on income rate
-        potential_targets = game.get_cash_leaderboard_data(limit=20)
+        potential_targets = await _cached_leaderboard("cash", game.get_cash_leaderboard_data, 20)
         income_rate_data = []
+        performance = await asyncio.to_thread(game.get_performance_multipliers, game.EXPANSION_LOCATIONS)
         
         # Calculate income rates for potential targets
         for player_id, player_name, _ in potential_targets:
             if player_id != user.id:  # Skip the current user
-                player_data = game.load_player_data(player_id)
+                player_data = await asyncio.to_thread(game.load_player_data, player_id)
                 if player_data:
                     shops = player_data.get("shops", {})
-                    income_rate = game.calculate_income_rate(shops)
+                    income_rate = game.calculate_income_rate(shops, performance)
                     income_rate_data.append((player_id, player_name, income_rate))
         
         # Sort by income rate and get top 20
@@ -1332,19 +1495,20 @@ async def sabotage_choice_callback(update: Update, context: ContextTypes.DEFAULT
     attacker_user_id = user.id
     if target_user_id == attacker_user_id:
         await query.edit_message_text("Can't sabotage yourself!"); return
-    target_data = game.load_player_data(target_user_id)
+    target_data = await asyncio.to_thread(game.load_player_data, target_user_id)
     target_name = target_data.get("display_name") or f"Player {target_user_id}"
     target_shops = target_data.get("shops", {})
     if not target_data or not target_shops:
         await query.edit_message_text(f"{target_name} has no shops to sabotage!"); return
     keyboard = []
+    performance = await asyncio.to_thread(game.get_performance_multipliers, target_shops)
     shop_list = sorted(target_shops.items(), key=lambda item: item[1].get('level', 1), reverse=True)
     for location, shop_data in shop_list:
         custom_name = shop_data.get("custom_name", location)
         level = shop_data.get("level", 1)
         
         # Calculate the income rate for this specific shop
-        shop_rate = game.get_shop_income_rate(location, level)
+        shop_rate = game.get_shop_income_rate(location, level, performance[location])
         
         display_name = f"{custom_name} ({location})" if custom_name != location else location
         callback_data = f"sabo_shop_{target_user_id}_{location}"
@@ -1374,23 +1538,41 @@ async def sabotage_shop_choice_callback(update: Update, context: ContextTypes.DE
         logger.warning(f"Invalid sabotage shop choice callback data: {query.data}")
         await query.edit_message_text("Invalid shop choice."); return
     attacker_user_id = user.id
-    attacker_data = game.load_player_data(attacker_user_id)
-    if not attacker_data:
-        await query.edit_message_text("Error loading your data."); return
-    now = time.time()
-    last_attempt_time = attacker_data.get("last_sabotage_attempt_time", 0.0)
-    time_since_last = now - last_attempt_time
-    if time_since_last < game.SABOTAGE_COOLDOWN_SECONDS:
-         remaining_cooldown = timedelta(seconds=int(game.SABOTAGE_COOLDOWN_SECONDS - time_since_last))
-         await query.edit_message_text(f"Agents laying low! Cooldown: {str(remaining_cooldown).split('.')[0]}."); return
-    target_name = game.find_display_name_by_id(target_user_id) or f"Player {target_user_id}"
-    shop_display = game.get_shop_custom_name(target_user_id, shop_location) or shop_location
+    if target_user_id == attacker_user_id:
+        await query.edit_message_text("Can't sabotage yourself!"); return
+    # One load and one save of the attacker for the cooldown check, cost and cooldown stamp. The target's
+    # lock is held too (apply_shop_shutdown saves them); both are taken in user id order so that two players
+    # sabotaging each other at once can't deadlock. Only the load/modify/save runs under the locks: every
+    # Telegram call waits until they are released, so a slow send can't stall either player's own commands.
+    error_reply = None
+    outcome = None
+    async with AsyncExitStack() as locks:
+        for locked_user_id in sorted((attacker_user_id, target_user_id)):
+            await locks.enter_async_context(player_lock(locked_user_id))
+        attacker_data = await asyncio.to_thread(game.load_player_data, attacker_user_id)
+        if not attacker_data:
+            error_reply = "Error loading your data."
+        elif remaining_cooldown := _check_sabotage_cooldown(attacker_data, time.time()):
+            error_reply = f"Agents laying low! Cooldown: {remaining_cooldown}."
+        else:
+            logger.info(f"User {attacker_user_id} confirmed sabotage attempt against {target_user_id}'s shop: {shop_location}")
+            outcome = await _process_sabotage(attacker_user_id, target_user_id, shop_location, attacker_data=attacker_data)
+            if outcome[0]:
+                await asyncio.to_thread(game.save_player_data, attacker_user_id, outcome[0])
+                logger.info(f"Saved attacker data for {attacker_user_id} after sabotage attempt.")
+    if error_reply:
+        await query.edit_message_text(error_reply); return
+
+    _, attacker_messages, target_alert = outcome
+    target_name = await asyncio.to_thread(game.find_display_name_by_id, target_user_id) or f"Player {target_user_id}"
+    shop_display = await asyncio.to_thread(game.get_shop_custom_name, target_user_id, shop_location) or shop_location
     await query.edit_message_text(f"Sending agent to hit {shop_display} at {target_name}'s place... Fingers crossed!")
-    logger.info(f"User {attacker_user_id} confirmed sabotage attempt against {target_user_id}'s shop: {shop_location}")
-    modified_attacker_data = await _process_sabotage(context, attacker_user_id, target_user_id, shop_location)
-    if modified_attacker_data:
-        game.save_player_data(attacker_user_id, modified_attacker_data)
-        logger.info(f"Saved attacker data for {attacker_user_id} after sabotage attempt.")
+    for message in attacker_messages:
+        await context.bot.send_message(chat_id=attacker_user_id, text=message)
+    if target_alert:
+        try:
+            await safe_send(context.bot, target_user_id, text=target_alert)
+        except Exception as notify_err: logger.error(f"Failed to notify target {target_user_id} of sabotage attempt: {notify_err}")
     # --- Show Status Again AFTER processing --- #
     logger.debug(f"Sabotage attempt processed for {attacker_user_id}, showing status.")
     await asyncio.sleep(1.5)  # Add delay to let player read the message
@@ -1419,35 +1601,14 @@ async def upgrade_shop_choice_callback(update: Update, context: ContextTypes.DEF
 async def _send_status_update(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Re-shows the status message with buttons after an action is completed."""
     try:
-        player_data = game.load_player_data(user_id)
+        player_data = await asyncio.to_thread(game.load_player_data, user_id)
         if not player_data:
             await context.bot.send_message(chat_id=chat_id, text="Could not load your updated status.")
             return
             
-        status_message = game.format_status(player_data)
-        
-        # Create action buttons
-        keyboard = [
-            [
-                InlineKeyboardButton("💰 Collect Income", callback_data="main_collect"),
-                InlineKeyboardButton("⬆️ Upgrade Shop", callback_data="main_upgrade"),
-            ],
-            [
-                InlineKeyboardButton("🗺️ Expand Empire", callback_data="main_expand"),
-                InlineKeyboardButton("🎯 View Challenges", callback_data="main_challenges"),
-            ],
-            [
-                InlineKeyboardButton("🏆 Leaderboard", callback_data="main_leaderboard"),
-                InlineKeyboardButton("🔪 Sabotage Rival", callback_data="main_sabotage"),
-            ],
-            [
-                InlineKeyboardButton("🍕 Buy Coins", callback_data="main_buycoins"),
-                InlineKeyboardButton("❓ Help Guide", callback_data="main_help"),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        status_message = await asyncio.to_thread(game.format_status, player_data)
         
-        await context.bot.send_message(chat_id=chat_id, text=status_message, reply_markup=reply_markup, parse_mode="HTML")
+        await context.bot.send_message(chat_id=chat_id, text=status_message, reply_markup=STATUS_MAIN_MARKUP, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error in _send_status_update for user {user_id}: {e}", exc_info=True)
 
@@ -1482,7 +1643,8 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # --- Collect --- #
         if action == "main_collect":
             logger.debug(f"Handling main_collect action via button for {user.id}")
-            collected_amount, completed_challenges, is_mafia_event, mafia_demand = game.collect_income(user.id)
+            async with player_lock(user.id):
+                collected_amount, completed_challenges, is_mafia_event, mafia_demand, newly_unlocked, tip_amount = await asyncio.to_thread(game.collect_income, user.id)
             if is_mafia_event:
                 if mafia_demand is None or mafia_demand <= 0:
                     await context.bot.send_message(chat_id=chat_id, text="Collectors seemed confused... lucky break?")
@@ -1498,17 +1660,13 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     # Don't show status yet, mafia_button_callback will handle this
             elif collected_amount > 0.01:
                 tip_message, pineapple_message = "", ""
-                if random.random() < 0.15: # Tip chance
-                    player_data_tip = game.load_player_data(user.id)
-                    tip_amount = round(random.uniform(collected_amount * 0.05, collected_amount * 0.2) + random.uniform(5, 50), 2); tip_amount = max(5.0, tip_amount)
-                    player_data_tip["cash"] = player_data_tip.get("cash", 0) + tip_amount
-                    game.save_player_data(user.id, player_data_tip)
+                if tip_amount: # Already added to cash by collect_income
                     tip_message = f"\n🍕 Wiseguy tipped ya ${tip_amount:.2f}!"
-                if random.random() < 0.05: # Pineapple chance
+                if _rng.random() < PINEAPPLE_CHANCE:
                     pineapple_message = "\n🍍 Psst... Remember the pineapple rule..."
                 await context.bot.send_message(chat_id=chat_id, text=f"🤑 Pizza payday! +${collected_amount:,.2f}!{tip_message}{pineapple_message}", parse_mode="HTML")
                 await send_challenge_notifications(user.id, completed_challenges, context)
-                await check_and_notify_achievements(user.id, context)
+                await notify_achievements(user.id, newly_unlocked, context)
                 
                 # Show status after successful collection
                 await asyncio.sleep(1.5)  # Add delay to let player read the message
@@ -1528,7 +1686,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         elif action == "main_expand":
             logger.debug(f"Handling main_expand action via button for {user.id} - showing options")
             # Replicate expand_command logic (no args case)
-            player_data = game.load_player_data(user.id)
+            player_data = await asyncio.to_thread(game.load_player_data, user.id)
             if not player_data:
                 await context.bot.send_message(chat_id=chat_id, text="Could not load your data.")
             else:
@@ -1536,41 +1694,17 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 if not available:
                      await context.bot.send_message(chat_id=chat_id, text="No new turf available right now, boss!")
                 else:
-                     keyboard = []; row = []
-                     for i, loc in enumerate(available):
-                         cost = game.get_expansion_cost(loc); current_perf = game.get_current_performance_multiplier(loc)
-                         perf_emoji = "📈" if current_perf > 1.1 else "📉" if current_perf < 0.9 else "🤷‍♂️"
-                         button_text = f"{loc} {perf_emoji}x{current_perf:.1f} (${cost:,.0f})"
-                         row.append(InlineKeyboardButton(button_text, callback_data=f"expand_{loc}"))
-                         if (i + 1) % 2 == 0: keyboard.append(row); row = []
-                     if row: keyboard.append(row)
-                     reply_markup = InlineKeyboardMarkup(keyboard)
+                     expansion_meta = await asyncio.to_thread(game.get_expansion_meta_bulk, available)
+                     reply_markup = expansion_markup(tuple(expansion_meta.items()))
                      await context.bot.send_message(chat_id=chat_id, text="Choose your next conquest (Perf/Cost shown):", reply_markup=reply_markup)
 
         # --- Challenges --- #
         elif action == "main_challenges":
              logger.debug(f"Handling main_challenges action via button for {user.id}")
              # Replicate challenges_command logic
-             player_data = game.load_player_data(user.id); needs_save = False
-             if player_data.get("active_challenges", {}).get("daily") is None:
-                 game.generate_new_challenges(user.id, 'daily'); needs_save = True
-             if player_data.get("active_challenges", {}).get("weekly") is None:
-                 game.generate_new_challenges(user.id, 'weekly'); needs_save = True
-             if needs_save: player_data = game.load_player_data(user.id)
+             player_data = await ensure_challenges(user.id)
              if player_data:
-                 stats = player_data.get("stats", {}); active_challenges = player_data.get("active_challenges", {}); challenge_progress = player_data.get("challenge_progress", {})
-                 lines = ["<b>--- Your Active Challenges ---</b>"]
-                 for timescale in ["daily", "weekly"]:
-                     challenge = active_challenges.get(timescale); lines.append(f"\n<b>{timescale.capitalize()} Challenge:</b>")
-                     if challenge:
-                         metric = challenge["metric"]; goal = challenge["goal"]; current_prog = stats.get(metric, 0)
-                         is_complete = challenge_progress.get(timescale, {}).get(challenge["id"], False)
-                         prog_str = f" ({current_prog:,.0f} / {goal:,.0f})" if isinstance(goal, (int, float)) else ""
-                         status_str = " ✅ Completed!" if is_complete else prog_str
-                         lines.append(f"  - {challenge['description']}{status_str}")
-                         lines.append(f"    Reward: {challenge['reward_value']:,} {challenge['reward_type'].upper()}")
-                     else: lines.append("  Error generating challenge.")
-                 await context.bot.send_message(chat_id=chat_id, text="\n".join(lines), parse_mode="HTML")
+                 await context.bot.send_message(chat_id=chat_id, text=format_challenges(player_data), parse_mode="HTML")
                  
                  # Show status after viewing challenges via button
                  await asyncio.sleep(1.5)  # Add delay to let player read the message
@@ -1584,31 +1718,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # --- Leaderboard --- #
         elif action == "main_leaderboard":
              logger.debug(f"Handling main_leaderboard action via button for {user.id}")
-             # Replicate leaderboard_command logic
-             top_income = game.get_leaderboard_data(limit=10)
-             
-             # Calculate income rates for all players we find
-             income_rate_data = []
-             for player_id, player_name, _ in top_income:
-                 player_data = game.load_player_data(player_id)
-                 if player_data:
-                     shops = player_data.get("shops", {})
-                     income_rate = game.calculate_income_rate(shops)
-                     income_rate_data.append((player_id, player_name, income_rate))
-             
-             # Sort by income rate
-             income_rate_data.sort(key=lambda x: x[2], reverse=True)
-             income_rate_data = income_rate_data[:10]  # Limit to top 10
-             
-             lines = ["<b>🏆 Global Income Leaderboard 🏆</b>\n(Total Earned)\n"]
-             if not top_income: lines.append("<i>No income earned yet!</i>")
-             else: lines.extend([f"{(i+1)}. {(name or f'Player {pid}')[:25]} - ${inc:,.2f}" for i, (pid, name, inc) in enumerate(top_income)])
-             
-             lines.append("\n<b>💰 Income Rate Leaderboard 💰</b>\n($/sec)\n")
-             if not income_rate_data: lines.append("<i>No income rates calculated!</i>")
-             else: lines.extend([f"{(i+1)}. {(name or f'Player {pid}')[:25]} - ${rate:.2f}/sec" for i, (pid, name, rate) in enumerate(income_rate_data)])
-             
-             await context.bot.send_message(chat_id=chat_id, text="\n".join(lines), parse_mode="HTML")
+             await context.bot.send_message(chat_id=chat_id, text=await _leaderboard_html(), parse_mode="HTML")
              
              # Show status after viewing leaderboard via button
              await asyncio.sleep(1.5)  # Add delay to let player read the message
@@ -1621,10 +1731,8 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
              if not PAYMENT_PROVIDER_TOKEN:
                  await context.bot.send_message(chat_id=chat_id, text="My owner still hasn't signed up for a Stripe account...")
              else:
-                 for pack_id, (name, desc, price_cents, coin_amount) in game.PIZZA_COIN_PACKS.items():
-                     title = f"{name} ({coin_amount} Coins)"; payload = f"BUY_{pack_id.upper()}_{user.id}"; currency = "USD"; prices = [LabeledPrice(label=name, amount=price_cents)]
-                     try: await context.bot.send_invoice(chat_id=user.id, title=title, description=desc, payload=payload, provider_token=PAYMENT_PROVIDER_TOKEN, currency=currency, prices=prices)
-                     except Exception as e: logger.error(f"Failed to send invoice {pack_id} from button: {e}"); await context.bot.send_message(chat_id=chat_id, text=f"Couldn't start purchase for {name}.")
+                 for name in await send_coin_invoices(context, user.id):
+                     await context.bot.send_message(chat_id=chat_id, text=f"Couldn't start purchase for {name}.")
 
         # --- Help --- #
         elif action == "main_help":
@@ -1661,23 +1769,20 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
              logger.debug(f"Handling main_sabotage action via button for {user.id}")
              # Replicate sabotage_command logic (no args case) to show target list
              attacker_user_id = user.id
-             attacker_data = game.load_player_data(attacker_user_id)
+             attacker_data = await asyncio.to_thread(game.load_player_data, attacker_user_id)
              if not attacker_data:
                  await context.bot.send_message(chat_id=chat_id, text="Couldn't load your data.")
                  return
              # Check Cooldown
-             now = time.time()
-             last_attempt_time = attacker_data.get("last_sabotage_attempt_time", 0.0)
-             time_since_last = now - last_attempt_time
-             if time_since_last < game.SABOTAGE_COOLDOWN_SECONDS:
-                  remaining_cooldown = timedelta(seconds=int(game.SABOTAGE_COOLDOWN_SECONDS - time_since_last))
-                  await context.bot.send_message(chat_id=chat_id, text=f"Your agents need to lay low! Sabotage available again in {str(remaining_cooldown).split('.')[0]}.")
+             remaining_cooldown = _check_sabotage_cooldown(attacker_data, time.time())
+             if remaining_cooldown:
+                  await context.bot.send_message(chat_id=chat_id, text=f"Your agents need to lay low! Sabotage available again in {remaining_cooldown}.")
                   return
              # Calculate potential cost for explanation
              attacker_cash = attacker_data.get("cash", 0)
              potential_cost = round(game.SABOTAGE_BASE_COST + (attacker_cash * game.SABOTAGE_PCT_COST), 2)
              # Show Target List
-             potential_targets = game.get_cash_leaderboard_data(limit=20)
+             potential_targets = await _cached_leaderboard("cash", game.get_cash_leaderboard_data, 20)
              valid_targets = [(pid, name, cash) for pid, name, cash in potential_targets if pid != user.id]
              if not valid_targets:
                  await context.bot.send_message(chat_id=chat_id, text="No valid targets found on the cash leaderboard right now!")
@@ -1710,36 +1815,97 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
          logger.error(f"Error handling main_menu_callback action {action} for {user.id}: {e}", exc_info=True)
          await context.bot.send_message(chat_id=chat_id, text="Ay! Somethin' went wrong with that button.")
 
-def main() -> None:
-    """Start the bot and scheduler."""
-    logger.info("Building Telegram Application...")
-    # Revert Application builder to simpler form
-    application = Application.builder().token(BOT_TOKEN).build()
-    logger.info("Telegram Application built successfully.")
+async def _post_init(application: Application) -> None:
+    """Sizes the thread pool and starts the scheduler on the application's running event loop once the bot is initialized."""
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="game"))
+    # Schedule challenge generation jobs
+    logger.info("Setting up scheduled jobs...")
+    try:
+        # Run daily at 00:01 UTC
+        scheduler.add_job(generate_daily_challenges_job, CronTrigger(hour=0, minute=1, timezone="UTC"), args=[application])
+        # Run weekly on Monday at 00:05 UTC
+        scheduler.add_job(generate_weekly_challenges_job, CronTrigger(day_of_week='mon', hour=0, minute=5, timezone="UTC"), args=[application])
+        # Add new job for performance update (e.g., daily at 00:03 UTC)
+        scheduler.add_job(update_location_performance_job, CronTrigger(hour=0, minute=3, timezone="UTC"), args=[application])
+        # Periodic write-back for low-value player changes the cache holds back
+        scheduler.add_job(flush_player_cache_job, IntervalTrigger(seconds=game.PLAYER_PERIODIC_FLUSH_SECONDS), args=[application])
+        scheduler.start()
+        logger.info("Scheduler started successfully.")
+    except Exception as e:
+        logger.error(f"Failed to start scheduler: {e}", exc_info=True)
+        # Depending on severity, might want to exit or just log
 
+async def _post_shutdown(application: Application) -> None:
+    """Stops the scheduler, writes back cached players and releases the database connection pool once updates have stopped."""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await asyncio.to_thread(game.flush_player_cache)
+    await asyncio.to_thread(game.close_db_pool)
+    log_listener.stop() # Drains any queued records
+
+class FastCommandDispatcher(BaseHandler):
+    """Routes every bot command with one dict lookup instead of asking a CommandHandler per command.
+       Matches CommandHandler semantics: command entity at offset 0, optional @botname, context.args set."""
+
+    def __init__(self, commands: dict):
+        super().__init__(self._unused_callback)
+        self.commands = {name.lower(): callback for name, callback in commands.items()}
+
+    @staticmethod
+    async def _unused_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        pass # handle_update calls the matched command's callback instead
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update):
+            return None
+        message = update.message or update.edited_message
+        if not message or not message.text or not message.entities:
+            return None
+        entity = message.entities[0]
+        if entity.type != MessageEntity.BOT_COMMAND or entity.offset != 0:
+            return None
+        command, _, bot_username = message.text[1:entity.length].partition("@")
+        if bot_username and bot_username.lower() != message.get_bot().username.lower():
+            return None # Addressed to another bot in a group chat
+        callback = self.commands.get(command.lower())
+        if callback is None:
+            return None
+        return callback, message.text.split()[1:]
+
+    def collect_additional_context(self, context, update, application, check_result) -> None:
+        context.args = check_result[1]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[0](update, context)
+
+def register_handlers(application: Application) -> None:
+    """Adds every bot handler exactly once, whichever entry point builds the Application."""
+    if application.bot_data.get("handlers_registered"):
+        logger.warning("Handlers already registered on this application, skipping.")
+        return
     logger.info("Adding command handlers...")
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("status", status_command))
-    application.add_handler(CommandHandler("play", status_command))  # Add /play command that calls status_command
-    application.add_handler(CommandHandler("collect", collect_command))
-    application.add_handler(CommandHandler("upgrade", upgrade_command))
-    application.add_handler(CommandHandler("expand", expand_command))
-    application.add_handler(CommandHandler("challenges", challenges_command))
-    application.add_handler(CommandHandler("buycoins", buy_coins_command))
-    application.add_handler(CommandHandler("leaderboard", leaderboard_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("setname", setname_command))
-    application.add_handler(CommandHandler("renameshop", renameshop_command))
-    application.add_handler(CommandHandler("sabotage", sabotage_command))
-    # application.add_handler(CommandHandler("boost", boost_command)) # Placeholder boost command
+    application.add_handler(FastCommandDispatcher({
+        "start": start_command,
+        "status": status_command,
+        "play": status_command, # /play is an alias for /status
+        "collect": collect_command,
+        "upgrade": upgrade_command,
+        "expand": expand_command,
+        "challenges": challenges_command,
+        "buycoins": buy_coins_command,
+        "leaderboard": leaderboard_command,
+        "help": help_command,
+        "setname": setname_command,
+        "renameshop": renameshop_command,
+        "sabotage": sabotage_command,
+        # "boost": boost_command, # Placeholder boost command
+    }))
 
     logger.info("Adding payment handlers...")
     application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
 
-    logger.info("Adding unknown command handler...")
-    application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
-
     # --- Add Callback Handlers (Correct Order) --- #
     logger.info("Adding callback handlers...")
     application.add_handler(CallbackQueryHandler(mafia_button_callback, pattern="^mafia_(pay|refuse)$"))
@@ -1749,27 +1915,48 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(upgrade_shop_choice_callback, pattern="^upgrade_shop_")) # <<< Add this handler back
     application.add_handler(CallbackQueryHandler(main_menu_callback, pattern="^main_.*")) # Status buttons
 
-    # Schedule challenge generation jobs
-    logger.info("Setting up scheduled jobs...")
-    try:
-        # Run daily at 00:01 UTC
-        scheduler.add_job(generate_daily_challenges_job, CronTrigger(hour=0, minute=1, timezone="UTC"), args=[application])
-        # Run weekly on Monday at 00:05 UTC
-        scheduler.add_job(generate_weekly_challenges_job, CronTrigger(day_of_week='mon', hour=0, minute=5, timezone="UTC"), args=[application])
-        # Add new job for performance update (e.g., daily at 00:03 UTC)
-        scheduler.add_job(update_location_performance_job, CronTrigger(hour=0, minute=3, timezone="UTC"), args=[application])
-        scheduler.start()
-        logger.info("Scheduler started successfully.")
-    except Exception as e:
-        logger.error(f"Failed to start scheduler: {e}", exc_info=True)
-        # Depending on severity, might want to exit or just log
+    # Catch-all stays last in group 0 so it is only tried after every real handler missed.
+    # Not a separate group: PTB runs one handler per group, so group 1 would also answer known commands.
+    logger.info("Adding unknown command handler...")
+    application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
+    # Separate group so it runs alongside whichever handler answered; by then the player is usually cached
+    application.add_handler(TypeHandler(Update, record_activity), group=1)
+    application.bot_data["handlers_registered"] = True
 
-    logger.info("Starting Pizza Wars bot polling...")
-    application.run_polling()
+def main() -> None:
+    """Start the bot and scheduler."""
+    logger.info("Building Telegram Application...")
+    game.init_db_pool() # Already created during startup DB init; kept here so main() stands alone
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(AIORateLimiter(max_retries=TELEGRAM_MAX_RETRIES))
+        .connection_pool_size(TELEGRAM_CONNECTION_POOL_SIZE)
+        .pool_timeout(TELEGRAM_POOL_TIMEOUT_SECONDS)
+        .connect_timeout(TELEGRAM_CONNECT_TIMEOUT_SECONDS)
+        .read_timeout(TELEGRAM_READ_TIMEOUT_SECONDS)
+        .http_version(TELEGRAM_HTTP_VERSION)
+        .get_updates_connection_pool_size(1)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
+    logger.info("Telegram Application built successfully.")
+
+    register_handlers(application)
 
-    # Shut down scheduler gracefully if bot stops (though run_polling blocks)
-    # Consider using run_webhook for production which doesn't block like this
-    # scheduler.shutdown()
+    if WEBHOOK_HOST:
+        logger.info(f"Starting Pizza Wars bot webhook on port {WEBHOOK_PORT}...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"https://{WEBHOOK_HOST}/{BOT_TOKEN}",
+        )
+    else:
+        logger.info("Starting Pizza Wars bot polling...")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()